@@ -0,0 +1,230 @@
+"""
+Minimal manipulation of ELF shared libraries, for the kernel libraries
+produced by :meth:`artiq.compiler.targets.Target.link`.
+"""
+
+import struct
+
+
+SHT_SYMTAB = 2
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHT_DYNSYM = 11
+
+SHF_ALLOC = 0x2
+SHF_INFO_LINK = 0x40
+
+SHN_LORESERVE = 0xff00
+
+ET_EXEC = 2
+ET_DYN = 3
+
+_DEBUG_PREFIXES = (b".debug", b".zdebug", b".gdb_index")
+
+
+class _Layout:
+    def __init__(self, data):
+        if data[:4] != b"\x7fELF":
+            raise ValueError("not an ELF file")
+        if data[4] not in (1, 2) or data[5] not in (1, 2):
+            raise ValueError("unsupported ELF class or data encoding")
+        self.is64 = data[4] == 2
+        order = "<" if data[5] == 1 else ">"
+        if self.is64:
+            self.ehdr = struct.Struct(order + "16sHHIQQQIHHHHHH")
+            self.shdr = struct.Struct(order + "IIQQQQIIQQ")
+            self.phdr = struct.Struct(order + "IIQQQQQQ")
+            self.sym = struct.Struct(order + "IBBHQQ")
+            self.sym_shndx = 3
+            self.rel = struct.Struct(order + "QQ")
+            self.rela = struct.Struct(order + "QQq")
+            self.r_sym_shift = 32
+        else:
+            self.ehdr = struct.Struct(order + "16sHHIIIIIHHHHHH")
+            self.shdr = struct.Struct(order + "IIIIIIIIII")
+            self.phdr = struct.Struct(order + "IIIIIIII")
+            self.sym = struct.Struct(order + "IIIBBH")
+            self.sym_shndx = 5
+            self.rel = struct.Struct(order + "II")
+            self.rela = struct.Struct(order + "IIi")
+            self.r_sym_shift = 8
+
+    def segments(self, data, e_phoff, e_phnum):
+        for index in range(e_phnum):
+            fields = self.phdr.unpack_from(data, e_phoff + index*self.phdr.size)
+            if self.is64:
+                # p_type, p_flags, p_offset, ..., p_filesz, ...
+                yield fields[2], fields[5]
+            else:
+                # p_type, p_offset, ..., p_filesz, ...
+                yield fields[1], fields[4]
+
+
+def _read_sections(layout, data):
+    header = layout.ehdr.unpack_from(data, 0)
+    e_shoff, e_shentsize, e_shnum, e_shstrndx = header[6], header[11], header[12], header[13]
+    sections = [list(layout.shdr.unpack_from(data, e_shoff + index*e_shentsize))
+                for index in range(e_shnum)]
+    names = []
+    if sections:
+        shstrtab_offset = sections[e_shstrndx][4]
+        for section in sections:
+            start = shstrtab_offset + section[0]
+            names.append(bytes(data[start:data.index(b"\0", start)]))
+    return sections, names
+
+
+def sections(data):
+    """Returns the sections of an ELF file, as a list of
+    ``(name, type, flags, offset, size)`` tuples."""
+    layout = _Layout(data)
+    sections, names = _read_sections(layout, data)
+    return [(name.decode(), section[1], section[2], section[4], section[5])
+            for name, section in zip(names, sections)]
+
+
+def _entries(data, section, entry):
+    return [list(entry.unpack_from(data, offset))
+            for offset in range(section[4], section[4] + section[5], entry.size)]
+
+
+def _align(offset, alignment):
+    if alignment > 1:
+        offset = (offset + alignment - 1) // alignment * alignment
+    return offset
+
+
+def strip_debug(data):
+    """Removes the debug information from an ELF shared library or
+    executable, like ``llvm-strip --strip-debug``.
+
+    The loadable contents of the file are not modified; the non-loadable
+    sections that are kept are moved after them, followed by the section
+    header table."""
+    layout = _Layout(data)
+    (e_ident, e_type, e_machine, e_version, e_entry, e_phoff, e_shoff,
+     e_flags, e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum,
+     e_shstrndx) = layout.ehdr.unpack_from(data, 0)
+    if e_type not in (ET_EXEC, ET_DYN):
+        raise ValueError("not an ELF shared library or executable")
+    if e_shnum == 0:
+        return bytes(data)
+
+    sections, names = _read_sections(layout, data)
+    removed = set()
+    for index, section in enumerate(sections):
+        if index != 0 and not section[2] & SHF_ALLOC and \
+                names[index].startswith(_DEBUG_PREFIXES):
+            removed.add(index)
+    for index, section in enumerate(sections):
+        if section[1] in (SHT_REL, SHT_RELA) and section[7] in removed:
+            removed.add(index)
+    if not removed:
+        return bytes(data)
+    if e_shstrndx in removed:
+        raise ValueError("section name table is a debug section")
+
+    new_index = {}
+    for index in range(e_shnum):
+        if index not in removed:
+            new_index[index] = len(new_index)
+    def remap(index):
+        if index >= SHN_LORESERVE:
+            return index
+        if index in removed:
+            raise ValueError("section {} refers to a debug section".format(index))
+        return new_index[index]
+
+    # Symbols defined in removed sections, e.g. their section symbols, are
+    # removed from the symbol tables like llvm-strip does, and the
+    # relocations using the tables are renumbered.
+    contents = dict()
+    symbol_indices = dict()
+    for index in new_index:
+        section = sections[index]
+        if index == 0 or section[1] not in (SHT_SYMTAB, SHT_DYNSYM):
+            continue
+        symbols = _entries(data, section, layout.sym)
+        kept = [symbol_index for symbol_index, symbol in enumerate(symbols)
+                if symbol[layout.sym_shndx] not in removed]
+        if len(kept) < len(symbols):
+            if section[2] & SHF_ALLOC:
+                raise ValueError("loadable symbol table {} refers to a debug "
+                                 "section".format(index))
+            symbol_indices[index] = {old: new for new, old in enumerate(kept)}
+            # index of the first global symbol
+            section[7] = sum(1 for old in kept if old < section[7])
+        for symbol_index in kept:
+            symbol = symbols[symbol_index]
+            if symbol[layout.sym_shndx] != 0:
+                symbol[layout.sym_shndx] = remap(symbol[layout.sym_shndx])
+        contents[index] = b"".join(layout.sym.pack(*symbols[symbol_index])
+                                   for symbol_index in kept)
+    for index in new_index:
+        section = sections[index]
+        if section[1] not in (SHT_REL, SHT_RELA) or section[6] not in symbol_indices:
+            continue
+        mapping = symbol_indices[section[6]]
+        entry = layout.rela if section[1] == SHT_RELA else layout.rel
+        relocations = _entries(data, section, entry)
+        mask = (1 << layout.r_sym_shift) - 1
+        for relocation in relocations:
+            symbol_index = relocation[1] >> layout.r_sym_shift
+            if symbol_index not in mapping:
+                raise ValueError("relocation section {} refers to a symbol of "
+                                 "a debug section".format(index))
+            relocation[1] = (mapping[symbol_index] << layout.r_sym_shift |
+                             relocation[1] & mask)
+        contents[index] = b"".join(entry.pack(*relocation)
+                                   for relocation in relocations)
+
+    # Everything up to the end of the loadable contents stays in place.
+    base = e_ehsize
+    if e_phnum:
+        base = max(base, e_phoff + e_phnum*e_phentsize)
+    for offset, filesz in layout.segments(data, e_phoff, e_phnum):
+        base = max(base, offset + filesz)
+    for index, section in enumerate(sections):
+        if index not in removed and section[2] & SHF_ALLOC and section[1] != SHT_NOBITS:
+            base = max(base, section[4] + section[5])
+
+    output = bytearray(data[:base])
+    for index, content in contents.items():
+        section = sections[index]
+        if section[4] < base:
+            # loadable sections keep their size
+            output[section[4]:section[4] + section[5]] = content
+    for index in sorted(new_index, key=lambda index: sections[index][4]):
+        section = sections[index]
+        if index == 0 or section[4] < base:
+            continue
+        offset = _align(len(output), section[8])
+        if section[1] == SHT_NOBITS:
+            section[4] = offset
+            continue
+        output += bytes(offset - len(output))
+        if index in contents:
+            output += contents[index]
+            section[5] = len(contents[index])
+        else:
+            output += data[section[4]:section[4] + section[5]]
+        section[4] = offset
+
+    for index in new_index:
+        section = sections[index]
+        if index == 0:
+            continue
+        section[6] = remap(section[6])
+        if section[1] in (SHT_REL, SHT_RELA) or section[2] & SHF_INFO_LINK:
+            section[7] = remap(section[7])
+
+    e_shoff = _align(len(output), 8 if layout.is64 else 4)
+    output += bytes(e_shoff - len(output))
+    for index in sorted(new_index):
+        output += layout.shdr.pack(*sections[index])
+    output[:layout.ehdr.size] = layout.ehdr.pack(
+        e_ident, e_type, e_machine, e_version, e_entry, e_phoff, e_shoff,
+        e_flags, e_ehsize, e_phentsize, e_phnum, layout.shdr.size, len(new_index),
+        new_index[e_shstrndx])
+    return bytes(output)
@@ -15,7 +15,7 @@ from pythonparser import lexer as source_lexer, parser as source_parser
 from Levenshtein import ratio as similarity, jaro_winkler
 
 from ..language import core as language_core
-from . import types, builtins, asttyped, math_fns, prelude
+from . import types, builtins, asttyped, math_fns, prelude, profiler
 from .transforms import ASTTypedRewriter, Inferencer, IntMonomorphizer, TypedtreePrinter
 from .transforms.asttyped_rewriter import LocalExtractor
 
@@ -27,6 +27,26 @@ except ImportError:
     _ArrayFunctionDispatcher = None    
 
 
+# Lists and arrays of numbers of a single type with at least this many
+# elements are embedded as a single constant rather than element by element.
+# Such a constant is shared by all evaluations of the expression that quotes it.
+BLOB_MIN_ELEMENTS = 1024
+
+_blob_dtypes = {
+    numpy.dtype(numpy.int32): builtins.TInt32,
+    numpy.dtype(numpy.int64): builtins.TInt64,
+    numpy.dtype(numpy.float64): builtins.TFloat,
+}
+
+_blob_elt_types = {
+    int: builtins.TInt,
+    float: builtins.TFloat,
+    numpy.int32: builtins.TInt32,
+    numpy.int64: builtins.TInt64,
+    numpy.float64: builtins.TFloat,
+}
+
+
 class SpecializedFunction:
     def __init__(self, instance_type, host_function):
         self.instance_type = instance_type
@@ -289,6 +309,41 @@ class ASTSynthesizer:
                     self._add_iterable(", ")
         return elts
 
+    def blob_type(self, value):
+        """Returns the type of `value` if it is a large list or array of
+        numbers that can be embedded as a single constant, or None."""
+        if isinstance(value, numpy.ndarray):
+            if value.size < BLOB_MIN_ELEMENTS or value.dtype not in _blob_dtypes:
+                return None
+            return builtins.TArray(_blob_dtypes[value.dtype](), value.ndim)
+
+        if len(value) < BLOB_MIN_ELEMENTS:
+            return None
+        T = type(value[0])
+        if T not in _blob_elt_types:
+            return None
+        for v in value:
+            if type(v) is not T:
+                return None
+        if T is int and not (-2**63 < min(value) and max(value) < 2**63-1):
+            return None
+        # The width of Python integers is left undetermined, as for integer
+        # literals; IntMonomorphizer will collapse it.
+        elt_type = _blob_elt_types[T]()
+        return builtins.TList(elt_type)
+
+    def quote_blob(self, value, typ):
+        """Construct a constant equal to `value`, of type `typ` as returned
+        by :meth:`blob_type`, without an AST node per element."""
+        count = value.size if isinstance(value, numpy.ndarray) else len(value)
+        quote_loc   = self._add_iterable('`')
+        repr_loc    = self._add_iterable("<{} of {} elements>".format(
+                                            type(value).__name__, count))
+        unquote_loc = self._add_iterable('`')
+        loc         = quote_loc.join(unquote_loc)
+        # Lists are quoted as arrays, since the AST visitors walk through lists.
+        return asttyped.QuoteT(value=numpy.asarray(value), type=typ, loc=loc)
+
     def quote(self, value):
         """Construct an AST fragment equal to `value`."""
         if value is None:
@@ -349,6 +404,10 @@ class ASTSynthesizer:
 
             return asttyped.QuoteT(value=value, type=builtins.TByteArray(), loc=loc)
         elif isinstance(value, list):
+            blob_type = self.blob_type(value)
+            if blob_type is not None:
+                return self.quote_blob(value, blob_type)
+
             begin_loc = self._add_iterable("[")
             elts = self.fast_quote_list(value)
             end_loc   = self._add_iterable("]")
@@ -364,6 +423,9 @@ class ASTSynthesizer:
                                    begin_loc=begin_loc, end_loc=end_loc,
                                    loc=begin_loc.join(end_loc))
         elif isinstance(value, numpy.ndarray):
+            blob_type = self.blob_type(value)
+            if blob_type is not None:
+                return self.quote_blob(value, blob_type)
             return self.call(numpy.array, [list(value)], {})
         elif inspect.isfunction(value) or inspect.ismethod(value) or \
                 isinstance(value, pytypes.BuiltinFunctionType) or \
@@ -786,6 +848,54 @@ class TypedtreeHasher(algorithm.Visitor):
             fields = fields + node._types
         return hash(tuple(freeze(getattr(node, field_name)) for field_name in fields))
 
+class TypedtreeDependencies(algorithm.Visitor):
+    """
+    Collects what the inference of a typed tree depends on: the type
+    variables that are not unified yet, and the types of host objects,
+    whose attributes and instances may be discovered later, with their
+    state when they are first collected.
+    """
+
+    def __init__(self, value_map):
+        self.value_map = value_map
+        self.type_vars = []
+        self.host_types = []
+        self.seen = set()
+
+    def _collect(self, accum, typ):
+        if id(typ) not in self.seen:
+            self.seen.add(id(typ))
+            if isinstance(typ, types.TVar):
+                self.type_vars.append(typ)
+            elif isinstance(typ, (types.TInstance, types.TModule, types.TConstructor)):
+                self.host_types.append((typ, len(typ.attributes),
+                                        len(self.value_map.get(typ, ()))))
+        return accum
+
+    def visit_type(self, typ):
+        if isinstance(typ, types.Type) and id(typ) not in self.seen:
+            typ.fold(None, self._collect)
+
+    def generic_visit(self, node):
+        for field_name in getattr(node, "_types", ()):
+            self.visit_type(getattr(node, field_name))
+        if isinstance(node, asttyped.scoped):
+            for typ in node.typing_env.values():
+                self.visit_type(typ)
+        super().generic_visit(node)
+
+    def changed(self):
+        """Checks whether any of the collected dependencies changed since
+        it was collected."""
+        for typ in self.type_vars:
+            if typ.parent is not typ:
+                return True
+        for typ, attribute_count, value_count in self.host_types:
+            if len(typ.attributes) != attribute_count or \
+                    len(self.value_map.get(typ, ())) != value_count:
+                return True
+        return False
+
 class Stitcher:
     def __init__(self, core, dmgr, engine=None, print_as_rpc=True, destination=0, subkernel_arg_types=[]):
         self.core = core
@@ -829,30 +939,21 @@ class Stitcher:
         synthesizer.finalize()
         self.typedtree.append(call_node)
 
-    def finalize(self):
+    def finalize(self, incremental=True):
+        """
+        Infers the types of the stitched functions until they do not change.
+
+        :param incremental: only infer again the functions whose types or
+            host objects changed since they were last inferred; otherwise,
+            infer the whole typed tree until its hash does not change.
+        """
         inferencer = StitchingInferencer(engine=self.engine,
                                          value_map=self.value_map,
                                          quote=self._quote)
-        typedtree_hasher = TypedtreeHasher()
-
-        # Iterate inference to fixed point.
-        old_typedtree_hash = None
-        old_attr_count = None
-        while True:
-            inferencer.visit(self.typedtree)
-            if self.definitely_changed:
-                changed = True
-                self.definitely_changed = False
-            else:
-                typedtree_hash = typedtree_hasher.visit(self.typedtree)
-                attr_count = self.embedding_map.attribute_count()
-                changed = old_attr_count != attr_count or \
-                          old_typedtree_hash != typedtree_hash
-                old_typedtree_hash = typedtree_hash
-                old_attr_count = attr_count
-
-            if not changed:
-                break
+        if incremental:
+            self._infer_incrementally(inferencer)
+        else:
+            self._infer_to_fixpoint(inferencer)
 
         # After we've discovered every referenced attribute, check if any kernel_invariant
         # specifications refers to ones we didn't encounter.
@@ -888,6 +989,57 @@ class Stitcher:
             typing_env=self.globals, globals_in_scope=set(),
             body=self.typedtree, loc=source.Range(source_buffer, 0, 0))
 
+    def _infer_to_fixpoint(self, inferencer):
+        typedtree_hasher = TypedtreeHasher()
+
+        # Iterate inference to fixed point.
+        old_typedtree_hash = None
+        old_attr_count = None
+        iteration = 0
+        while True:
+            with profiler.stage("inference", iteration=iteration):
+                inferencer.visit(self.typedtree)
+            iteration += 1
+            if self.definitely_changed:
+                changed = True
+                self.definitely_changed = False
+            else:
+                with profiler.stage("fixpoint_check", iteration=iteration - 1):
+                    typedtree_hash = typedtree_hasher.visit(self.typedtree)
+                    attr_count = self.embedding_map.attribute_count()
+                changed = old_attr_count != attr_count or \
+                          old_typedtree_hash != typedtree_hash
+                old_typedtree_hash = typedtree_hash
+                old_attr_count = attr_count
+
+            if not changed:
+                break
+
+    def _infer_incrementally(self, inferencer):
+        # The dependencies of each node of the typed tree (typically
+        # a function definition), collected before and after it was last
+        # inferred. A node is inferred again until inferring it does not
+        # change its types, and then again whenever its dependencies change.
+        # Nodes injected while inferring are inferred in the next iteration.
+        dependencies = {}
+        iteration = 0
+        while True:
+            with profiler.stage("fixpoint_check", iteration=iteration):
+                changed = [node for node in self.typedtree
+                           if id(node) not in dependencies or
+                              dependencies[id(node)].changed()]
+            if not changed:
+                break
+
+            with profiler.stage("inference", iteration=iteration, nodes=len(changed)):
+                for node in changed:
+                    collector = TypedtreeDependencies(self.value_map)
+                    collector.visit(node)
+                    inferencer.visit(node)
+                    collector.visit(node)
+                    dependencies[id(node)] = collector
+            iteration += 1
+
     def _inject(self, node):
         self.typedtree.insert(self.inject_at, node)
         self.inject_at += 1
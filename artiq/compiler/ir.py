@@ -19,6 +19,8 @@ class TBasicBlock(types.TMono):
     def __init__(self):
         super().__init__("label")
 
+_basic_block_type = TBasicBlock()
+
 def is_basic_block(typ):
     return isinstance(typ, TBasicBlock)
 
@@ -37,6 +39,34 @@ def is_keyword(typ):
     return isinstance(typ, TKeyword)
 
 
+# Scalar types are allocated anew for most instructions, but never change
+# once their parameters are known, so the values share a single instance
+# of each.
+_interned_types = {}
+_internable_types = (TBasicBlock, builtins.TNone, builtins.TBool,
+                     builtins.TInt, builtins.TFloat, builtins.TStr)
+
+def intern_type(typ):
+    """
+    Returns a canonical instance of ``typ`` if it is a scalar type with
+    known parameters, or ``typ`` itself.
+    """
+    typ = typ.find()
+    if typ.__class__ not in _internable_types:
+        return typ
+    if typ.__class__ is builtins.TInt:
+        width = typ.params["width"].find()
+        if not isinstance(width, types.TValue):
+            return typ
+        key = (typ.__class__, width.value)
+    else:
+        key = typ.__class__
+    interned = _interned_types.get(key)
+    if interned is None:
+        interned = _interned_types[key] = typ
+    return interned
+
+
 # See rpc_proto.rs and comm_kernel.py:_{send,receive}_rpc_value.
 def rpc_tag(typ, error_handler):
     typ = typ.find()
@@ -86,8 +116,10 @@ class Value:
     :ivar uses: (list of :class:`Value`) values that use this value
     """
 
+    __slots__ = ("uses", "type")
+
     def __init__(self, typ):
-        self.uses, self.type = set(), typ.find()
+        self.uses, self.type = set(), intern_type(typ)
 
     def replace_all_uses_with(self, value):
         for user in set(self.uses):
@@ -103,6 +135,8 @@ class Constant(Value):
     :ivar value: (Python object) value
     """
 
+    __slots__ = ("value",)
+
     def __init__(self, value, typ):
         super().__init__(typ)
         self.value = value
@@ -132,6 +166,8 @@ class NamedValue(Value):
     :ivar function: (:class:`Function`) function containing this value
     """
 
+    __slots__ = ("name", "function", "is_removed")
+
     def __init__(self, typ, name):
         super().__init__(typ)
         self.name, self.function = name, None
@@ -166,6 +202,8 @@ class User(NamedValue):
     :ivar operands: (list of :class:`Value`) operands of this value
     """
 
+    __slots__ = ("operands",)
+
     def __init__(self, operands, typ, name):
         super().__init__(typ, name)
         self.operands = []
@@ -199,6 +237,8 @@ class Instruction(User):
         source location
     """
 
+    __slots__ = ("basic_block", "loc")
+
     def __init__(self, operands, typ, name=""):
         assert isinstance(operands, list)
         assert isinstance(typ, types.Type)
@@ -270,6 +310,8 @@ class Phi(Instruction):
     directly reading :attr:`operands` or calling :meth:`set_operands`.
     """
 
+    __slots__ = ()
+
     def __init__(self, typ, name=""):
         super().__init__([], typ, name)
 
@@ -337,6 +379,8 @@ class Terminator(Instruction):
     An SSA instruction that performs control flow.
     """
 
+    __slots__ = ()
+
     def successors(self):
         return [operand for operand in self.operands if isinstance(operand, BasicBlock)]
 
@@ -346,10 +390,13 @@ class BasicBlock(NamedValue):
 
     :ivar instructions: (list of :class:`Instruction`)
     """
+
+    __slots__ = ("instructions",)
+
     _dump_loc = True
 
     def __init__(self, instructions, name=""):
-        super().__init__(TBasicBlock(), name)
+        super().__init__(_basic_block_type, name)
         self.instructions = []
         self.set_instructions(instructions)
 
@@ -457,6 +504,9 @@ class Argument(NamedValue):
     :ivar loc: (:class:`pythonparser.source.Range` or None)
         source location
     """
+
+    __slots__ = ("loc",)
+
     def __init__(self, typ, name):
         super().__init__(typ, name)
         self.loc = None
@@ -481,6 +531,9 @@ class Function:
         Flag ``fast-math`` is the equivalent of gcc's ``-ffast-math``.
     """
 
+    __slots__ = ("type", "name", "loc", "names", "arguments", "basic_blocks",
+                 "next_name", "is_internal", "is_cold", "is_generated", "flags")
+
     def __init__(self, typ, name, arguments, loc=None):
         self.type, self.name, self.loc = typ, name, loc
         self.names, self.arguments, self.basic_blocks = set(), [], []
@@ -617,6 +670,8 @@ class EnvironmentArgument(Argument):
     A function argument specifying an outer environment.
     """
 
+    __slots__ = ()
+
     def as_operand(self, type_printer):
         return "environment(...) %{}".format(escape_name(self.name))
 
@@ -626,6 +681,8 @@ class Alloc(Instruction):
     the type of the intsruction.
     """
 
+    __slots__ = ()
+
     def __init__(self, operands, typ, name=""):
         for operand in operands: assert isinstance(operand, Value)
         super().__init__(operands, typ, name)
@@ -648,6 +705,8 @@ class GetLocal(Instruction):
     :ivar var_name: (string) variable name
     """
 
+    __slots__ = ("var_name",)
+
     """
     :param env: (:class:`Value`) local environment
     :param var_name: (string) local variable name
@@ -678,6 +737,8 @@ class SetLocal(Instruction):
     :ivar var_name: (string) variable name
     """
 
+    __slots__ = ("var_name",)
+
     """
     :param env: (:class:`Value`) local environment
     :param var_name: (string) local variable name
@@ -715,6 +776,8 @@ class GetArgFromRemote(Instruction):
     :ivar arg_type: argument type
     """
 
+    __slots__ = ("arg_name", "arg_type")
+
     """
     :param arg_name: (string) argument name
     :param arg_type: argument type
@@ -745,6 +808,8 @@ class GetOptArgFromRemote(GetArgFromRemote):
                  in reference to remote arguments
     """
 
+    __slots__ = ("rcv_count", "index")
+
     """
     :param rcv_count: number of received valuese
     :param index: (integer) index of the current argument, 
@@ -772,6 +837,8 @@ class SubkernelAwaitArgs(Instruction):
     :ivar arg_types: (list of types) types of passed arguments (including optional)
     """
 
+    __slots__ = ("arg_types",)
+
     """
     :param arg_types: (list of types) types of passed arguments (including optional)
     """
@@ -789,6 +856,8 @@ class GetAttr(Instruction):
     :ivar attr: (string) variable name
     """
 
+    __slots__ = ("attr",)
+
     """
     :param obj: (:class:`Value`) object or tuple
     :param attr: (string or integer) attribute or index
@@ -826,6 +895,8 @@ class SetAttr(Instruction):
     :ivar attr: (string) variable name
     """
 
+    __slots__ = ("attr",)
+
     """
     :param obj: (:class:`Value`) object or tuple
     :param attr: (string or integer) attribute
@@ -864,6 +935,8 @@ class Offset(Instruction):
     remain inside the same object (see :class:`GetElem` and LLVM's GetElementPtr).
     """
 
+    __slots__ = ()
+
     """
     :param lst: (:class:`Value`) list
     :param index: (:class:`Value`) index
@@ -888,6 +961,8 @@ class GetElem(Instruction):
     An intruction that loads an element from a list.
     """
 
+    __slots__ = ()
+
     """
     :param lst: (:class:`Value`) list
     :param index: (:class:`Value`) index
@@ -911,6 +986,8 @@ class SetElem(Instruction):
     An intruction that stores an element into a list.
     """
 
+    __slots__ = ()
+
     """
     :param lst: (:class:`Value`) list
     :param index: (:class:`Value`) index
@@ -940,6 +1017,8 @@ class Coerce(Instruction):
     A coercion operation for numbers.
     """
 
+    __slots__ = ()
+
     def __init__(self, value, typ, name=""):
         assert isinstance(value, Value)
         assert isinstance(typ, types.Type)
@@ -958,6 +1037,8 @@ class Arith(Instruction):
     :ivar op: (:class:`pythonparser.ast.operator`) operation
     """
 
+    __slots__ = ("op",)
+
     """
     :param op: (:class:`pythonparser.ast.operator`) operation
     :param lhs: (:class:`Value`) left-hand operand
@@ -993,6 +1074,8 @@ class Compare(Instruction):
     :ivar op: (:class:`pythonparser.ast.cmpop`) operation
     """
 
+    __slots__ = ("op",)
+
     """
     :param op: (:class:`pythonparser.ast.cmpop`) operation
     :param lhs: (:class:`Value`) left-hand operand
@@ -1028,6 +1111,8 @@ class Builtin(Instruction):
     :ivar op: (string) operation name
     """
 
+    __slots__ = ("op",)
+
     """
     :param op: (string) operation name
     """
@@ -1054,6 +1139,8 @@ class Closure(Instruction):
     :ivar target_function: (:class:`Function`) function to invoke
     """
 
+    __slots__ = ("target_function",)
+
     """
     :param func: (:class:`Function`) function
     :param env: (:class:`Value`) outer environment
@@ -1088,6 +1175,8 @@ class Call(Instruction):
         the callee function is cold
     """
 
+    __slots__ = ("arg_exprs", "static_target_function", "is_cold")
+
     """
     :param func: (:class:`Value`) function to call
     :param args: (list of :class:`Value`) function arguments
@@ -1130,6 +1219,8 @@ class Select(Instruction):
     A conditional select instruction.
     """
 
+    __slots__ = ()
+
     """
     :param cond: (:class:`Value`) select condition
     :param if_true: (:class:`Value`) value of select if condition is truthful
@@ -1162,6 +1253,8 @@ class Quote(Instruction):
     :ivar value: (string) operation name
     """
 
+    __slots__ = ("value",)
+
     """
     :param value: (string) operation name
     """
@@ -1182,6 +1275,8 @@ class Branch(Terminator):
     An unconditional branch instruction.
     """
 
+    __slots__ = ()
+
     """
     :param target: (:class:`BasicBlock`) branch target
     """
@@ -1205,6 +1300,8 @@ class BranchIf(Terminator):
     A conditional branch instruction.
     """
 
+    __slots__ = ()
+
     """
     :param cond: (:class:`Value`) branch condition
     :param if_true: (:class:`BasicBlock`) branch target if condition is truthful
@@ -1235,6 +1332,8 @@ class IndirectBranch(Terminator):
     An indirect branch instruction.
     """
 
+    __slots__ = ()
+
     """
     :param target: (:class:`Value`) branch target
     :param destinations: (list of :class:`BasicBlock`) all possible values of `target`
@@ -1270,6 +1369,8 @@ class Return(Terminator):
         where the return value is sent back through DRTIO
     """
 
+    __slots__ = ("remote_return",)
+
     """
     :param value: (:class:`Value`) return value
     """
@@ -1289,6 +1390,8 @@ class Unreachable(Terminator):
     An instruction used to mark unreachable branches.
     """
 
+    __slots__ = ()
+
     """
     :param target: (:class:`BasicBlock`) branch target
     """
@@ -1303,6 +1406,8 @@ class Raise(Terminator):
     A raise instruction.
     """
 
+    __slots__ = ()
+
     """
     :param value: (:class:`Value`) exception value
     :param exn: (:class:`BasicBlock` or None) exceptional target
@@ -1330,6 +1435,8 @@ class Resume(Terminator):
     A resume instruction.
     """
 
+    __slots__ = ()
+
     """
     :param exn: (:class:`BasicBlock` or None) exceptional target
     """
@@ -1359,6 +1466,8 @@ class Invoke(Terminator):
         the callee function is cold
     """
 
+    __slots__ = ("arg_exprs", "static_target_function", "is_cold")
+
     """
     :param func: (:class:`Value`) function to call
     :param args: (list of :class:`Value`) function arguments
@@ -1424,6 +1533,8 @@ class LandingPad(Terminator):
         exception types corresponding to the basic block operands
     """
 
+    __slots__ = ("types", "has_cleanup")
+
     def __init__(self, cleanup, name=""):
         super().__init__([cleanup], builtins.TException(), name)
         self.types = []
@@ -1469,6 +1580,8 @@ class Delay(Terminator):
     :ivar interval: (:class:`iodelay.Expr`) expression
     """
 
+    __slots__ = ("interval",)
+
     """
     :param interval: (:class:`iodelay.Expr`) expression
     :param call: (:class:`Call` or ``Constant(None, builtins.TNone())``)
@@ -1522,6 +1635,8 @@ class Loop(Terminator):
         expression for trip count
     """
 
+    __slots__ = ("trip_count",)
+
     """
     :param trip_count: (:class:`iodelay.Expr`) expression
     :param indvar: (:class:`Phi`)
@@ -1571,6 +1686,8 @@ class Interleave(Terminator):
     in parallel.
     """
 
+    __slots__ = ()
+
     def __init__(self, destinations, name=""):
         super().__init__(destinations, builtins.TNone(), name)
 
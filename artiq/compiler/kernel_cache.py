@@ -0,0 +1,187 @@
+"""
+The :class:`KernelCache` class keeps the shared libraries produced by
+the compiler on disk, so that kernels whose generated code has not changed
+are not optimized, assembled, linked and stripped again.
+
+Entries are addressed by a hash of the LLVM IR generated for the kernel,
+which includes the values of the host objects embedded in the kernel,
+together with a description of the target and of the compiler. The
+embedding map references host objects, and is therefore not stored; it is
+rebuilt by the stitching and code generation steps, which always run.
+"""
+
+import os
+import sys
+import hashlib
+import logging
+import tempfile
+import subprocess
+
+import llvmlite
+
+from artiq import __version__ as artiq_version
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    """Returns the directory of the cache, which can be set with the
+    ``ARTIQ_KERNEL_CACHE`` environment variable. An empty value disables
+    the cache, in which case None is returned."""
+    directory = os.getenv("ARTIQ_KERNEL_CACHE")
+    if directory is None:
+        if sys.platform == "win32":
+            base = os.getenv("LOCALAPPDATA", os.path.expanduser("~"))
+        else:
+            base = os.getenv("XDG_CACHE_HOME",
+                             os.path.join(os.path.expanduser("~"), ".cache"))
+        directory = os.path.join(base, "artiq", "kernels")
+    return directory or None
+
+
+def _compiler_digest(tool_ld):
+    # The output also depends on the optimization passes, linker script and
+    # stripping, which may change without the ARTIQ version number in
+    # development trees, and on the linker, which is found in the PATH.
+    h = hashlib.sha256()
+    h.update(artiq_version.encode())
+    h.update(llvmlite.__version__.encode())
+    for filename in ("targets.py", "kernel.ld", "elf.py"):
+        with open(os.path.join(os.path.dirname(__file__), filename), "rb") as f:
+            h.update(f.read())
+    try:
+        h.update(subprocess.run([tool_ld, "--version"], capture_output=True,
+                                check=True).stdout)
+    except (OSError, subprocess.CalledProcessError):
+        # linking will fail anyway
+        logger.debug("failed to get the version of %s", tool_ld, exc_info=True)
+    return h.digest()
+
+
+_compiler_digests = dict()
+
+
+class KernelCache:
+    """
+    Size-bounded cache of compiled kernels, in the directory ``directory``.
+    When the total size of the entries exceeds ``max_size`` bytes, the least
+    recently used entries are deleted.
+
+    Several processes may use the same directory concurrently.
+    """
+    suffix = ".kernel"
+
+    def __init__(self, directory, max_size=256*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+    def key(self, target, llvm_ir):
+        digest = _compiler_digests.get(target.tool_ld)
+        if digest is None:
+            digest = _compiler_digest(target.tool_ld)
+            _compiler_digests[target.tool_ld] = digest
+        h = hashlib.sha256(digest)
+        description = (type(target).__module__, type(target).__qualname__,
+                       target.triple, target.data_layout, target.features,
+                       target.additional_linker_options, target.subkernel_id,
+                       target.opt_level)
+        h.update(repr(description).encode())
+        h.update(llvm_ir.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Returns the library and the stripped library stored for ``key``,
+        or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        library_size = int.from_bytes(data[:4], "little")
+        return data[4:4+library_size], data[4+library_size:]
+
+    def put(self, key, library, stripped_library):
+        data = len(library).to_bytes(4, "little") + library + stripped_library
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False,
+                                         suffix=".tmp") as f:
+            f.write(data)
+            tmpname = f.name
+        os.replace(tmpname, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in
+        its maximum size."""
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            else:
+                self.stats["evictions"] += 1
+            total_size -= size
+
+    def clear(self):
+        max_size, self.max_size = self.max_size, 0
+        try:
+            self.evict()
+        finally:
+            self.max_size = max_size
+
+    def lookup(self, target, llvm_ir):
+        """Returns the key of the entry for ``llvm_ir``, and the entry if
+        present. The key is None if the cache is bypassed because compiler
+        dumps are requested, as they are produced by the compilation
+        steps."""
+        if any(name.startswith("ARTIQ_DUMP_") for name in os.environ):
+            return None, None
+        key = self.key(target, llvm_ir)
+        entry = self.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            logger.debug("kernel cache miss for %s", key)
+        else:
+            self.stats["hits"] += 1
+            logger.debug("kernel cache hit for %s", key)
+        return key, entry
+
+    def store(self, key, library, stripped_library):
+        """Stores the results of a compilation after a miss of
+        :meth:`lookup`."""
+        if key is None:
+            return
+        try:
+            self.put(key, library, stripped_library)
+        except OSError:
+            logger.warning("failed to store kernel in cache", exc_info=True)
@@ -10,7 +10,7 @@ string and infers types for it using a trivial :module:`prelude`.
 
 import os
 from pythonparser import source, diagnostic, parse_buffer
-from . import prelude, types, transforms, analyses, validators, embedding
+from . import prelude, types, transforms, analyses, validators, embedding, profiler
 
 class Source:
     def __init__(self, source_buffer, engine=None):
@@ -67,23 +67,38 @@ class Module:
         interleaver = transforms.Interleaver(engine=self.engine)
         invariant_detection = analyses.InvariantDetection(engine=self.engine)
 
-        int_monomorphizer.visit(src.typedtree)
-        cast_monomorphizer.visit(src.typedtree)
-        inferencer.visit(src.typedtree)
-        monomorphism_validator.visit(src.typedtree)
-        escape_validator.visit(src.typedtree)
-        iodelay_estimator.visit_fixpoint(src.typedtree)
-        constness_validator.visit(src.typedtree)
-        devirtualization.visit(src.typedtree)
-        self.artiq_ir = artiq_ir_generator.visit(src.typedtree)
-        artiq_ir_generator.annotate_calls(devirtualization)
-        dead_code_eliminator.process(self.artiq_ir)
-        interleaver.process(self.artiq_ir)
-        local_access_validator.process(self.artiq_ir)
-        local_demoter.process(self.artiq_ir)
-        constant_hoister.process(self.artiq_ir)
+        with profiler.stage("int_monomorphizer"):
+            int_monomorphizer.visit(src.typedtree)
+        with profiler.stage("cast_monomorphizer"):
+            cast_monomorphizer.visit(src.typedtree)
+        with profiler.stage("inferencer"):
+            inferencer.visit(src.typedtree)
+        with profiler.stage("monomorphism_validator"):
+            monomorphism_validator.visit(src.typedtree)
+        with profiler.stage("escape_validator"):
+            escape_validator.visit(src.typedtree)
+        with profiler.stage("iodelay_estimator"):
+            iodelay_estimator.visit_fixpoint(src.typedtree)
+        with profiler.stage("constness_validator"):
+            constness_validator.visit(src.typedtree)
+        with profiler.stage("devirtualization"):
+            devirtualization.visit(src.typedtree)
+        with profiler.stage("artiq_ir_generator"):
+            self.artiq_ir = artiq_ir_generator.visit(src.typedtree)
+            artiq_ir_generator.annotate_calls(devirtualization)
+        with profiler.stage("dead_code_eliminator"):
+            dead_code_eliminator.process(self.artiq_ir)
+        with profiler.stage("interleaver"):
+            interleaver.process(self.artiq_ir)
+        with profiler.stage("local_access_validator"):
+            local_access_validator.process(self.artiq_ir)
+        with profiler.stage("local_demoter"):
+            local_demoter.process(self.artiq_ir)
+        with profiler.stage("constant_hoister"):
+            constant_hoister.process(self.artiq_ir)
         if remarks:
-            invariant_detection.process(self.artiq_ir)
+            with profiler.stage("invariant_detection"):
+                invariant_detection.process(self.artiq_ir)
         # for subkernels: main kernel inferencer output, to be passed to further compilations
         self.subkernel_arg_types = inferencer.subkernel_arg_types
 
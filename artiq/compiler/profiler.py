@@ -0,0 +1,119 @@
+"""
+Instrumentation of the compiler.
+
+The compiler marks its stages with :func:`stage`. When a :class:`Profiler`
+is active (see :func:`activate`), each stage is recorded with its wall
+time and the peak of memory allocated by Python during the stage, as
+measured by :mod:`tracemalloc`; otherwise, :func:`stage` does nothing.
+Memory allocated by LLVM is not included, and tracing the allocations
+slows down the compiler.
+"""
+
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+REPORT_VERSION = 1
+
+_active = None
+
+
+class Profiler:
+    """Records of the stages of a compilation.
+
+    :param trace_memory: whether to measure the peak memory of each stage.
+    """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.start = time.time()
+        self.stages = []
+        # list of [name, peak memory of the finished children]
+        self._stack = []
+
+    def _traced_peak(self):
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        return peak
+
+    @contextmanager
+    def stage(self, name, **info):
+        path = "/".join([entry[0] for entry in self._stack] + [name])
+        record = {"name": path}
+        record.update(info)
+        self.stages.append(record)
+
+        memory = None
+        if self.trace_memory:
+            peak = self._traced_peak()
+            if self._stack:
+                parent = self._stack[-1]
+                parent[1] = max(parent[1], peak)
+            memory = tracemalloc.get_traced_memory()[0]
+        entry = [name, 0]
+        self._stack.append(entry)
+        record["start"] = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["time"] = time.perf_counter() - t0
+            self._stack.pop()
+            if memory is not None:
+                peak = max(entry[1], self._traced_peak())
+                record["peak_memory"] = max(0, peak - memory)
+                if self._stack:
+                    parent = self._stack[-1]
+                    parent[1] = max(parent[1], peak)
+
+    def merge(self, stages):
+        """Adds stages recorded by another profiler, typically in another
+        process."""
+        self.stages += stages
+
+    def report(self, **info):
+        """Returns the report of the compilation, as a JSON-serializable
+        dictionary.
+
+        The ``stages`` item lists the stages in the order they started, with
+        their name (the names of the enclosing stages and of the stage,
+        separated by slashes), start time (as a UNIX timestamp), time in
+        seconds, and peak memory in bytes above the memory allocated at the
+        start of the stage. Some stages have additional items, such as the
+        iteration number."""
+        report = {"version": REPORT_VERSION}
+        report.update(info)
+        report["start"] = self.start
+        report["time"] = time.time() - self.start
+        report["stages"] = sorted(self.stages, key=lambda s: s["start"])
+        return report
+
+
+def active():
+    """Returns the active profiler, or None."""
+    return _active
+
+
+@contextmanager
+def activate(profiler):
+    """Makes ``profiler`` record the stages of the compiler in the current
+    process while in the context."""
+    global _active
+    previous, _active = _active, profiler
+    stop_tracing = profiler.trace_memory and not tracemalloc.is_tracing()
+    if stop_tracing:
+        tracemalloc.start()
+    try:
+        yield profiler
+    finally:
+        _active = previous
+        if stop_tracing:
+            tracemalloc.stop()
+
+
+def stage(name, **info):
+    """Returns a context manager recording a stage named ``name`` with the
+    active profiler, if any."""
+    if _active is None:
+        return nullcontext()
+    return _active.stage(name, **info)
@@ -1,5 +1,5 @@
 import os, sys, tempfile, subprocess, io
-from artiq.compiler import types, ir
+from artiq.compiler import types, ir, profiler, elf
 from llvmlite import ir as ll, binding as llvm
 
 llvm.initialize()
@@ -63,6 +63,11 @@ def _dump(target, kind, suffix, content):
         file.close()
         print("{} dumped as {}".format(kind, file.name), file=sys.stderr)
 
+#: Optimization levels of the targets: 0 only runs a few cheap passes and
+#: generates code without optimization, 1 additionally simplifies the code
+#: without inlining, and 2 runs the full pipeline.
+OPT_LEVELS = (0, 1, 2)
+
 class Target:
     """
     A description of the target environment where the binaries
@@ -81,6 +86,9 @@ class Target:
         provided by the target, e.g. ``"printf"``.
     :var now_pinning: (boolean)
         Whether the target implements the now-pinning RTIO optimization.
+    :var opt_level: (int)
+        Optimization level, from 0 (fastest compilation) to 2 (fastest
+        code, the default). See :data:`OPT_LEVELS`.
     """
     triple = "unknown"
     data_layout = ""
@@ -90,19 +98,20 @@ class Target:
     now_pinning = True
 
     tool_ld = "ld.lld"
-    tool_strip = "llvm-strip"
     tool_symbolizer = "llvm-symbolizer"
     tool_cxxfilt = "llvm-cxxfilt"
 
-    def __init__(self, subkernel_id=None):
+    def __init__(self, subkernel_id=None, opt_level=2):
+        assert opt_level in OPT_LEVELS
         self.llcontext = ll.Context()
         self.subkernel_id = subkernel_id
+        self.opt_level = opt_level
 
     def target_machine(self):
         lltarget = llvm.Target.from_triple(self.triple)
         llmachine = lltarget.create_target_machine(
                         features=",".join(["+{}".format(f) for f in self.features]),
-                        reloc="pic", codemodel="default",
+                        opt=self.opt_level, reloc="pic", codemodel="default",
                         abiname="ilp32d" if isinstance(self, RV32GTarget) else "")
         llmachine.set_asm_verbosity(True)
         return llmachine
@@ -110,6 +119,15 @@ class Target:
     def optimize(self, llmodule):
         llpassmgr = llvm.create_module_pass_manager()
 
+        if self.opt_level == 0:
+            # Only keep the local variables in registers rather than on
+            # the stack, and remove unreachable code; this is cheap and
+            # makes the code much smaller.
+            llpassmgr.add_sroa_pass()
+            llpassmgr.add_cfg_simplification_pass()
+            llpassmgr.run(llmodule)
+            return
+
         # Register our alias analysis passes.
         llpassmgr.add_basic_alias_analysis_pass()
         llpassmgr.add_type_based_alias_analysis_pass()
@@ -122,24 +140,26 @@ class Target:
         llpassmgr.add_sroa_pass()
         llpassmgr.add_dead_code_elimination_pass()
         llpassmgr.add_function_attrs_pass()
-        llpassmgr.add_global_optimizer_pass()
 
-        # Now, actually optimize the code.
-        llpassmgr.add_function_inlining_pass(275)
-        llpassmgr.add_ipsccp_pass()
-        llpassmgr.add_instruction_combining_pass()
-        llpassmgr.add_gvn_pass()
-        llpassmgr.add_cfg_simplification_pass()
-        llpassmgr.add_licm_pass()
+        if self.opt_level >= 2:
+            llpassmgr.add_global_optimizer_pass()
 
-        # Clean up after optimizing.
-        llpassmgr.add_dead_arg_elimination_pass()
-        llpassmgr.add_global_dce_pass()
+            # Now, actually optimize the code.
+            llpassmgr.add_function_inlining_pass(275)
+            llpassmgr.add_ipsccp_pass()
+            llpassmgr.add_instruction_combining_pass()
+            llpassmgr.add_gvn_pass()
+            llpassmgr.add_cfg_simplification_pass()
+            llpassmgr.add_licm_pass()
+
+            # Clean up after optimizing.
+            llpassmgr.add_dead_arg_elimination_pass()
+            llpassmgr.add_global_dce_pass()
 
         llpassmgr.run(llmodule)
 
-    def compile(self, module):
-        """Compile the module to a relocatable object for this target."""
+    def generate_llvm_ir(self, module):
+        """Generate the LLVM IR of the module for this target, as text."""
 
         if os.getenv("ARTIQ_DUMP_SIG"):
             print("====== MODULE_SIGNATURE DUMP ======", file=sys.stderr)
@@ -153,19 +173,32 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_IR"), "ARTIQ IR", suffix + ".txt",
               lambda: "\n".join(fn.as_entity(type_printer) for fn in module.artiq_ir))
 
-        llmod = module.build_llvm_ir(self)
+        with profiler.stage("llvm_ir_generator"):
+            return str(module.build_llvm_ir(self))
+
+    def compile(self, module, llvm_ir=None):
+        """Compile the module to a relocatable object for this target.
+
+        ``llvm_ir`` may be given if the output of :meth:`generate_llvm_ir`
+        for the module is already available."""
 
+        if llvm_ir is None:
+            llvm_ir = self.generate_llvm_ir(module)
+
+        suffix = "_subkernel_{}".format(self.subkernel_id) if self.subkernel_id is not None else ""
         try:
-            llparsedmod = llvm.parse_assembly(str(llmod))
-            llparsedmod.verify()
+            with profiler.stage("llvm_parse"):
+                llparsedmod = llvm.parse_assembly(llvm_ir)
+                llparsedmod.verify()
         except RuntimeError:
-            _dump("", "LLVM IR (broken)", ".ll", lambda: str(llmod))
+            _dump("", "LLVM IR (broken)", ".ll", lambda: llvm_ir)
             raise
 
         _dump(os.getenv("ARTIQ_DUMP_UNOPT_LLVM"), "LLVM IR (generated)", suffix + "_unopt.ll",
               lambda: str(llparsedmod))
 
-        self.optimize(llparsedmod)
+        with profiler.stage("llvm_optimize"):
+            self.optimize(llparsedmod)
 
         _dump(os.getenv("ARTIQ_DUMP_LLVM"), "LLVM IR (optimized)", suffix + ".ll",
               lambda: str(llparsedmod))
@@ -181,34 +214,41 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_OBJ"), "Object file", ".o",
               lambda: llmachine.emit_object(llmodule))
 
-        return llmachine.emit_object(llmodule)
+        with profiler.stage("llvm_emit_object"):
+            return llmachine.emit_object(llmodule)
 
     def link(self, objects):
-        """Link the relocatable objects into a shared library for this target."""
-        with RunTool([self.tool_ld, "-shared", "--eh-frame-hdr"] +
-                     self.additional_linker_options +
-                     ["-T" + os.path.join(os.path.dirname(__file__), "kernel.ld")] +
-                     ["{{obj{}}}".format(index) for index in range(len(objects))] +
-                     ["-x"] +
-                     ["-o", "{output}"],
-                     output=None,
-                     **{"obj{}".format(index): obj for index, obj in enumerate(objects)}) \
-                as results:
-            library = results["output"].read()
-
-            _dump(os.getenv("ARTIQ_DUMP_ELF"), "Shared library", ".elf",
-                  lambda: library)
-
-            return library
+        """Link the relocatable objects into a shared library for this target.
+
+        Unlike stripping, linking still runs ``ld.lld`` on temporary files
+        for each kernel; it is the remaining external step of the backend,
+        which the kernel cache avoids for kernels compiled again."""
+        with profiler.stage("link"):
+            with RunTool([self.tool_ld, "-shared", "--eh-frame-hdr"] +
+                         self.additional_linker_options +
+                         ["-T" + os.path.join(os.path.dirname(__file__), "kernel.ld")] +
+                         ["{{obj{}}}".format(index) for index in range(len(objects))] +
+                         ["-x"] +
+                         ["-o", "{output}"],
+                         output=None,
+                         **{"obj{}".format(index): obj for index, obj in enumerate(objects)}) \
+                    as results:
+                library = results["output"].read()
+
+                _dump(os.getenv("ARTIQ_DUMP_ELF"), "Shared library", ".elf",
+                      lambda: library)
+
+                return library
 
     def compile_and_link(self, modules):
         return self.link([self.assemble(self.compile(module)) for module in modules])
 
     def strip(self, library):
-        with RunTool([self.tool_strip, "--strip-debug", "{library}", "-o", "{output}"],
-                     library=library, output=None) \
-                as results:
-            return results["output"].read()
+        """Remove the debug information from a shared library produced by
+        :meth:`link`. The library with debug information is only needed to
+        symbolize backtraces, and is kept in memory by the caller."""
+        with profiler.stage("strip"):
+            return elf.strip_debug(library)
 
     def symbolize(self, library, addresses):
         if addresses == []:
@@ -278,7 +318,6 @@ class RV32IMATarget(Target):
     now_pinning = True
 
     tool_ld = "ld.lld"
-    tool_strip = "llvm-strip"
     tool_symbolizer = "llvm-symbolizer"
     tool_cxxfilt = "llvm-cxxfilt"
 
@@ -291,7 +330,6 @@ class RV32GTarget(Target):
     now_pinning = True
 
     tool_ld = "ld.lld"
-    tool_strip = "llvm-strip"
     tool_symbolizer = "llvm-symbolizer"
     tool_cxxfilt = "llvm-cxxfilt"
 
@@ -304,6 +342,5 @@ class CortexA9Target(Target):
     now_pinning = False
 
     tool_ld = "ld.lld"
-    tool_strip = "llvm-strip"
     tool_symbolizer = "llvm-symbolizer"
     tool_cxxfilt = "llvm-cxxfilt"
@@ -0,0 +1,73 @@
+"""
+Measures the time and memory needed to build and transform the ARTIQ IR
+of a large generated kernel.
+
+Example::
+
+    python -m artiq.compiler.testbench.perf_ir 500
+"""
+
+import sys, gc, tracemalloc
+from .. import profiler
+from ..module import Module, Source
+
+
+_function_template = """
+def f{index}(x):
+    total = 0
+    values = [x, x + 1, x + 2]
+    for i in range(x):
+        if i % 3 == 0:
+            total += i * {index}
+        elif i % 5 == 1:
+            total -= values[i % 3]
+        else:
+            total = total + (i << 1) - {index}
+    while total > 1000:
+        total = total // 2
+    return total
+"""
+
+
+def make_source(count):
+    return "".join(_function_template.format(index=index) for index in range(count)) + \
+        "def entrypoint():\n" + \
+        "".join("    f{}({})\n".format(index, index) for index in range(count))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    source = make_source(count)
+
+    # Compile once without instrumentation for the wall time.
+    gc.collect()
+    p = profiler.Profiler(trace_memory=False)
+    with profiler.activate(p):
+        Module(Source.from_string(source, "<perf_ir>"))
+    times = {stage["name"]: stage["time"] for stage in p.stages}
+
+    p = profiler.Profiler()
+    with profiler.activate(p):
+        module = Module(Source.from_string(source, "<perf_ir>"))
+        gc.collect()
+        with_ir = tracemalloc.get_traced_memory()[0]
+        instructions = sum(1 for function in module.artiq_ir
+                              for _ in function.instructions())
+        del module.artiq_ir
+        gc.collect()
+        retained = with_ir - tracemalloc.get_traced_memory()[0]
+    peaks = {stage["name"]: stage["peak_memory"] for stage in p.stages}
+
+    print("{} functions, {} instructions".format(count, instructions))
+    print("| Stage | Time (ms) | Peak memory (KiB) |")
+    print("| ----- | --------- | ----------------- |")
+    for name in ("artiq_ir_generator", "dead_code_eliminator", "interleaver",
+                 "local_access_validator", "local_demoter", "constant_hoister"):
+        print("| {} | {:.1f} | {:.0f} |".format(name, times[name]*1e3,
+                                                peaks[name]/1024))
+    print("ARTIQ IR: {:.0f} KiB ({:.0f} bytes per instruction)".format(
+        retained/1024, retained/instructions))
+
+
+if __name__ == "__main__":
+    main()
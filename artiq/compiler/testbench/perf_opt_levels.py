@@ -0,0 +1,74 @@
+"""
+Compares the optimization levels of the kernels.
+
+Compiles the cases of :mod:`artiq.compiler.testbench.perf_suite` (by
+default, the experiments of ``artiq/examples``) at each optimization level,
+and prints the compile time and the size of the linked kernels as a table.
+
+Example::
+
+    python -m artiq.compiler.testbench.perf_opt_levels -k 'examples/*'
+"""
+
+import os, argparse, tempfile, fnmatch
+
+from artiq.master.databases import DatasetDB
+from ..targets import OPT_LEVELS
+from .perf_suite import synthetic_cases, lit_cases, example_cases, measure
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description="ARTIQ kernel optimization level comparison")
+    parser.add_argument("-k", "--cases", default="examples/*",
+                        help="only run the cases whose name matches this "
+                             "shell pattern (default: %(default)s)")
+    parser.add_argument("-n", "--runs", default=3, type=int,
+                        help="number of compilations of each case, of which "
+                             "the fastest is kept (default: %(default)s)")
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+    os.environ["ARTIQ_KERNEL_CACHE"] = ""
+
+    print("| Case | " + " | ".join("O{0} (ms) | O{0} (bytes)".format(level)
+                                   for level in OPT_LEVELS) + " |")
+    print("| ---- |" + " --- | --- |"*len(OPT_LEVELS))
+    with tempfile.TemporaryDirectory() as dataset_dir:
+        dataset_db = DatasetDB(os.path.join(dataset_dir, "dataset_db.mdb"))
+        cases = synthetic_cases() + lit_cases() + example_cases(dataset_db)
+        totals = {level: [0., 0] for level in OPT_LEVELS}
+        for name, prepare in cases:
+            if not fnmatch.fnmatch(name, args.cases):
+                continue
+            row = []
+            try:
+                for level in OPT_LEVELS:
+                    compile_case = prepare(level)
+                    if compile_case is None:
+                        break
+                    result = measure(compile_case, args.runs, True)
+                    row.append((result["total"], result["size"]))
+            except Exception as error:
+                message = str(error).strip().split("\n")[0]
+                print("skipped {}: {}: {}".format(name, type(error).__name__,
+                                                  message))
+                continue
+            if len(row) != len(OPT_LEVELS):
+                continue
+            for level, (total, size) in zip(OPT_LEVELS, row):
+                totals[level][0] += total
+                totals[level][1] += size
+            print("| {} | ".format(name) +
+                  " | ".join("{:.1f} | {}".format(total*1e3, size)
+                             for total, size in row) + " |")
+        dataset_db.close_db()
+    print("| **total** | " +
+          " | ".join("{:.1f} | {}".format(totals[level][0]*1e3, totals[level][1])
+                     for level in OPT_LEVELS) + " |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import sys, time, linecache
+from ...coredevice.core import Core
+
+
+_subkernel_template = """
+    @subkernel(destination={destination})
+    def subkernel{index}(self) -> TNone:
+        x = 0
+        for i in range(1000):
+            if i % 3 == 0:
+                x += i*i
+            else:
+                x -= i
+"""
+
+_kernel_template = """
+from artiq.language.core import *
+from artiq.language.types import *
+
+class Benchmark:
+    def __init__(self, core):
+        self.core = core
+{subkernels}
+    @kernel
+    def run(self):
+{calls}
+"""
+
+
+def make_benchmark(core, count):
+    code = _kernel_template.format(
+        subkernels="".join(_subkernel_template.format(destination=i + 1, index=i)
+                           for i in range(count)),
+        calls="".join("        self.subkernel{}()\n".format(i)
+                      for i in range(count)))
+    filename = "<perf_subkernels {}>".format(count)
+    # the compiler reads the source of kernels from the line cache
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    testcase_vars = {"__name__": "testbench"}
+    exec(compile(code, filename, "exec"), testcase_vars)
+    return testcase_vars["Benchmark"](core)
+
+
+def measure(core, count, runs=3):
+    experiment = make_benchmark(core, count)
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        _, subkernels = core._compile_with_subkernels(
+            type(experiment).run, (experiment,), {}, None)
+        duration = time.perf_counter() - start
+        assert [sid for _, sid, _ in subkernels] == sorted(sid for _, sid, _ in subkernels)
+        assert len(subkernels) == count
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def measure_cold(destinations, count):
+    # includes starting the processes of the pool, as in each experiment
+    # run by the master
+    dmgr = dict()
+    core = dmgr["core"] = Core(dmgr, None, 1e-9,
+                               satellite_cpu_targets=destinations,
+                               compile_workers=None)
+    try:
+        return measure(core, count, runs=1)
+    finally:
+        core.close()
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [0, 1, 2, 4, 8, 12]
+    destinations = {i + 1: "rv32g" for i in range(max(counts))}
+
+    cores = {}
+    for name, compile_workers in ("serial", 0), ("parallel", None):
+        dmgr = dict()
+        cores[name] = dmgr["core"] = \
+            Core(dmgr, None, 1e-9, satellite_cpu_targets=destinations,
+                 compile_workers=compile_workers)
+    try:
+        # start the processes of the pool
+        measure(cores["parallel"], 1, runs=1)
+
+        print("| Subkernels | Serial (s) | Parallel (s) | Speedup "
+              "| Parallel with start-up (s) | Speedup |")
+        print("| ---------- | ---------- | ------------ | ------- "
+              "| -------------------------- | ------- |")
+        for count in counts:
+            serial = measure(cores["serial"], count)
+            parallel = measure(cores["parallel"], count)
+            cold = measure_cold(destinations, count)
+            print("| {:>10} | {:>10.2f} | {:>12.2f} | {:>7.2f} "
+                  "| {:>26.2f} | {:>7.2f} |".format(
+                      count, serial, parallel, serial/parallel,
+                      cold, serial/cold))
+    finally:
+        for core in cores.values():
+            core.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""
+Compile-time benchmark suite.
+
+Compiles a corpus of kernels against an offline core device: the embedding
+lit tests, the kernels of the lit integration tests, the experiments of
+``artiq/examples`` whose entry point is a kernel, and synthetic stress
+cases. The time spent in each phase of the compiler is measured with
+:mod:`artiq.compiler.profiler`, and the results of each invocation are
+appended to a JSON history. A case or phase that became slower than the
+median of the previous runs on the same host by more than a threshold is
+reported as a regression, and makes the exit status non-zero.
+
+Example::
+
+    python -m artiq.compiler.testbench.perf_suite --history compile_times.json
+"""
+
+import os, sys, glob, json, time, argparse, linecache, platform, statistics, \
+    tempfile, tokenize, fnmatch
+from collections import defaultdict
+
+from artiq import __artiq_dir__ as artiq_dir, __version__ as artiq_version
+from artiq.tools import file_import
+from artiq.master.databases import DeviceDB, DatasetDB
+from artiq.master.worker_db import DeviceManager, DatasetManager
+from artiq.language.environment import ProcessArgumentManager, is_experiment
+from artiq.coredevice.core import Core, _link_llvm_ir
+from ..targets import OPT_LEVELS
+from .. import profiler
+from ..module import Module, Source
+
+
+HISTORY_VERSION = 1
+
+
+def _exec_source(filename, code, namespace):
+    # the compiler reads the source of kernels from the line cache
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    exec(compile(code, filename, "exec"), namespace)
+    return namespace
+
+
+def _make_core(opt_level):
+    dmgr = dict()
+    dmgr["core"] = Core(dmgr, None, 1e-9, compile_workers=0,
+                        opt_level=opt_level)
+    return dmgr["core"]
+
+
+def _kernel_compiler(core, function, args, opt_level):
+    def compile_kernel(backend):
+        core.opt_level = opt_level
+        _, _, target, llvm_ir = core._generate(function, args, {})
+        if backend:
+            with profiler.stage("kernel/backend"):
+                _, library = _link_llvm_ir(target, llvm_ir)
+            return len(library)
+    return compile_kernel
+
+
+# Synthetic stress cases
+
+_quoted_list = """
+from artiq.language.core import *
+from artiq.language.types import *
+
+class Benchmark:
+    def __init__(self, core):
+        self.core = core
+        self.ints = list(range(10000))
+        self.floats = [i*0.5 for i in range(10000)]
+
+    @kernel
+    def run(self):
+        total = 0.
+        for i in range(len(self.ints)):
+            total += self.ints[i]*self.floats[i]
+"""
+
+_attribute_level = """
+class Level{level}:
+    def __init__(self):
+        self.next = Level{next}()
+{values}
+"""
+
+_attribute_graph = """
+from artiq.language.core import *
+from artiq.language.types import *
+{levels}
+class Level{depth}:
+    def __init__(self):
+        self.value = 1
+
+class Benchmark:
+    def __init__(self, core):
+        self.core = core
+        self.root = Level0()
+
+    @kernel
+    def run(self):
+        x = 0
+{accesses}
+"""
+
+_many_rpcs = """
+from artiq.language.core import *
+from artiq.language.types import *
+
+class Benchmark:
+    def __init__(self, core):
+        self.core = core
+{rpcs}
+    @kernel
+    def run(self):
+{calls}
+"""
+
+_many_kernels = """
+from artiq.language.core import *
+from artiq.language.types import *
+
+class Benchmark:
+    def __init__(self, core):
+        self.core = core
+{kernels}
+    @kernel
+    def run(self):
+        self.kernel0(0)
+"""
+
+
+def _synthetic(name, code):
+    def prepare(opt_level=2):
+        core = _make_core(opt_level)
+        namespace = _exec_source("<perf_suite {}>".format(name), code,
+                                 {"__name__": "testbench"})
+        experiment = namespace["Benchmark"](core)
+        return _kernel_compiler(core, type(experiment).run, (experiment,),
+                                opt_level)
+    return prepare
+
+
+def synthetic_cases():
+    depth = 40
+    attribute_graph = _attribute_graph.format(
+        levels="".join(_attribute_level.format(
+            level=level, next=level + 1,
+            values="".join("        self.value{} = {}\n".format(i, i)
+                           for i in range(8)))
+            for level in range(depth)),
+        depth=depth,
+        accesses="".join(
+            "        x += self.root{}.value{}\n".format(".next"*level, level % 8)
+            for level in range(depth)) +
+            "        x += self.root{}.value\n".format(".next"*depth))
+    many_rpcs = _many_rpcs.format(
+        rpcs="".join(
+            "    def rpc{0}(self, x: TInt32, y: TFloat) -> TInt32:\n"
+            "        return {0}\n".format(i) for i in range(300)),
+        calls="".join("        self.rpc{}({}, {}.0)\n".format(i, i, i)
+                      for i in range(300)))
+    many_kernels = _many_kernels.format(
+        kernels="".join(
+            "    @kernel\n"
+            "    def kernel{0}(self, x):\n"
+            "        return self.kernel{1}(x + {0})\n".format(i, i + 1)
+            for i in range(200)) +
+            "    @kernel\n"
+            "    def kernel200(self, x):\n"
+            "        return x\n")
+    return [
+        ("synthetic/quoted_list", _synthetic("quoted_list", _quoted_list)),
+        ("synthetic/attribute_graph",
+         _synthetic("attribute_graph", attribute_graph)),
+        ("synthetic/many_rpcs", _synthetic("many_rpcs", many_rpcs)),
+        ("synthetic/many_kernels", _synthetic("many_kernels", many_kernels)),
+    ]
+
+
+# Lit tests
+
+def _run_lines(filename):
+    with open(filename) as f:
+        return [line for line in f if line.startswith("# RUN:")]
+
+
+def _lit_embedding(filename):
+    def prepare(opt_level=2):
+        dmgr = DeviceManager(DeviceDB(
+            os.path.join(os.path.dirname(filename), "device_db.py")))
+        with tokenize.open(filename) as f:
+            namespace = {"__name__": "testbench", "dmgr": dmgr}
+            exec(compile(f.read(), f.name, "exec"), namespace)
+        return _kernel_compiler(dmgr.get("core"), namespace["entrypoint"], (),
+                                opt_level)
+    return prepare
+
+
+def _lit_module(filename):
+    def prepare(opt_level=2):
+        core = _make_core(opt_level)
+        with open(filename) as f:
+            code = f.read().replace("#ARTIQ#", "").expandtabs()
+        def compile_module(backend):
+            with profiler.stage("kernel"):
+                module = Module(Source.from_string(code, filename))
+                target = core.target_cls(opt_level=opt_level)
+                llvm_ir = target.generate_llvm_ir(module)
+            if backend:
+                with profiler.stage("kernel/backend"):
+                    _, library = _link_llvm_ir(target, llvm_ir)
+                return len(library)
+        return compile_module
+    return prepare
+
+
+def lit_cases():
+    lit_dir = os.path.join(artiq_dir, "test", "lit")
+    cases = []
+    for filename in sorted(glob.glob(os.path.join(lit_dir, "*", "*.py"))):
+        run_lines = _run_lines(filename)
+        name = "lit/" + os.path.relpath(filename, lit_dir)
+        if any("testbench.embedding" in line and "+diag" not in line
+               for line in run_lines):
+            cases.append((name, _lit_embedding(filename)))
+        elif any("testbench.jit" in line and "%not" not in line
+                 for line in run_lines):
+            cases.append((name, _lit_module(filename)))
+    return cases
+
+
+# Examples
+
+class _DummyScheduler:
+    rid = 0
+    pipeline_name = "main"
+    priority = 0
+    expid = None
+
+    def check_pause(self, rid=None):
+        return False
+
+
+def _example(device_db, filename, dataset_db):
+    def prepare(opt_level=2):
+        ddb = DeviceDB(device_db)
+        # compile for the core device of the example, without connecting
+        ddb.get("core", resolve_alias=True)["arguments"]["host"] = None
+        dmgr = DeviceManager(ddb, virtual_devices={
+            "scheduler": _DummyScheduler(), "ccb": None})
+        dataset_mgr = DatasetManager(dataset_db)
+        module = file_import(filename, prefix="artiq_perf_")
+        compilers = []
+        for name in sorted(dir(module)):
+            exp = getattr(module, name)
+            if not (is_experiment(exp) and
+                    hasattr(exp.run, "artiq_embedded")):
+                continue
+            exp_inst = exp((dmgr, dataset_mgr, ProcessArgumentManager({}), {}))
+            exp_inst.prepare()
+            core = getattr(exp_inst, exp.run.artiq_embedded.core_name)
+            compilers.append(_kernel_compiler(core, exp.run, (exp_inst,),
+                                              opt_level))
+        if not compilers:
+            return None
+        def compile_experiments(backend):
+            sizes = [compile_experiment(backend)
+                     for compile_experiment in compilers]
+            if backend:
+                return sum(sizes)
+        return compile_experiments
+    return prepare
+
+
+def example_cases(dataset_db):
+    examples_dir = os.path.join(artiq_dir, "examples")
+    cases = []
+    for device_db in sorted(glob.glob(os.path.join(examples_dir, "*", "device_db.py"))):
+        with open(device_db) as f:
+            if "artiq.coredevice.core" not in f.read():
+                continue
+        example_dir = os.path.dirname(device_db)
+        filenames = sorted(glob.glob(os.path.join(example_dir, "*.py")) +
+                           glob.glob(os.path.join(example_dir, "repository", "*.py")))
+        for filename in filenames:
+            if filename == device_db:
+                continue
+            cases.append(("examples/" + os.path.relpath(filename, examples_dir),
+                          _example(device_db, filename, dataset_db)))
+    return cases
+
+
+# Measurement and history
+
+def measure(compile_case, runs, backend):
+    """Compiles a case ``runs`` times, and returns the minimum total time
+    and the minimum time of each phase, in seconds, and the size of the
+    linked kernels in bytes if ``compile_case`` returns it."""
+    size = None
+    totals = []
+    phases = defaultdict(list)
+    for _ in range(runs):
+        p = profiler.Profiler(trace_memory=False)
+        t0 = time.perf_counter()
+        with profiler.activate(p):
+            size = compile_case(backend)
+        totals.append(time.perf_counter() - t0)
+        run_phases = defaultdict(float)
+        for stage in p.stages:
+            # the phases of all kernels and iterations are added up
+            _, _, phase = stage["name"].partition("/")
+            run_phases[phase or "frontend"] += stage["time"]
+        for phase, duration in run_phases.items():
+            phases[phase].append(duration)
+    result = {
+        "total": min(totals),
+        "phases": {phase: min(durations) for phase, durations in sorted(phases.items())}
+    }
+    if size is not None:
+        result["size"] = size
+    return result
+
+
+def host_id():
+    return "{} {} {}".format(platform.node(), platform.machine(),
+                             platform.python_version())
+
+
+def load_history(filename):
+    try:
+        with open(filename) as f:
+            history = json.load(f)
+    except FileNotFoundError:
+        return {"version": HISTORY_VERSION, "runs": []}
+    if history.get("version") != HISTORY_VERSION:
+        raise ValueError("unsupported history version in {}".format(filename))
+    return history
+
+
+def save_history(filename, history):
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(filename)),
+                                     suffix=".tmp", delete=False) as f:
+        json.dump(history, f, indent=1)
+        tmpname = f.name
+    os.replace(tmpname, filename)
+
+
+def find_regressions(history, run, threshold=0.2, min_delta=0.005, window=5):
+    """Compares the results of ``run`` with the median of the last
+    ``window`` runs of ``history`` on the same host.
+
+    A case or phase is a regression if it is slower than the median by
+    more than ``threshold`` (relative) and ``min_delta`` seconds.
+    Returns a list of ``(case, phase, median, time)`` tuples, where phase is
+    ``"total"`` for the whole case."""
+    previous_runs = [r for r in history["runs"]
+                     if r["host"] == run["host"] and r["backend"] == run["backend"]
+                     and r.get("opt_level", 2) == run.get("opt_level", 2)]
+    previous_runs = previous_runs[-window:]
+    regressions = []
+    for case, result in sorted(run["results"].items()):
+        previous = [r["results"][case] for r in previous_runs
+                    if case in r["results"]]
+        if not previous:
+            continue
+        measurements = [("total", result["total"],
+                         [p["total"] for p in previous])]
+        for phase, duration in result["phases"].items():
+            measurements.append((phase, duration,
+                                 [p["phases"][phase] for p in previous
+                                  if phase in p["phases"]]))
+        for phase, duration, values in measurements:
+            if not values:
+                continue
+            median = statistics.median(values)
+            if duration > median*(1 + threshold) and duration - median > min_delta:
+                regressions.append((case, phase, median, duration))
+    return regressions
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description="ARTIQ compile-time benchmark suite")
+    parser.add_argument("--history", default=None,
+                        help="JSON file where the results are appended and "
+                             "compared with previous runs")
+    parser.add_argument("-k", "--cases", default=None,
+                        help="only run the cases whose name matches this "
+                             "shell pattern, e.g. 'synthetic/*'")
+    parser.add_argument("-n", "--runs", default=3, type=int,
+                        help="number of compilations of each case, of which "
+                             "the fastest is kept (default: %(default)s)")
+    parser.add_argument("--frontend-only", default=False, action="store_true",
+                        help="do not optimize, assemble and link the kernels")
+    parser.add_argument("-O", "--opt-level", default=2, type=int,
+                        choices=OPT_LEVELS,
+                        help="optimization level of the kernels "
+                             "(default: %(default)s)")
+    parser.add_argument("--threshold", default=0.2, type=float,
+                        help="relative slowdown reported as a regression "
+                             "(default: %(default)s)")
+    parser.add_argument("--min-delta", default=0.005, type=float,
+                        help="minimum slowdown in seconds reported as a "
+                             "regression (default: %(default)s)")
+    parser.add_argument("--window", default=5, type=int,
+                        help="number of previous runs the results are "
+                             "compared with (default: %(default)s)")
+    parser.add_argument("--no-save", default=False, action="store_true",
+                        help="do not append the results to the history")
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+    # offline and reproducible: never reuse compiled kernels
+    os.environ["ARTIQ_KERNEL_CACHE"] = ""
+    backend = not args.frontend_only
+
+    with tempfile.TemporaryDirectory() as dataset_dir:
+        dataset_db = DatasetDB(os.path.join(dataset_dir, "dataset_db.mdb"))
+        cases = synthetic_cases() + lit_cases() + example_cases(dataset_db)
+        if args.cases is not None:
+            cases = [(name, prepare) for name, prepare in cases
+                     if fnmatch.fnmatch(name, args.cases)]
+
+        results = dict()
+        skipped = dict()
+        for name, prepare in cases:
+            try:
+                compile_case = prepare(args.opt_level)
+                if compile_case is None:
+                    continue
+                results[name] = measure(compile_case, args.runs, backend)
+            except Exception as error:
+                message = str(error).strip().split("\n")[0]
+                skipped[name] = "{}: {}".format(type(error).__name__, message)
+                continue
+            result = results[name]
+            print("{:<60} {:>9.1f} ms  (frontend {:.1f} ms, backend {:.1f} ms{})".format(
+                name, result["total"]*1e3,
+                result["phases"].get("frontend", 0.)*1e3,
+                result["phases"].get("backend", 0.)*1e3,
+                ", {} bytes".format(result["size"]) if "size" in result else ""))
+        dataset_db.close_db()
+
+    for name, reason in sorted(skipped.items()):
+        print("skipped {}: {}".format(name, reason))
+
+    run = {
+        "time": time.time(),
+        "artiq_version": artiq_version,
+        "host": host_id(),
+        "backend": backend,
+        "opt_level": args.opt_level,
+        "runs": args.runs,
+        "results": results
+    }
+
+    regressions = []
+    if args.history is not None:
+        history = load_history(args.history)
+        regressions = find_regressions(history, run, args.threshold,
+                                       args.min_delta, args.window)
+        if not args.no_save:
+            history["runs"].append(run)
+            save_history(args.history, history)
+
+    for case, phase, median, duration in regressions:
+        print("REGRESSION {} [{}]: {:.1f} ms -> {:.1f} ms (+{:.0f}%)".format(
+            case, phase, median*1e3, duration*1e3, (duration/median - 1)*100))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,3 +26,14 @@ class IntMonomorphizer(algorithm.Visitor):
                     return
 
                 node.type["width"].unify(types.TValue(width))
+
+    def visit_QuoteT(self, node):
+        # Large lists of integers are quoted as a whole; see ASTSynthesizer.quote.
+        if builtins.is_list(node.type):
+            elt_type = builtins.get_iterable_elt(node.type)
+            if builtins.is_int(elt_type) and types.is_var(elt_type["width"]):
+                if -2**31 < node.value.min() and node.value.max() < 2**31-1:
+                    width = 32
+                else:
+                    width = 64
+                elt_type["width"].unify(types.TValue(width))
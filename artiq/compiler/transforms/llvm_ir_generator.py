@@ -1835,21 +1835,11 @@ class LLVMIRGenerator:
 
     def _quote_listish_to_llglobal(self, value, elt_type, path, kind_name):
         fail_msg = "at " + ".".join(path())
-        if len(value) > 0:
-            if builtins.is_int(elt_type):
-                int_typ = (int, numpy.int32, numpy.int64)
-                for v in value:
-                    assert isinstance(v, int_typ), fail_msg
-                llty = self.llty_of_type(elt_type)
-                llelts = [ll.Constant(llty, int(v)) for v in value]
-            elif builtins.is_float(elt_type):
-                for v in value:
-                    assert isinstance(v, float), fail_msg
-                llty = self.llty_of_type(elt_type)
-                llelts = [ll.Constant(llty, v) for v in value]
-            else:
-                llelts = [self._quote(value[i], elt_type, lambda: path() + [str(i)])
-                          for i in range(len(value))]
+        if len(value) > 0 and (builtins.is_int(elt_type) or builtins.is_float(elt_type)):
+            return self._quote_numbers_to_llglobal(value, elt_type, fail_msg, kind_name)
+        elif len(value) > 0:
+            llelts = [self._quote(value[i], elt_type, lambda: path() + [str(i)])
+                      for i in range(len(value))]
         else:
             llelts = []
         lleltsary = ll.Constant(ll.ArrayType(self.llty_of_type(elt_type), len(llelts)),
@@ -1860,6 +1850,38 @@ class LLVMIRGenerator:
         llglobal.linkage = "private"
         return llglobal.bitcast(lleltsary.type.element.as_pointer())
 
+    def _quote_numbers_to_llglobal(self, value, elt_type, fail_msg, kind_name):
+        # Emit the elements as a single blob of bytes in the memory layout
+        # of the target, which is much faster than building a constant for
+        # every element when quoting large tables.
+        llty = self.llty_of_type(elt_type)
+        size, align = self.abi_layout_info.get_size_align(llty)
+        byteorder = ">" if "E" in self.llmodule.data_layout.split("-") else "<"
+        if builtins.is_int(elt_type):
+            if isinstance(value, numpy.ndarray):
+                assert value.dtype.kind == "i", fail_msg
+            else:
+                int_typ = (int, numpy.int32, numpy.int64)
+                for v in value:
+                    assert isinstance(v, int_typ), fail_msg
+            dtype = numpy.dtype("{}i{}".format(byteorder, size))
+        else:
+            if isinstance(value, numpy.ndarray):
+                assert value.dtype.kind == "f", fail_msg
+            else:
+                for v in value:
+                    assert isinstance(v, float), fail_msg
+            dtype = numpy.dtype("{}f{}".format(byteorder, size))
+        data = numpy.asarray(value).astype(dtype, casting="same_kind").tobytes()
+
+        lldata = ll.Constant(ll.ArrayType(lli8, len(data)), bytearray(data))
+        name = self.llmodule.scope.deduplicate("quoted.{}".format(kind_name))
+        llglobal = ll.GlobalVariable(self.llmodule, lldata.type, name)
+        llglobal.initializer = lldata
+        llglobal.linkage = "private"
+        llglobal.align = align
+        return llglobal.bitcast(llty.as_pointer())
+
     def _quote_attributes(self, value, typ, path, value_id, llty):
         llglobal = None
         llfields = []
@@ -1,11 +1,18 @@
+import os
+import json
 import struct
 import logging
 import traceback
 import numpy
 import socket
+import queue
+import threading
+import time
 from enum import Enum
 from fractions import Fraction
 from collections import namedtuple
+from operator import itemgetter
+from itertools import repeat
 
 from artiq.coredevice import exceptions
 from artiq import __version__ as software_version
@@ -56,6 +63,36 @@ class RPCReturnValueError(ValueError):
 RPCKeyword = namedtuple('RPCKeyword', ['name', 'value'])
 
 
+_element_names = {"b": "bool", "i": "32-bit int", "I": "64-bit int", "f": "float"}
+
+
+def _elements_to_array(tag, values, endian):
+    """Converts a list or array of values to an array in the wire format of
+    the primitive RPC tag ``tag`` (see :data:`_element_names`), with one
+    check of the type and range of all the values. Returns None if a value
+    cannot be serialized."""
+    try:
+        array = numpy.asarray(values)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    kind = array.dtype.kind
+    if tag == "b":
+        dtype = numpy.dtype("?")
+        valid = kind == "b"
+    elif tag == "f":
+        dtype = numpy.dtype(endian + "f8")
+        valid = kind in "biuf"
+    else:
+        dtype = numpy.dtype(endian + ("i4" if tag == "i" else "i8"))
+        valid = kind in "biu"
+        if valid and kind != "b" and array.size:
+            info = numpy.iinfo(dtype)
+            valid = info.min <= array.min() and array.max() <= info.max
+    if not valid and array.size:
+        return None
+    return array.astype(dtype, copy=False)
+
+
 def _receive_fraction(kernel, embedding_map):
     numerator = kernel._read_int64()
     denominator = kernel._read_int64()
@@ -65,17 +102,19 @@ def _receive_fraction(kernel, embedding_map):
 def _receive_list(kernel, embedding_map):
     length = kernel._read_int32()
     tag = chr(kernel._read_int8())
+    # the elements are converted before the next read, so they can be
+    # parsed in place
     if tag == "b":
-        buffer = kernel._read(length)
+        buffer = kernel._read_view(length)
         return list(struct.unpack(kernel.endian + "%s?" % length, buffer))
     elif tag == "i":
-        buffer = kernel._read(4 * length)
+        buffer = kernel._read_view(4 * length)
         return list(struct.unpack(kernel.endian + "%sl" % length, buffer))
     elif tag == "I":
-        buffer = kernel._read(8 * length)
+        buffer = kernel._read_view(8 * length)
         return list(numpy.ndarray((length, ), kernel.endian + 'i8', buffer))
     elif tag == "f":
-        buffer = kernel._read(8 * length)
+        buffer = kernel._read_view(8 * length)
         return list(struct.unpack(kernel.endian + "%sd" % length, buffer))
     else:
         fn = receivers[tag]
@@ -171,6 +210,182 @@ class CommKernelDummy:
     def check_system_info(self):
         pass
 
+    def close(self):
+        pass
+
+
+class AsyncRPCExecutor:
+    """Runs the async RPCs of kernels in a worker thread, one at a time and
+    in the order in which the kernel made them, so that the host keeps
+    reading from the core device while a slow async RPC runs.
+
+    :param queue_size: number of async RPCs that can wait for the worker.
+        When the queue is full, the host stops reading from the core device
+        until an RPC completes.
+    """
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.error = None
+        self.cancelled = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = 0
+        self.max_depth = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+
+    def stats(self):
+        """Returns the number of async RPCs completed since the last
+        :meth:`reset_stats`, the maximum number of RPCs that were queued or
+        running at once, and the mean and maximum time from the arrival of
+        an RPC to its completion, in seconds."""
+        return {
+            "calls": self.calls,
+            "max_depth": self.max_depth,
+            "mean_latency": self.total_latency/self.calls if self.calls else 0.,
+            "max_latency": self.max_latency,
+        }
+
+    def submit(self, service, args, kwargs):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="async_rpc",
+                                           daemon=True)
+            self.thread.start()
+        self.queue.put((time.monotonic(), service, args, kwargs))
+        self.max_depth = max(self.max_depth, self.queue.unfinished_tasks)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            arrival, service, args, kwargs = item
+            try:
+                # after a failure, the remaining RPCs are dropped, as the
+                # kernel would have been stopped if they were run inline
+                if self.error is None and not self.cancelled:
+                    service(*args, **kwargs)
+                    latency = time.monotonic() - arrival
+                    self.calls += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """Waits for the completion of all the submitted RPCs, and raises
+        the exception of the first one that failed since the last call."""
+        self.queue.join()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def cancel(self):
+        """Drops the RPCs that are still queued, waits for the completion of
+        the running one and discards any error, so that nothing from an
+        abandoned kernel runs or is raised during the next one."""
+        self.cancelled = True
+        try:
+            self.queue.join()
+        finally:
+            self.cancelled = False
+            self.error = None
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def _service_name(service_id, service):
+    if service_id == 0:
+        return "setattr"
+    return getattr(service, "__qualname__", None) or repr(service)
+
+
+class RPCProfiler:
+    """Records the RPCs served by :class:`CommKernel` during a kernel run:
+    for each service, the number of calls, the time spent in its host
+    handler and the bytes received and sent, as well as the timeline of the
+    calls."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.services = {}
+            self.events = []
+            self.origin = time.perf_counter()
+            self.end = None
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def record(self, service_id, service, is_async, start, end, received, sent):
+        name = _service_name(service_id, service)
+        with self.lock:
+            entry = self.services.get((service_id, name))
+            if entry is None:
+                entry = self.services[(service_id, name)] = {
+                    "service_id": service_id,
+                    "name": name,
+                    "calls": 0,
+                    "async_calls": 0,
+                    "time": 0.,
+                    "bytes_received": 0,
+                    "bytes_sent": 0,
+                }
+            entry["calls"] += 1
+            entry["async_calls"] += is_async
+            entry["time"] += end - start
+            entry["bytes_received"] += received
+            entry["bytes_sent"] += sent
+            self.events.append((name, is_async, start, end, received, sent,
+                                threading.get_ident()))
+
+    def stats(self):
+        """Returns a dictionary for each service, with its ``service_id``
+        and ``name``, the number of ``calls`` and ``async_calls``, the
+        ``time`` spent in its handler in seconds, and the
+        ``bytes_received`` (arguments) and ``bytes_sent`` (replies), sorted
+        by decreasing time."""
+        with self.lock:
+            entries = [dict(entry) for entry in self.services.values()]
+        return sorted(entries, key=lambda entry: entry["time"], reverse=True)
+
+    def chrome_trace(self):
+        """Returns the timeline of the kernel run in the Chrome trace event
+        format, which can be viewed with Perfetto or ``chrome://tracing``."""
+        pid = os.getpid()
+        def event(name, category, start, end, tid, args):
+            return {"name": name, "cat": category, "ph": "X", "pid": pid,
+                    "tid": tid, "ts": (start - self.origin)*1e6,
+                    "dur": (end - start)*1e6, "args": args}
+
+        with self.lock:
+            events = [event(name, "async_rpc" if is_async else "rpc",
+                             start, end, tid,
+                             {"bytes_received": received, "bytes_sent": sent})
+                      for name, is_async, start, end, received, sent, tid
+                      in self.events]
+        if self.end is not None:
+            events.insert(0, event("kernel", "kernel", self.origin, self.end,
+                                   threading.get_ident(), {}))
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
 
 def incompatible_versions(v1, v2):
     if v1.endswith(".beta") or v2.endswith(".beta"):
@@ -185,11 +400,24 @@ def incompatible_versions(v1, v2):
 class CommKernel:
     warned_of_mismatch = False
 
-    def __init__(self, host, port=1381):
+    #: Size of the window in which small reads are buffered, in bytes.
+    read_buffer_size = 65536
+
+    def __init__(self, host, port=1381, async_rpc_queue=0, profile_rpc=False):
         self._read_type = None
         self.host = host
         self.port = port
-        self.read_buffer = bytearray()
+        self.async_rpc_executor = None
+        if async_rpc_queue:
+            self.async_rpc_executor = AsyncRPCExecutor(async_rpc_queue)
+        self.rpc_profiler = RPCProfiler() if profile_rpc else None
+        # total numbers of bytes received from and sent to the device
+        self.received_bytes = 0
+        self.sent_bytes = 0
+        self.read_buffer = bytearray(self.read_buffer_size)
+        self.read_view = memoryview(self.read_buffer)
+        # the received data not read yet is read_buffer[read_start:read_end]
+        self.read_start = self.read_end = 0
         self.write_buffer = bytearray()
 
 
@@ -200,11 +428,14 @@ class CommKernel:
         self.socket.sendall(b"ARTIQ coredev\n")
         endian = self._read(1)
         if endian == b"e":
-            self.endian = "<"
+            self._set_endian("<")
         elif endian == b"E":
-            self.endian = ">"
+            self._set_endian(">")
         else:
             raise IOError("Incorrect reply from device: expected e/E.")
+
+    def _set_endian(self, endian):
+        self.endian = endian
         self.unpack_int32 = struct.Struct(self.endian + "l").unpack
         self.unpack_int64 = struct.Struct(self.endian + "q").unpack
         self.unpack_float64 = struct.Struct(self.endian + "d").unpack
@@ -216,31 +447,66 @@ class CommKernel:
         self.pack_float64 = struct.Struct(self.endian + "d").pack
 
     def close(self):
+        if self.async_rpc_executor is not None:
+            self.async_rpc_executor.close()
         if not hasattr(self, "socket"):
             return
         self.socket.close()
         del self.socket
+        self.read_start = self.read_end = 0
         logger.debug("disconnected")
 
     #
     # Reader interface
     #
 
+    def _recv_into(self, view, flags=0):
+        received = self.socket.recv_into(view, len(view), flags)
+        if not received:
+            raise ConnectionResetError("Core device connection closed unexpectedly")
+        self.received_bytes += received
+        return received
+
+    def _read_position(self):
+        """Returns the number of bytes read from the device."""
+        return self.received_bytes - (self.read_end - self.read_start)
+
+    def _read_view(self, length):
+        """Returns a view of the next ``length`` bytes, which is only valid
+        until the next read."""
+        if length > self.read_buffer_size // 2:
+            return memoryview(self._read(length))
+        if self.read_end - self.read_start < length:
+            # cache the reads to avoid frequent call to recv
+            if self.read_start + length > self.read_buffer_size:
+                # move the data not read yet to the start of the buffer
+                available = self.read_end - self.read_start
+                self.read_view[:available] = self.read_view[self.read_start:self.read_end]
+                self.read_start, self.read_end = 0, available
+            while self.read_end - self.read_start < length:
+                self.read_end += self._recv_into(self.read_view[self.read_end:])
+        start = self.read_start
+        self.read_start += length
+        if self.read_start == self.read_end:
+            self.read_start = self.read_end = 0
+        return self.read_view[start:start + length]
+
     def _read(self, length):
-        # cache the reads to avoid frequent call to recv
-        while len(self.read_buffer) < length:
-            # the number is just the maximum amount
-            # when there is not much data, it would return earlier
-            diff = length - len(self.read_buffer)
-            flag = 0
-            if diff > 8192:
-                flag |= socket.MSG_WAITALL
-            new_buffer = self.socket.recv(8192, flag)
-            if not new_buffer:
-                raise ConnectionResetError("Core device connection closed unexpectedly")
-            self.read_buffer += new_buffer
-        result = self.read_buffer[:length]
-        self.read_buffer = self.read_buffer[length:]
+        """Returns the next ``length`` bytes as a new :class:`bytearray`.
+
+        Large reads are received directly into the result, without going
+        through the read buffer."""
+        if length <= self.read_buffer_size // 2:
+            return bytearray(self._read_view(length))
+        result = bytearray(length)
+        view = memoryview(result)
+        received = min(length, self.read_end - self.read_start)
+        view[:received] = self.read_view[self.read_start:self.read_start + received]
+        self.read_start += received
+        if self.read_start == self.read_end:
+            self.read_start = self.read_end = 0
+        while received < length:
+            received += self._recv_into(view[received:], socket.MSG_WAITALL)
         return result
 
     def _read_header(self):
@@ -249,14 +515,14 @@ class CommKernel:
         # Wait for a synchronization sequence, 5a 5a 5a 5a.
         sync_count = 0
         while sync_count < 4:
-            sync_byte = self._read(1)[0]
+            sync_byte = self._read_view(1)[0]
             if sync_byte == 0x5a:
                 sync_count += 1
             else:
                 sync_count = 0
 
         # Read message header.
-        raw_type = self._read(1)[0]
+        raw_type = self._read_view(1)[0]
         self._read_type = Reply(raw_type)
 
         logger.debug("receiving message: type=%r",
@@ -272,18 +538,18 @@ class CommKernel:
         self._read_expect(ty)
 
     def _read_int8(self):
-        return self._read(1)[0]
+        return self._read_view(1)[0]
 
     def _read_int32(self):
-        (value, ) = self.unpack_int32(self._read(4))
+        (value, ) = self.unpack_int32(self._read_view(4))
         return value
 
     def _read_int64(self):
-        (value, ) = self.unpack_int64(self._read(8))
+        (value, ) = self.unpack_int64(self._read_view(8))
         return value
 
     def _read_float64(self):
-        (value, ) = self.unpack_float64(self._read(8))
+        (value, ) = self.unpack_float64(self._read_view(8))
         return value
 
     def _read_bool(self):
@@ -293,7 +559,7 @@ class CommKernel:
         return self._read(self._read_int32())
 
     def _read_string(self):
-        return self._read_bytes().decode("utf-8")
+        return str(self._read_view(self._read_int32()), "utf-8")
 
     #
     # Writer interface
@@ -308,6 +574,7 @@ class CommKernel:
 
     def _flush(self):
         self.socket.sendall(self.write_buffer)
+        self.sent_bytes += len(self.write_buffer)
         self.write_buffer.clear()
 
     def _write_header(self, ty):
@@ -501,25 +768,32 @@ class CommKernel:
                   lambda: "list")
             self._write_int32(len(value))
             tag_element = chr(tags[0])
-            if tag_element == "b":
-                self._write(bytes(value))
-            elif tag_element == "i":
-                try:
-                    self._write(struct.pack(self.endian + "%sl" % len(value), *value))
-                except struct.error:
-                    raise RPCReturnValueError(
-                        "type mismatch: cannot serialize {value} as {type}".format(
-                            value=repr(value), type="32-bit integer list"))
-            elif tag_element == "I":
-                try:
-                    self._write(struct.pack(self.endian + "%sq" % len(value), *value))
-                except struct.error:
-                    raise RPCReturnValueError(
-                        "type mismatch: cannot serialize {value} as {type}".format(
-                            value=repr(value), type="64-bit integer list"))
-            elif tag_element == "f":
-                self._write(struct.pack(self.endian + "%sd" %
-                                        len(value), *value))
+            if tag_element in _element_names:
+                array = _elements_to_array(tag_element, value, self.endian)
+                check(array is not None and array.ndim == 1,
+                      lambda: "list of {}".format(_element_names[tag_element]))
+                self._write(array.tobytes())
+            elif tag_element == "t" and \
+                    all(chr(field) in _element_names for field in tags[2:2 + tags[1]]):
+                # tuples of primitive values are sent as a structured array
+                field_tags = [chr(field) for field in tags[2:2 + tags[1]]]
+                check(all(map(isinstance, value, repeat(tuple))) and
+                      set(map(len, value)) <= {len(field_tags)},
+                      lambda: "list of tuples of {}".format(len(field_tags)))
+                fields = [_elements_to_array(field_tag,
+                                             list(map(itemgetter(index), value)),
+                                             self.endian)
+                          for index, field_tag in enumerate(field_tags)]
+                check(all(field is not None and field.ndim == 1
+                          for field in fields),
+                      lambda: "list of tuples of ({})".format(
+                          ", ".join(_element_names[field_tag]
+                                    for field_tag in field_tags)))
+                array = numpy.empty(len(value), [("f{}".format(index), field.dtype)
+                                                 for index, field in enumerate(fields)])
+                for index, field in enumerate(fields):
+                    array["f{}".format(index)] = field
+                self._write(array.tobytes())
             else:
                 for elt in value:
                     tags_copy = bytearray(tags)
@@ -534,20 +808,11 @@ class CommKernel:
             for s in value.shape:
                 self._write_int32(s)
             tag_element = chr(tags[0])
-            if tag_element == "b":
-                self._write(value.reshape((-1,), order="C").tobytes())
-            elif tag_element == "i":
-                array = value.reshape(
-                    (-1,), order="C").astype(self.endian + 'i4')
-                self._write(array.tobytes())
-            elif tag_element == "I":
-                array = value.reshape(
-                    (-1,), order="C").astype(self.endian + 'i8')
-                self._write(array.tobytes())
-            elif tag_element == "f":
-                array = value.reshape(
-                    (-1,), order="C").astype(self.endian + 'd')
-                self._write(array.tobytes())
+            if tag_element in _element_names:
+                array = _elements_to_array(tag_element, value, self.endian)
+                check(array is not None,
+                      lambda: "numpy.ndarray of {}".format(_element_names[tag_element]))
+                self._write(array.tobytes(order="C"))
             else:
                 for elt in value.reshape((-1,), order="C"):
                     tags_copy = bytearray(tags)
@@ -572,7 +837,18 @@ class CommKernel:
         else:
             return msg
 
+    def _profiled(self, service_id, service, received):
+        def run(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                service(*args, **kwargs)
+            finally:
+                self.rpc_profiler.record(service_id, service, True, start,
+                                         time.perf_counter(), received, 0)
+        return run
+
     def _serve_rpc(self, embedding_map):
+        received = self._read_position()
         is_async = self._read_bool()
         service_id = self._read_int32()
         args, kwargs = self._receive_rpc_args(embedding_map)
@@ -585,15 +861,30 @@ class CommKernel:
         logger.debug("rpc service: [%d]%r%s %r %r -> %s", service_id, service,
                      (" (async)" if is_async else ""), args, kwargs, return_tags)
 
+        profiler = self.rpc_profiler
+        if profiler is not None:
+            received = self._read_position() - received
+            sent = self.sent_bytes
+            if is_async:
+                service = self._profiled(service_id, service, received)
+
         if is_async:
-            service(*args, **kwargs)
+            # the arguments are not views of the read buffer, so they can
+            # be used after the next read
+            if self.async_rpc_executor is None:
+                service(*args, **kwargs)
+            else:
+                self.async_rpc_executor.submit(service, args, kwargs)
             return
 
+        self._wait_async_rpcs()
+        start = time.perf_counter()
         try:
             result = service(*args, **kwargs)
         except RPCReturnValueError as exn:
             raise
         except Exception as exn:
+            end = time.perf_counter()
             logger.debug("rpc service: %d %r %r ! %r",
                          service_id, args, kwargs, exn)
 
@@ -642,6 +933,7 @@ class CommKernel:
                 self._write_int32(embedding_map.store_str(function))
             self._flush()
         else:
+            end = time.perf_counter()
             logger.debug("rpc service: %d %r %r = %r",
                          service_id, args, kwargs, result)
             self._write_header(Request.RPCReply)
@@ -649,6 +941,9 @@ class CommKernel:
             self._send_rpc_value(bytearray(return_tags),
                                  result, result, service)
             self._flush()
+        if profiler is not None:
+            profiler.record(service_id, service, False, start, end, received,
+                            self.sent_bytes - sent)
 
     def _serve_exception(self, embedding_map, symbolizer, demangler):
         exception_count = self._read_int32()
@@ -660,7 +955,7 @@ class CommKernel:
             if length == -1:
                 return embedding_map.retrieve_str(self._read_int32())
             else:
-                return self._read(length).decode("utf-8")
+                return str(self._read_view(length), "utf-8")
 
         for _ in range(exception_count):
             name = embedding_map.retrieve_str(self._read_int32())
@@ -723,16 +1018,51 @@ class CommKernel:
             logger.warning(f"{(', '.join(errors[:-1]) + ' and ') if len(errors) > 1 else ''}{errors[-1]} "
                            f"reported during kernel execution")
 
+    def _wait_async_rpcs(self):
+        if self.async_rpc_executor is not None:
+            self.async_rpc_executor.wait()
+
+    def async_rpc_stats(self):
+        """Returns the statistics of :meth:`AsyncRPCExecutor.stats` for the
+        async RPCs of the last kernel, or None if they are run inline."""
+        if self.async_rpc_executor is None:
+            return None
+        return self.async_rpc_executor.stats()
+
+    def rpc_stats(self):
+        """Returns the statistics of :meth:`RPCProfiler.stats` for the RPCs
+        of the last kernel, or an empty list if profiling is disabled."""
+        if self.rpc_profiler is None:
+            return []
+        return self.rpc_profiler.stats()
+
     def serve(self, embedding_map, symbolizer, demangler):
-        while True:
-            self._read_header()
-            if self._read_type == Reply.RPCRequest:
-                self._serve_rpc(embedding_map)
-            elif self._read_type == Reply.KernelException:
-                self._serve_exception(embedding_map, symbolizer, demangler)
-            elif self._read_type == Reply.ClockFailure:
-                raise exceptions.ClockFailure
-            else:
-                self._read_expect(Reply.KernelFinished)
-                self._process_async_error()
-                return
+        if self.async_rpc_executor is not None:
+            self.async_rpc_executor.reset_stats()
+        if self.rpc_profiler is not None:
+            self.rpc_profiler.reset()
+        try:
+            while True:
+                self._read_header()
+                if self._read_type == Reply.RPCRequest:
+                    self._serve_rpc(embedding_map)
+                    continue
+                # the async RPCs complete before the kernel ends
+                self._wait_async_rpcs()
+                if self._read_type == Reply.KernelException:
+                    self._serve_exception(embedding_map, symbolizer, demangler)
+                elif self._read_type == Reply.ClockFailure:
+                    raise exceptions.ClockFailure
+                else:
+                    self._read_expect(Reply.KernelFinished)
+                    self._process_async_error()
+                    if self.async_rpc_executor is not None:
+                        logger.debug("async RPCs: %r", self.async_rpc_stats())
+                    if self.rpc_profiler is not None:
+                        self.rpc_profiler.finish()
+                    return
+        except:
+            # the kernel is abandoned, its queued async RPCs must not outlive it
+            if self.async_rpc_executor is not None:
+                self.async_rpc_executor.cancel()
+            raise
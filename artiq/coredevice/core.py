@@ -1,7 +1,12 @@
 import os, sys
+import json
+import logging
 import numpy
 from inspect import getfullargspec
 from functools import wraps
+from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from pythonparser import diagnostic
 
@@ -13,13 +18,35 @@ from artiq.language.units import *
 
 from artiq.compiler.module import Module
 from artiq.compiler.embedding import Stitcher
-from artiq.compiler.targets import RV32IMATarget, RV32GTarget, CortexA9Target
+from artiq.compiler.targets import RV32IMATarget, RV32GTarget, CortexA9Target, OPT_LEVELS
+from artiq.compiler.kernel_cache import KernelCache, default_cache_dir
+from artiq.compiler import profiler as compiler_profiler
 
 from artiq.coredevice.comm_kernel import CommKernel, CommKernelDummy
 # Import for side effects (creating the exception classes).
 from artiq.coredevice import exceptions
 
 
+logger = logging.getLogger(__name__)
+
+
+def _link_llvm_ir(target, llvm_ir):
+    library = target.link([target.assemble(target.compile(None, llvm_ir))])
+    return library, target.strip(library)
+
+
+def _compile_llvm_ir(target_cls, subkernel_id, opt_level, llvm_ir, profile_name=None):
+    # Runs in the processes of the compilation pool. The stages recorded
+    # when profiling are returned to the profiler of the caller.
+    target = target_cls(subkernel_id=subkernel_id, opt_level=opt_level)
+    if profile_name is None:
+        return _link_llvm_ir(target, llvm_ir), []
+    profiler = compiler_profiler.Profiler()
+    with compiler_profiler.activate(profiler), profiler.stage(profile_name):
+        result = _link_llvm_ir(target, llvm_ir)
+    return result, profiler.stages
+
+
 def _render_diagnostic(diagnostic, colored):
     def shorten_path(path):
         return path.replace(artiq_dir, "<artiq>")
@@ -78,6 +105,38 @@ class Core:
     :param ref_multiplier: ratio between the RTIO fine timestamp frequency
         and the RTIO coarse timestamp frequency (e.g. SERDES multiplication
         factor).
+    :param kernel_cache: whether to keep compiled kernels on disk and reuse
+        them when the same code is compiled again (disabled by default). The
+        cache is stored in the directory given by the ``ARTIQ_KERNEL_CACHE``
+        environment variable (by default ``~/.cache/artiq/kernels``); an
+        empty value disables it.
+    :param kernel_cache_size: maximum size of the kernel cache in bytes.
+    :param compile_workers: number of processes compiling kernels that use
+        subkernels, which are then compiled in parallel with the main kernel,
+        or None for the number of CPUs. The processes are started when the
+        first such kernel is compiled and stopped when the device is closed,
+        i.e. at the end of each experiment run by the master, so that this
+        only pays off for kernels with many large subkernels. The default, 0,
+        compiles them one after another in the current process.
+    :param profile_compiler: whether to record the time and memory used by
+        each stage of the compiler, in reports returned by
+        :meth:`get_compiler_profiles`. If a string is given, the reports of
+        each experiment are also archived by the master in a dataset with
+        this name. Reports are also appended, as JSON lines, to the file
+        given by the ``ARTIQ_PROFILE_COMPILER`` environment variable if it
+        is set (or printed to the standard error if it is empty).
+    :param opt_level: optimization level of the kernels, from 0 (fastest
+        compilation, e.g. for kernels that run once during development) to
+        2 (fastest code, the default). It can be overridden for a kernel
+        with the ``opt0``, ``opt1`` or ``opt2`` flag.
+    :param async_rpc_queue: if not 0, async RPCs are run in a worker thread
+        while the host keeps serving the kernel, and this is the number of
+        them that can be queued. They still run one at a time in the order
+        of the kernel, and complete before the next synchronous RPC and the
+        end of the kernel. By default, they are run before the host reads
+        the next message from the core device.
+    :param profile_rpc: whether to record the RPCs served during each kernel
+        run, for :meth:`rpc_stats` and :meth:`dump_rpc_trace`.
     """
 
     kernel_invariants = {
@@ -85,7 +144,13 @@ class Core:
     }
 
     def __init__(self, dmgr, host, ref_period, ref_multiplier=8, 
-                 target="rv32g", satellite_cpu_targets={}):
+                 target="rv32g", satellite_cpu_targets={},
+                 kernel_cache=False, kernel_cache_size=256*1024*1024,
+                 compile_workers=0, profile_compiler=False, opt_level=2,
+                 async_rpc_queue=0, profile_rpc=False):
+        if opt_level not in OPT_LEVELS:
+            raise ValueError("invalid optimization level {}, expected one of {}"
+                             .format(opt_level, ", ".join(map(str, OPT_LEVELS))))
         self.ref_period = ref_period
         self.ref_multiplier = ref_multiplier
         self.satellite_cpu_targets = satellite_cpu_targets
@@ -94,7 +159,28 @@ class Core:
         if host is None:
             self.comm = CommKernelDummy()
         else:
-            self.comm = CommKernel(host)
+            self.comm = CommKernel(host, async_rpc_queue=async_rpc_queue,
+                                   profile_rpc=profile_rpc)
+
+        self.kernel_cache = None
+        if kernel_cache:
+            cache_dir = default_cache_dir()
+            if cache_dir is not None:
+                try:
+                    self.kernel_cache = KernelCache(cache_dir,
+                                                    kernel_cache_size)
+                except OSError:
+                    logger.warning("kernel cache disabled", exc_info=True)
+
+        self.compile_workers = compile_workers
+        self._compile_pool = None
+
+        self.profile_compiler = bool(profile_compiler)
+        self.compiler_profile_dataset = \
+            profile_compiler if isinstance(profile_compiler, str) else None
+        self.compiler_profiles = []
+
+        self.opt_level = opt_level
 
         self.first_run = True
         self.dmgr = dmgr
@@ -102,35 +188,184 @@ class Core:
         self.comm.core = self
 
     def close(self):
+        if self._compile_pool is not None:
+            self._compile_pool.shutdown()
+            self._compile_pool = None
         self.comm.close()
 
-    def compile(self, function, args, kwargs, set_result=None,
-                attribute_writeback=True, print_as_rpc=True,
-                target=None, destination=0, subkernel_arg_types=[]):
+    @contextmanager
+    def _profile(self, function):
+        if compiler_profiler.active() is not None or not (
+                self.profile_compiler
+                or os.getenv("ARTIQ_PROFILE_COMPILER") is not None):
+            yield
+            return
+        profiler = compiler_profiler.Profiler()
+        with compiler_profiler.activate(profiler):
+            yield
+        report = profiler.report(
+            function=getattr(function, "__qualname__", repr(function)))
+        if self.profile_compiler:
+            self.compiler_profiles.append(report)
+        path = os.getenv("ARTIQ_PROFILE_COMPILER")
+        if path is not None:
+            line = json.dumps(report)
+            if path == "":
+                print(line, file=sys.stderr)
+            else:
+                with open(path, "a") as f:
+                    f.write(line + "\n")
+
+    def get_compiler_profiles(self):
+        """Returns the reports of the compilations since the creation of this
+        device, if enabled by the ``profile_compiler`` argument.
+
+        Each report is a dictionary with the name of the compiled function,
+        the start time and duration of the compilation, and the list of
+        stages of the compiler described in
+        :meth:`artiq.compiler.profiler.Profiler.report`."""
+        return list(self.compiler_profiles)
+
+    def rpc_stats(self):
+        """Returns the RPCs served during the last kernel run, if enabled by
+        the ``profile_rpc`` argument, as described in
+        :meth:`artiq.coredevice.comm_kernel.RPCProfiler.stats`: for each
+        RPC function, the number of calls (and how many were async), the
+        time spent in its host handler, and the bytes of its arguments and
+        replies."""
+        profiler = getattr(self.comm, "rpc_profiler", None)
+        if profiler is None:
+            return []
+        return profiler.stats()
+
+    def dump_rpc_trace(self, filename):
+        """Writes the timeline of the RPCs of the last kernel run, if
+        enabled by the ``profile_rpc`` argument, to a JSON file in the
+        Chrome trace event format, which can be opened with Perfetto or
+        ``chrome://tracing``."""
+        profiler = getattr(self.comm, "rpc_profiler", None)
+        if profiler is None:
+            raise ValueError("RPC profiling is not enabled, "
+                             "see the profile_rpc argument of Core")
+        profiler.dump_trace(filename)
+
+    def _generate(self, function, args, kwargs, set_result=None,
+                  attribute_writeback=True, print_as_rpc=True,
+                  target=None, destination=0, subkernel_arg_types=[],
+                  profile_name="kernel"):
         try:
             engine = _DiagnosticEngine(all_errors_are_fatal=True)
 
-            stitcher = Stitcher(engine=engine, core=self, dmgr=self.dmgr,
-                                print_as_rpc=print_as_rpc,
-                                destination=destination, subkernel_arg_types=subkernel_arg_types)
-            stitcher.stitch_call(function, args, kwargs, set_result)
-            stitcher.finalize()
-
-            module = Module(stitcher,
-                ref_period=self.ref_period,
-                attribute_writeback=attribute_writeback)
-            target = target if target is not None else self.target_cls()
-
-            library = target.compile_and_link([module])
-            stripped_library = target.strip(library)
-
-            return stitcher.embedding_map, stripped_library, \
-                   lambda addresses: target.symbolize(library, addresses), \
-                   lambda symbols: target.demangle(symbols), \
-                   module.subkernel_arg_types
+            with compiler_profiler.stage(profile_name):
+                stitcher = Stitcher(engine=engine, core=self, dmgr=self.dmgr,
+                                    print_as_rpc=print_as_rpc,
+                                    destination=destination, subkernel_arg_types=subkernel_arg_types)
+                with compiler_profiler.stage("stitch"):
+                    stitcher.stitch_call(function, args, kwargs, set_result)
+                with compiler_profiler.stage("finalize"):
+                    stitcher.finalize()
+
+                with compiler_profiler.stage("module"):
+                    module = Module(stitcher,
+                        ref_period=self.ref_period,
+                        attribute_writeback=attribute_writeback)
+                if target is None:
+                    target = self.target_cls(opt_level=self._opt_level(function))
+
+                return stitcher.embedding_map, module, target, \
+                       target.generate_llvm_ir(module)
         except diagnostic.Error as error:
             raise CompileError(error.diagnostic) from error
 
+    def _opt_level(self, function):
+        flags = function.artiq_embedded.flags
+        levels = [level for level in OPT_LEVELS if "opt{}".format(level) in flags]
+        if len(levels) > 1:
+            raise ValueError("{} has several optimization level flags"
+                             .format(function.__qualname__))
+        return levels[0] if levels else self.opt_level
+
+    def _submit(self, target, llvm_ir, parallel, profile_name="kernel"):
+        """Starts compiling ``llvm_ir``, and returns a function waiting for
+        the library and the stripped library."""
+        profile_name += "/backend"
+        key = None
+        if self.kernel_cache is not None:
+            with compiler_profiler.stage(profile_name + "/kernel_cache"):
+                key, entry = self.kernel_cache.lookup(target, llvm_ir)
+            if entry is not None:
+                return lambda: entry
+        profiler = compiler_profiler.active()
+        if parallel:
+            future = self._compile_pool.submit(
+                _compile_llvm_ir, type(target), target.subkernel_id,
+                target.opt_level, llvm_ir,
+                None if profiler is None else profile_name)
+            def get_result():
+                result, stages = future.result()
+                if profiler is not None:
+                    profiler.merge(stages)
+                return result
+        else:
+            with compiler_profiler.stage(profile_name):
+                result = _link_llvm_ir(target, llvm_ir)
+            get_result = lambda: result
+        def wait():
+            library, stripped_library = get_result()
+            if self.kernel_cache is not None:
+                self.kernel_cache.store(key, library, stripped_library)
+            return library, stripped_library
+        return wait
+
+    def _use_compile_pool(self):
+        if self.compile_workers == 0:
+            return False
+        if self._compile_pool is None:
+            # The worker processes of the master have threads of their own,
+            # which do not mix well with fork().
+            self._compile_pool = ProcessPoolExecutor(
+                self.compile_workers,
+                mp_context=multiprocessing.get_context("spawn"))
+        return True
+
+    def _result(self, embedding_map, target, wait, module):
+        library, stripped_library = wait()
+        return embedding_map, stripped_library, \
+               lambda addresses: target.symbolize(library, addresses), \
+               lambda symbols: target.demangle(symbols), \
+               module.subkernel_arg_types
+
+    def compile(self, function, args, kwargs, set_result=None,
+                attribute_writeback=True, print_as_rpc=True,
+                target=None, destination=0, subkernel_arg_types=[]):
+        with self._profile(function):
+            embedding_map, module, target, llvm_ir = self._generate(
+                function, args, kwargs, set_result, attribute_writeback,
+                print_as_rpc, target, destination, subkernel_arg_types)
+            return self._result(embedding_map, target,
+                                self._submit(target, llvm_ir, False), module)
+
+    def _compile_with_subkernels(self, function, args, kwargs, set_result,
+                                 attribute_writeback=True):
+        # The main kernel is compiled while the subkernels that it calls
+        # are generated and compiled, all in the compilation pool.
+        with self._profile(function):
+            embedding_map, module, target, llvm_ir = self._generate(
+                function, args, kwargs, set_result, attribute_writeback)
+            parallel = bool(embedding_map.subkernels()) and self._use_compile_pool()
+            wait = self._submit(target, llvm_ir, parallel)
+            subkernels = self._compile_subkernels(
+                embedding_map, args, module.subkernel_arg_types, parallel)
+            return self._result(embedding_map, target, wait, module), subkernels
+
+    def get_kernel_cache_stats(self):
+        """Returns the numbers of hits, misses and evictions of the kernel
+        cache since the creation of this device, or None if the cache is
+        disabled."""
+        if self.kernel_cache is None:
+            return None
+        return dict(self.kernel_cache.stats)
+
     def _run_compiled(self, kernel_library, embedding_map, symbolizer, demangler):
         if self.first_run:
             self.comm.check_system_info()
@@ -145,14 +380,21 @@ class Core:
         def set_result(new_result):
             nonlocal result
             result = new_result
-        embedding_map, kernel_library, symbolizer, demangler, subkernel_arg_types = \
-            self.compile(function, args, kwargs, set_result)
-        self.compile_subkernels(embedding_map, args, subkernel_arg_types)
+        (embedding_map, kernel_library, symbolizer, demangler, _), subkernels = \
+            self._compile_with_subkernels(function, args, kwargs, set_result)
+        self._upload_subkernels(subkernels)
         self._run_compiled(kernel_library, embedding_map, symbolizer, demangler)
         return result
 
     def compile_subkernels(self, embedding_map, args, subkernel_arg_types):
-        for sid, subkernel_fn in embedding_map.subkernels().items():
+        parallel = bool(embedding_map.subkernels()) and self._use_compile_pool()
+        self._upload_subkernels(self._compile_subkernels(
+            embedding_map, args, subkernel_arg_types, parallel))
+
+    def _compile_subkernels(self, embedding_map, args, subkernel_arg_types,
+                            parallel=False):
+        pending = []
+        for sid, subkernel_fn in sorted(embedding_map.subkernels().items()):
             # pass self to subkernels (if applicable)
             # assuming the first argument is self
             subkernel_args = getfullargspec(subkernel_fn.artiq_embedded.function)
@@ -162,13 +404,26 @@ class Core:
                     self_arg = args[:1]
             destination = subkernel_fn.artiq_embedded.destination
             destination_tgt = self.satellite_cpu_targets[destination]
-            target = get_target_cls(destination_tgt)(subkernel_id=sid)
-            object_map, kernel_library, _, _, _ = \
-                self.compile(subkernel_fn, self_arg, {}, attribute_writeback=False,
-                            print_as_rpc=False, target=target, destination=destination, 
-                            subkernel_arg_types=subkernel_arg_types.get(sid, []))
+            target = get_target_cls(destination_tgt)(
+                subkernel_id=sid, opt_level=self._opt_level(subkernel_fn))
+            profile_name = "subkernel_{}".format(sid)
+            object_map, _, target, llvm_ir = \
+                self._generate(subkernel_fn, self_arg, {}, attribute_writeback=False,
+                               print_as_rpc=False, target=target, destination=destination,
+                               subkernel_arg_types=subkernel_arg_types.get(sid, []),
+                               profile_name=profile_name)
             if object_map.has_rpc_or_subkernel():
                 raise ValueError("Subkernel must not use RPC or subkernels in other destinations")
+            pending.append((self._submit(target, llvm_ir, parallel, profile_name),
+                            sid, destination))
+        subkernels = []
+        for wait, sid, destination in pending:
+            _, kernel_library = wait()
+            subkernels.append((kernel_library, sid, destination))
+        return subkernels
+
+    def _upload_subkernels(self, subkernels):
+        for kernel_library, sid, destination in subkernels:
             self.comm.upload_subkernel(kernel_library, sid, destination)
 
     def precompile(self, function, *args, **kwargs):
@@ -195,6 +450,12 @@ class Core:
 
         The callable may be called several times.
         """
+        return self._precompile(function, args, kwargs)
+
+    def _precompile(self, function, args, kwargs, defer_upload=False):
+        # With defer_upload, the core device is not contacted until the
+        # first call, so that kernels can be compiled while another
+        # experiment uses the device.
         if not hasattr(function, "artiq_embedded"):
             raise ValueError("Argument is not a kernel")
 
@@ -204,13 +465,19 @@ class Core:
             nonlocal result
             result = new_result
 
-        embedding_map, kernel_library, symbolizer, demangler, subkernel_arg_types = \
-            self.compile(function, args, kwargs, set_result, attribute_writeback=False)
-        self.compile_subkernels(embedding_map, args, subkernel_arg_types)
+        (embedding_map, kernel_library, symbolizer, demangler, _), subkernels = \
+            self._compile_with_subkernels(function, args, kwargs, set_result,
+                                          attribute_writeback=False)
+        if not defer_upload:
+            self._upload_subkernels(subkernels)
+            subkernels = []
 
         @wraps(function)
         def run_precompiled():
-            nonlocal result
+            nonlocal result, subkernels
+            if subkernels:
+                self._upload_subkernels(subkernels)
+                subkernels = []
             self._run_compiled(kernel_library, embedding_map, symbolizer, demangler)
             return result
 
@@ -0,0 +1,473 @@
+"""
+Emulation of the network protocols of a core device, for testing and
+benchmarking the host side of :mod:`artiq.coredevice.comm_kernel`,
+:mod:`~artiq.coredevice.comm_mgmt`, :mod:`~artiq.coredevice.comm_analyzer`
+and :mod:`~artiq.coredevice.comm_moninj` without hardware.
+
+The emulator does not execute kernels: when a kernel is run, it replays a
+script of RPC requests (see :class:`RPCTraffic`) and then reports that the
+kernel has finished.
+"""
+
+import logging
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy
+
+from artiq import __version__ as software_version
+from artiq.coredevice.comm_kernel import Request as KernelRequest, Reply as KernelReply
+from artiq.coredevice.comm_mgmt import Request as MgmtRequest, Reply as MgmtReply
+
+
+logger = logging.getLogger(__name__)
+
+
+_header = struct.Struct("<lB")
+_int32 = struct.Struct("<l")
+_rpc_exception = struct.Struct("<llqqqllll")
+_sync = 0x5a5a5a5a
+
+_element_sizes = {"b": 1, "i": 4, "I": 8, "f": 8}
+
+
+def _pack_argument(kind, size):
+    if kind == "int32":
+        return b"i" + _int32.pack(size)
+    elif kind == "bytes":
+        return b"B" + _int32.pack(size) + bytes(size)
+    elif kind == "string":
+        return b"s" + _int32.pack(size) + b"x"*size
+    elif kind == "list":
+        return b"l" + _int32.pack(size//4) + b"i" + \
+            numpy.arange(size//4, dtype="<i4").tobytes()
+    elif kind == "float_list":
+        return b"l" + _int32.pack(size//8) + b"f" + \
+            numpy.arange(size//8, dtype="<f8").tobytes()
+    elif kind == "array":
+        return b"a\x01" + _int32.pack(size//4) + b"i" + \
+            numpy.arange(size//4, dtype="<i4").tobytes()
+    else:
+        raise ValueError("unknown RPC argument kind {}".format(kind))
+
+
+class RPCTraffic:
+    """RPC requests made by the emulated kernel.
+
+    :param service_id: RPC service number, as allocated by the embedding map
+        of the host.
+    :param count: number of requests.
+    :param kind: type of the single argument of each request: ``int32``
+        (whose value is ``size``), ``bytes``, ``string``, ``list`` (of
+        int32), ``float_list`` or ``array`` (one-dimensional, of int32).
+    :param size: size of the argument in bytes.
+    :param rate: number of requests per second, or None to send them as
+        fast as the host reads them.
+    :param is_async: whether the requests are async RPCs; otherwise, the
+        kernel waits for each reply.
+    :param return_tags: type tags of the return value, e.g. ``b"n"`` for
+        None or ``b"li"`` for a list of int32.
+    """
+
+    def __init__(self, service_id=1, count=1, kind="int32", size=0,
+                 rate=None, is_async=False, return_tags=b"n"):
+        self.service_id = service_id
+        self.count = count
+        self.rate = rate
+        self.is_async = is_async
+        self.return_tags = bytes(return_tags)
+        self.request = _header.pack(_sync, KernelReply.RPCRequest.value) + \
+            bytes([is_async]) + _int32.pack(service_id) + \
+            _pack_argument(kind, size) + b"\x00" + \
+            _int32.pack(len(self.return_tags)) + self.return_tags
+
+    @classmethod
+    def from_dict(cls, desc):
+        """Creates the traffic described by a dictionary of the parameters
+        of :class:`RPCTraffic`, as in the scripts of ``artiq_coreemu``."""
+        desc = dict(desc)
+        if "return_tags" in desc:
+            desc["return_tags"] = desc["return_tags"].encode()
+        return cls(**desc)
+
+
+def synthetic_analyzer_dump(message_count, channels=4, period=8):
+    """Returns an analyzer dump of ``message_count`` output events on
+    ``channels`` channels in turn, one every ``period`` RTIO cycles, that
+    toggle the value of each channel, followed by a stopped message."""
+    dtype = numpy.dtype([("data", ">u8"), ("address", ">u4"),
+                         ("rtio_counter", ">u8"), ("timestamp", ">u8"),
+                         ("type_channel", ">u4")])
+    index = numpy.arange(message_count, dtype=numpy.uint64)
+    messages = numpy.zeros(message_count, dtype)
+    messages["data"] = index // channels % 2
+    messages["timestamp"] = index*period
+    messages["rtio_counter"] = index*period
+    messages["type_channel"] = (index % channels) << 2
+    stopped = struct.pack(">12xQ8xI", message_count*period, 0b11)
+    data = messages.tobytes() + stopped
+    return b"e" + struct.pack("<IQbbb", len(data), len(data), 0, channels, 0) + data
+
+
+def _skip_tags(tags):
+    tag = chr(tags.pop(0))
+    if tag == "t":
+        for _ in range(tags.pop(0)):
+            _skip_tags(tags)
+    elif tag in "lr":
+        _skip_tags(tags)
+    elif tag == "a":
+        tags.pop(0)
+        _skip_tags(tags)
+
+
+def _read_rpc_value(read, tags):
+    """Reads an RPC return value of type ``tags`` sent by the host."""
+    tag = chr(tags.pop(0))
+    if tag == "t":
+        for _ in range(tags.pop(0)):
+            _read_rpc_value(read, tags)
+    elif tag in _element_sizes:
+        read(_element_sizes[tag])
+    elif tag == "F":
+        read(16)
+    elif tag in "sBA":
+        read(_int32.unpack(read(4))[0])
+    elif tag in "lar":
+        if tag == "l":
+            length = _int32.unpack(read(4))[0]
+        elif tag == "a":
+            length = 1
+            for _ in range(tags.pop(0)):
+                length *= _int32.unpack(read(4))[0]
+        else:
+            length = 3
+        if chr(tags[0]) in _element_sizes:
+            read(length*_element_sizes[chr(tags[0])])
+        else:
+            for _ in range(length):
+                _read_rpc_value(read, bytearray(tags))
+        _skip_tags(tags)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    hello = None
+
+    def handle(self):
+        hello = self.rfile.readline()
+        if hello != self.hello:
+            logger.warning("unexpected connection greeting %r", hello)
+            return
+        try:
+            self.serve()
+        except ConnectionError:
+            pass
+
+    def read(self, length):
+        data = self.rfile.read(length)
+        if len(data) != length:
+            raise ConnectionResetError("connection closed")
+        return data
+
+    def read_int32(self):
+        return _int32.unpack(self.read(4))[0]
+
+    def read_bytes(self):
+        return self.read(self.read_int32())
+
+
+class _KernelHandler(_Handler):
+    hello = b"ARTIQ coredev\n"
+
+    def write_header(self, reply):
+        self.wfile.write(_header.pack(_sync, reply.value))
+
+    def read_header(self):
+        sync, request = _header.unpack(self.read(5))
+        if sync != _sync:
+            raise IOError("incorrect synchronization sequence {:#x}".format(sync))
+        return KernelRequest(request)
+
+    def serve(self):
+        emulator = self.server.emulator
+        self.wfile.write(b"e")
+        while True:
+            request = self.read_header()
+            if request == KernelRequest.SystemInfo:
+                version = (software_version + ";emulator").encode()
+                self.write_header(KernelReply.SystemInfo)
+                self.wfile.write(b"AROR" + _int32.pack(len(version)) + version +
+                                 b"\x01")
+            elif request in (KernelRequest.LoadKernel,
+                             KernelRequest.SubkernelUpload):
+                if request == KernelRequest.SubkernelUpload:
+                    self.read(5)
+                library = self.read_bytes()
+                emulator.log("loaded kernel of {} bytes".format(len(library)))
+                self.write_header(KernelReply.LoadCompleted)
+            elif request == KernelRequest.RunKernel:
+                self.run_kernel(emulator.rpc_script)
+            else:
+                raise IOError("unexpected request {}".format(request))
+
+    def run_kernel(self, script):
+        output = bytearray()
+        for traffic in script:
+            start = time.perf_counter()
+            for index in range(traffic.count):
+                if traffic.rate:
+                    delay = start + index/traffic.rate - time.perf_counter()
+                    if delay > 0:
+                        self.wfile.write(output)
+                        output.clear()
+                        time.sleep(delay)
+                output += traffic.request
+                if not traffic.is_async:
+                    self.wfile.write(output)
+                    output.clear()
+                    if not self.read_rpc_reply(traffic):
+                        return
+                elif len(output) > 65536:
+                    self.wfile.write(output)
+                    output.clear()
+        output += _header.pack(_sync, KernelReply.KernelFinished.value) + b"\x00"
+        self.wfile.write(output)
+
+    def read_rpc_reply(self, traffic):
+        request = self.read_header()
+        if request == KernelRequest.RPCReply:
+            _read_rpc_value(self.read, bytearray(self.read_bytes()))
+            return True
+        elif request == KernelRequest.RPCException:
+            # the kernel does not catch the exception: send it back, with
+            # the strings that the host has stored in its embedding map
+            (name, message, param0, param1, param2, filename, line, column,
+             function) = _rpc_exception.unpack(self.read(_rpc_exception.size))
+            self.write_header(KernelReply.KernelException)
+            self.wfile.write(
+                struct.pack("<llllqqqllllll", 1, name, -1, message,
+                            param0, param1, param2, -1, filename, line,
+                            column, -1, function) +
+                struct.pack("<llll", 0, 0, 0, 0) + b"\x00")
+            return False
+        else:
+            raise IOError("unexpected request {}".format(request))
+
+
+class _MgmtHandler(_Handler):
+    hello = b"ARTIQ management\n"
+
+    def write_header(self, reply):
+        self.wfile.write(bytes([reply.value]))
+
+    def write_string(self, value):
+        value = value.encode()
+        self.wfile.write(_int32.pack(len(value)) + value)
+
+    def serve(self):
+        emulator = self.server.emulator
+        self.wfile.write(b"e")
+        while True:
+            request = MgmtRequest(self.read(1)[0])
+            if request == MgmtRequest.GetLog:
+                self.write_header(MgmtReply.LogContent)
+                self.write_string(emulator.get_log())
+            elif request == MgmtRequest.ClearLog:
+                emulator.clear_log()
+                self.write_header(MgmtReply.Success)
+            elif request == MgmtRequest.PullLog:
+                self.write_header(MgmtReply.LogContent)
+                self.write_string(emulator.pull_log())
+            elif request in (MgmtRequest.SetLogFilter,
+                             MgmtRequest.SetUartLogFilter):
+                self.read(1)
+                self.write_header(MgmtReply.Success)
+            elif request == MgmtRequest.ConfigRead:
+                value = emulator.config.get(self.read_bytes().decode())
+                if value is None:
+                    self.write_header(MgmtReply.Error)
+                else:
+                    self.write_header(MgmtReply.ConfigData)
+                    self.wfile.write(_int32.pack(len(value)) + value)
+            elif request == MgmtRequest.ConfigWrite:
+                key = self.read_bytes().decode()
+                emulator.config[key] = self.read_bytes()
+                self.write_header(MgmtReply.Success)
+            elif request == MgmtRequest.ConfigRemove:
+                emulator.config.pop(self.read_bytes().decode(), None)
+                self.write_header(MgmtReply.Success)
+            elif request == MgmtRequest.ConfigErase:
+                emulator.config.clear()
+                self.write_header(MgmtReply.Success)
+            elif request == MgmtRequest.Reboot:
+                emulator.log("rebooting")
+                self.write_header(MgmtReply.RebootImminent)
+                return
+            elif request == MgmtRequest.DebugAllocator:
+                pass
+
+
+class _AnalyzerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            self.request.sendall(self.server.emulator.analyzer_dump)
+        except ConnectionError:
+            pass
+
+
+class _MonInjHandler(_Handler):
+    hello = b"ARTIQ moninj\n"
+    # the packets after the greeting are read from the socket
+    rbufsize = 0
+
+    def serve(self):
+        emulator = self.server.emulator
+        interval = 1/emulator.moninj_rate
+        probes = {}
+        monitored_injections = set()
+        packets = bytearray()
+        next_update = time.monotonic()
+        sock = self.request
+        while True:
+            timeout = None
+            if probes:
+                timeout = max(next_update - time.monotonic(), 0)
+            sock.settimeout(timeout)
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                data = None
+            if data == b"":
+                return
+            if data:
+                packets += data
+            output = bytearray()
+            while packets and len(packets) >= (6 if packets[0] == 2 else 7):
+                ty = packets[0]
+                if ty in (0, 3):
+                    _, enable, channel, probe = struct.unpack("<bblb", packets[:7])
+                    del packets[:7]
+                    if ty == 0 and enable:
+                        probes[(channel, probe)] = 0
+                        output += struct.pack("<blbq", 0, channel, probe, 0)
+                    elif ty == 0:
+                        probes.pop((channel, probe), None)
+                    elif enable:
+                        monitored_injections.add((channel, probe))
+                        output += struct.pack(
+                            "<blbb", 1, channel, probe,
+                            emulator.injections.get((channel, probe), 0))
+                    else:
+                        monitored_injections.discard((channel, probe))
+                elif ty == 1:
+                    _, channel, override, value = struct.unpack("<blbb", packets[:7])
+                    del packets[:7]
+                    emulator.injections[(channel, override)] = value
+                    if (channel, override) in monitored_injections:
+                        output += struct.pack("<blbb", 1, channel, override, value)
+                elif ty == 2:
+                    _, channel, override = struct.unpack("<blb", packets[:6])
+                    del packets[:6]
+                    output += struct.pack(
+                        "<blbb", 1, channel, override,
+                        emulator.injections.get((channel, override), 0))
+                else:
+                    raise IOError("unexpected moninj packet type {}".format(ty))
+            if probes and time.monotonic() >= next_update:
+                # synthetic probe values: the number of updates
+                for (channel, probe), value in probes.items():
+                    probes[(channel, probe)] = value + 1
+                    output += struct.pack("<blbq", 0, channel, probe, value + 1)
+                next_update = max(next_update + interval, time.monotonic())
+            if output:
+                sock.sendall(output)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class CoreDeviceEmulator:
+    """Serves the kernel, management, analyzer and moninj protocols of a
+    core device on TCP ports of ``host``.
+
+    :param ports: dictionary of the ports of the ``kernel``, ``mgmt``,
+        ``analyzer`` and ``moninj`` protocols; 0 selects a free port, and
+        the default are the ports of a core device. The selected ports are
+        in the :attr:`ports` attribute once the emulator is started.
+    :param rpc_script: list of :class:`RPCTraffic` replayed by each kernel.
+    :param analyzer_dump: data sent to the clients of the analyzer, e.g.
+        from :func:`synthetic_analyzer_dump`.
+    :param moninj_rate: number of updates of each monitored probe per second.
+    """
+
+    default_ports = {"mgmt": 1380, "kernel": 1381, "analyzer": 1382, "moninj": 1383}
+
+    def __init__(self, host="127.0.0.1", ports=None, rpc_script=[],
+                 analyzer_dump=None, moninj_rate=10):
+        self.host = host
+        self.ports = dict(self.default_ports)
+        if ports is not None:
+            self.ports.update(ports)
+        self.rpc_script = list(rpc_script)
+        if analyzer_dump is None:
+            analyzer_dump = synthetic_analyzer_dump(0)
+        self.analyzer_dump = analyzer_dump
+        self.moninj_rate = moninj_rate
+
+        self.config = {}
+        self.injections = {}
+        self.log_lock = threading.Lock()
+        self.log_lines = []
+        self.pulled_lines = 0
+        self.servers = []
+
+    def log(self, message):
+        logger.info("%s", message)
+        with self.log_lock:
+            self.log_lines.append("[{:>13.6f}s]  INFO(emulator): {}".format(
+                time.monotonic(), message))
+
+    def get_log(self):
+        with self.log_lock:
+            return "".join(line + "\n" for line in self.log_lines)
+
+    def clear_log(self):
+        with self.log_lock:
+            self.log_lines.clear()
+            self.pulled_lines = 0
+
+    def pull_log(self):
+        with self.log_lock:
+            lines = self.log_lines[self.pulled_lines:]
+            self.pulled_lines = len(self.log_lines)
+        return "".join(line + "\n" for line in lines)
+
+    def start(self):
+        handlers = {"kernel": _KernelHandler, "mgmt": _MgmtHandler,
+                    "analyzer": _AnalyzerHandler, "moninj": _MonInjHandler}
+        for name, handler in handlers.items():
+            server = _Server((self.host, self.ports[name]), handler)
+            server.emulator = self
+            self.ports[name] = server.server_address[1]
+            threading.Thread(target=server.serve_forever, args=(0.1,),
+                             name=name, daemon=True).start()
+            self.servers.append(server)
+        self.log("core device emulator started")
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import threading
+
+from sipyco import common_args
+
+from artiq.coredevice.emulator import (CoreDeviceEmulator, RPCTraffic,
+                                       synthetic_analyzer_dump)
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description="ARTIQ core device protocol emulator")
+    common_args.verbosity_args(parser)
+    parser.add_argument("--bind", default="127.0.0.1",
+                        help="address to listen on (default: %(default)s)")
+    for name, port in CoreDeviceEmulator.default_ports.items():
+        parser.add_argument("--port-" + name, default=port, type=int,
+                            help="TCP port of the {} protocol "
+                                 "(default: %(default)d)".format(name))
+
+    group = parser.add_argument_group("kernels")
+    group.add_argument("--script", default=None,
+                       help="JSON file with the list of RPC traffic replayed "
+                            "by each kernel, as dictionaries of the "
+                            "parameters of RPCTraffic (overrides the "
+                            "options below)")
+    group.add_argument("--rpc-count", default=0, type=int,
+                       help="number of RPCs made by each kernel "
+                            "(default: %(default)d)")
+    group.add_argument("--rpc-service", default=1, type=int,
+                       help="RPC service number (default: %(default)d)")
+    group.add_argument("--rpc-kind", default="bytes",
+                       choices=["int32", "bytes", "string", "list",
+                                "float_list", "array"],
+                       help="type of the RPC argument (default: %(default)s)")
+    group.add_argument("--rpc-size", default=1024, type=int,
+                       help="size of the RPC argument in bytes "
+                            "(default: %(default)d)")
+    group.add_argument("--rpc-rate", default=None, type=float,
+                       help="number of RPCs per second "
+                            "(default: as fast as possible)")
+    group.add_argument("--rpc-async", default=False, action="store_true",
+                       help="make async RPCs")
+
+    group = parser.add_argument_group("analyzer")
+    group.add_argument("--analyzer-dump", default=None,
+                       help="raw analyzer dump file to serve, e.g. written "
+                            "by artiq_coreanalyzer -d")
+    group.add_argument("--analyzer-messages", default=1000, type=int,
+                       help="number of events of the synthetic analyzer dump "
+                            "(default: %(default)d)")
+
+    group = parser.add_argument_group("moninj")
+    group.add_argument("--moninj-rate", default=10., type=float,
+                       help="number of updates of each monitored probe per "
+                            "second (default: %(default)s)")
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+    common_args.init_logger_from_args(args)
+
+    if args.script is not None:
+        with open(args.script) as f:
+            rpc_script = [RPCTraffic.from_dict(desc) for desc in json.load(f)]
+    elif args.rpc_count:
+        rpc_script = [RPCTraffic(args.rpc_service, args.rpc_count,
+                                 args.rpc_kind, args.rpc_size, args.rpc_rate,
+                                 args.rpc_async)]
+    else:
+        rpc_script = []
+    if args.analyzer_dump is not None:
+        with open(args.analyzer_dump, "rb") as f:
+            analyzer_dump = f.read()
+    else:
+        analyzer_dump = synthetic_analyzer_dump(args.analyzer_messages)
+
+    ports = {name: getattr(args, "port_" + name)
+             for name in CoreDeviceEmulator.default_ports}
+    with CoreDeviceEmulator(args.bind, ports, rpc_script, analyzer_dump,
+                            args.moninj_rate):
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
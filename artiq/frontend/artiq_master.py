@@ -7,7 +7,6 @@ import logging
 from types import SimpleNamespace
 
 from sipyco.pc_rpc import Server as RPCServer
-from sipyco.sync_struct import Publisher
 from sipyco.logging_tools import Server as LoggingServer
 from sipyco.broadcast import Broadcaster
 from sipyco import common_args
@@ -16,6 +15,7 @@ from sipyco.asyncio_tools import atexit_register_coroutine, SignalHandler
 from artiq import __version__ as artiq_version
 from artiq.master.log import log_args, init_log
 from artiq.master.databases import DeviceDB, DatasetDB
+from artiq.master.publisher import CoalescingPublisher
 from artiq.master.scheduler import Scheduler
 from artiq.master.rid_counter import RIDCounter
 from artiq.master.experiments import (FilesystemBackend, GitBackend,
@@ -24,6 +24,14 @@ from artiq.master.experiments import (FilesystemBackend, GitBackend,
 logger = logging.getLogger(__name__)
 
 
+def _worker_pool_spec(spec):
+    pipeline_name, sep, size = spec.rpartition("=")
+    if not sep or not pipeline_name:
+        raise argparse.ArgumentTypeError(
+            "worker pool must be specified as PIPELINE=SIZE")
+    return pipeline_name, int(size)
+
+
 def get_argparser():
     parser = argparse.ArgumentParser(description="ARTIQ master")
     parser.add_argument("--version", action="version",
@@ -42,6 +50,14 @@ def get_argparser():
                        help="device database file (default: '%(default)s')")
     group.add_argument("--dataset-db", default="dataset_db.mdb",
                        help="dataset file (default: '%(default)s')")
+    group.add_argument("--dataset-broadcast-window", default=0.1, type=float,
+                       help="delay in seconds during which modifications of "
+                            "a dataset are merged before they are sent to "
+                            "each subscriber (default: %(default)s)")
+    group.add_argument("--dataset-broadcast-backlog", default=100, type=int,
+                       help="number of modifications of a dataset pending "
+                            "for a subscriber beyond which the whole dataset "
+                            "is sent instead (default: %(default)s)")
 
     group = parser.add_argument_group("repository")
     group.add_argument(
@@ -54,6 +70,34 @@ def get_argparser():
         "--experiment-subdir", default="",
         help=("path to the experiment folder from the repository root "
               "(default: '%(default)s')"))
+    group.add_argument(
+        "--scan-workers", default=4, type=int,
+        help=("number of experiment files examined in parallel when "
+              "scanning the repository (default: %(default)s)"))
+    group.add_argument(
+        "--examine-cache", default=None,
+        help=("file in which to keep the descriptions of experiment files "
+              "between repository scans, so that only modified files are "
+              "examined again (default: no cache)"))
+
+    group = parser.add_argument_group("worker pool")
+    group.add_argument(
+        "--worker-pool-size", default=0, type=int,
+        help="number of pre-started idle worker processes kept for each "
+             "pipeline (default: %(default)s)")
+    group.add_argument(
+        "--worker-pool", default=[], action="append",
+        type=_worker_pool_spec, metavar="PIPELINE=SIZE",
+        help="override the worker pool size for the given pipeline, and "
+             "start its pool together with the master "
+             "(can be specified multiple times)")
+    group.add_argument(
+        "--worker-pool-max-runs", default=1, type=int,
+        help="number of runs after which a pooled worker process is "
+             "replaced; it is replaced earlier if a run fails or imports "
+             "modules from outside the repository, ARTIQ and the standard "
+             "library (default: %(default)s)")
+
     log_args(parser)
 
     parser.add_argument("--name",
@@ -103,10 +147,13 @@ def main():
     else:
         repo_backend = FilesystemBackend(args.repository)
     experiment_db = ExperimentDB(
-        repo_backend, worker_handlers, args.experiment_subdir)
+        repo_backend, worker_handlers, args.experiment_subdir,
+        args.scan_workers, args.examine_cache)
     atexit.register(experiment_db.close)
 
-    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db, args.log_submissions)
+    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db, args.log_submissions,
+                          args.worker_pool_size, dict(args.worker_pool),
+                          args.worker_pool_max_runs)
     scheduler.start(loop=loop)
     atexit_register_coroutine(scheduler.stop, loop=loop)
 
@@ -115,6 +162,9 @@ def main():
         "get_device": device_db.get,
         "get_dataset": dataset_db.get,
         "update_dataset": dataset_db.update,
+        "get_datasets": dataset_db.get_many,
+        "watch_datasets": dataset_db.watch,
+        "unwatch_datasets": dataset_db.unwatch,
         "scheduler_submit": scheduler.submit,
         "scheduler_delete": scheduler.delete,
         "scheduler_request_termination": scheduler.request_termination,
@@ -128,7 +178,8 @@ def main():
     signal_handler_task = loop.create_task(signal_handler.wait_terminate())
     master_management = SimpleNamespace(
         get_name=lambda: args.name,
-        terminate=lambda: signal_handler_task.cancel()
+        terminate=lambda: signal_handler_task.cancel(),
+        get_subscriber_stats=lambda: server_notify.get_subscriber_stats()
     )
 
     server_control = RPCServer({
@@ -142,13 +193,16 @@ def main():
         bind, args.port_control))
     atexit_register_coroutine(server_control.stop, loop=loop)
 
-    server_notify = Publisher({
+    server_notify = CoalescingPublisher({
         "schedule": scheduler.notifier,
         "devices": device_db.data,
         "datasets": dataset_db.data,
         "explist": experiment_db.explist,
         "explist_status": experiment_db.status
-    })
+    }, coalesced={"datasets"}, window=args.dataset_broadcast_window,
+       max_backlog=args.dataset_broadcast_backlog,
+       # subscribers receive all datasets, even those not loaded yet
+       before_init={"datasets": dataset_db.load_all})
     loop.run_until_complete(server_notify.start(
         bind, args.port_notify))
     atexit_register_coroutine(server_notify.stop, loop=loop)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Tool to find runs in the results directory of the master, using the index
+updated by the workers.
+"""
+
+import argparse
+import time
+from dateutil.parser import parse as parse_date
+
+from prettytable import PrettyTable
+
+from artiq.master.results_index import ResultsIndex
+from artiq import __version__ as artiq_version
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="ARTIQ results index")
+    parser.add_argument("--version", action="version",
+                        version="ARTIQ v{}".format(artiq_version),
+                        help="print the ARTIQ version number")
+    parser.add_argument("-r", "--results", default="results",
+                        help="results directory of the master "
+                             "(default: '%(default)s')")
+
+    subparsers = parser.add_subparsers(dest="action")
+    subparsers.required = True
+
+    subparsers.add_parser(
+        "scan", help="index the results files that are not indexed yet")
+
+    parser_query = subparsers.add_parser(
+        "query", help="list the runs matching all the given criteria")
+    parser_query.add_argument("-c", "--class-name", default=None,
+                              help="name of the experiment class")
+    parser_query.add_argument("-f", "--file", default=None,
+                              help="experiment file")
+    parser_query.add_argument("-R", "--revision", default=None,
+                              help="repository revision")
+    parser_query.add_argument("-d", "--dataset", default=None,
+                              help="name of a dataset in the results")
+    parser_query.add_argument("--since", default=None,
+                              help="earliest start time")
+    parser_query.add_argument("--until", default=None,
+                              help="latest start time")
+    parser_query.add_argument("-n", "--limit", default=20, type=int,
+                              help="maximum number of runs, or 0 for all "
+                                   "(default: %(default)s)")
+    parser_query.add_argument("-p", "--paths", default=False,
+                              action="store_true",
+                              help="only print the paths of the results files")
+
+    parser_show = subparsers.add_parser(
+        "show", help="show the datasets of a run")
+    parser_show.add_argument("rid", type=int, help="RID of the run")
+
+    return parser
+
+
+def _timestamp(date):
+    if date is None:
+        return None
+    return parse_date(date).timestamp()
+
+
+def _format_time(t):
+    if t is None:
+        return ""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+
+
+def _action_query(index, args):
+    runs = index.query(class_name=args.class_name, file=args.file,
+                       repo_rev=args.revision, dataset=args.dataset,
+                       since=_timestamp(args.since),
+                       until=_timestamp(args.until),
+                       limit=args.limit or None)
+    if args.paths:
+        for run in runs:
+            print(index.get_path(run["rid"]))
+        return
+    table = PrettyTable(["RID", "Class", "File", "Revision", "Start time",
+                         "Results file"])
+    for run in runs:
+        table.add_row([run["rid"], run["class_name"], run["file"] or "",
+                       run["repo_rev"] or "",
+                       _format_time(run["start_time"]), run["results_file"]])
+    print(table)
+
+
+def _action_show(index, args):
+    run, = index.query(rid=args.rid) or [None]
+    if run is None:
+        print("RID {} is not indexed".format(args.rid))
+        return
+    print("Results file: {}".format(index.get_path(args.rid)))
+    print("Class: {}".format(run["class_name"]))
+    print("Start time: {}".format(_format_time(run["start_time"])))
+    print("Run time: {}".format(_format_time(run["run_time"])))
+    table = PrettyTable(["Dataset", "Archive", "Shape", "Type"])
+    for dataset in index.get_datasets(args.rid):
+        table.add_row([dataset["name"], "yes" if dataset["archive"] else "",
+                       dataset["shape"], dataset["dtype"]])
+    print(table)
+
+
+def main():
+    args = get_argparser().parse_args()
+    with ResultsIndex(args.results) as index:
+        if args.action == "scan":
+            print("Indexed {} results files".format(index.scan()))
+        elif args.action == "query":
+            _action_query(index, args)
+        elif args.action == "show":
+            _action_show(index, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -52,7 +52,7 @@ class FileRunner(EnvExperiment):
     def build(self, file):
         self.setattr_device("core")
         self.file = file
-        self.target = self.core.target_cls()
+        self.target = self.core.target_cls(opt_level=self.core.opt_level)
 
     def run(self):
         kernel_library = self.compile()
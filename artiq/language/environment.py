@@ -441,6 +441,33 @@ class HasEnvironment:
             else:
                 return default
 
+    def stream_results(self, flush_period=10.0, compression="gzip"):
+        """Requests the archived datasets to be written to the results file
+        while the experiment runs, instead of only at the end of the
+        analyze stage (or when ``run`` fails).
+
+        Numeric lists and arrays are stored in chunked HDF5 datasets,
+        compressed with the given filter (``None`` to disable compression),
+        and values appended to them are added incrementally. The file is
+        updated every ``flush_period`` seconds, so that most results survive
+        a crash of the worker process. The other contents of the results file
+        are written when the experiment completes.
+
+        This method must be called before ``run``, and only has an effect when
+        the experiment is executed by the master."""
+        self.__dataset_mgr.stream_results(flush_period, compression)
+
+    def prefetch_datasets(self, keys=(), prefixes=()):
+        """Obtains the given datasets from the master, and all datasets the
+        keys of which start with one of the given prefixes, with a single
+        request.
+
+        When running in the master, subsequent calls to ``get_dataset`` and
+        ``get_dataset_metadata`` for these keys are served by a local copy
+        that the master keeps up to date. Elsewhere, this method has no
+        effect."""
+        self.__dataset_mgr.prefetch(keys, prefixes)
+
     def setattr_dataset(self, key, default=NoDefault, archive=True):
         """Sets the contents of a dataset as attribute. The names of the
         dataset and of the attribute are the same."""
@@ -513,6 +540,17 @@ class EnvExperiment(Experiment, HasEnvironment):
     :class:`~artiq.language.environment.HasEnvironment` environment manager.
 
     Most experiments should derive from this class."""
+
+    #: Names of kernel methods without arguments that the worker compiles
+    #: during the prepare stage, while other experiments may be using the
+    #: core device. Calls to these methods then only upload and execute the
+    #: kernels compiled in advance, with the restrictions of
+    #: :meth:`~artiq.coredevice.core.Core.precompile`: attribute values are
+    #: those at the end of :meth:`prepare`, and modified attributes are not
+    #: written back to the host. If compilation fails, the methods are left
+    #: unchanged and compiled when called.
+    precompiled_kernels = ()
+
     def prepare(self):
         """This default prepare method calls :meth:`~artiq.language.environment.Experiment.prepare`
         for all children, in the order of registration, if the child has a
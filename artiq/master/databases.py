@@ -1,4 +1,5 @@
 import asyncio
+import time
 
 import lmdb
 
@@ -7,6 +8,7 @@ from sipyco import pyon
 from sipyco.asyncio_tools import TaskObject
 
 from artiq.tools import file_import
+from artiq.master import worker_ipc
 
 
 def device_db_from_file(filename):
@@ -40,37 +42,120 @@ class DeviceDB:
         return self.data.raw_view["satellite_cpu_targets"][destination]
 
 
+# First byte of records in the binary format. Records written by earlier
+# versions are PYON text, and begin with "(".
+DATASET_RECORD_VERSION = 1
+
+
+def encode_dataset_record(value, metadata):
+    """Encodes a persistent dataset for storage.
+
+    The record is the version byte followed by a message in the format of
+    :mod:`artiq.master.worker_ipc`, where all numeric arrays are stored as
+    raw memory."""
+    return b"".join([bytes([DATASET_RECORD_VERSION])] +
+                    worker_ipc.encode((value, metadata), True, 0))
+
+
+def decode_dataset_record(data):
+    """Decodes a record produced by :func:`encode_dataset_record`, or
+    a PYON record of earlier versions.
+
+    Returns the value, the metadata, and whether the record is in the
+    current format."""
+    view = memoryview(data)
+    if bytes(view[:1]) != bytes([DATASET_RECORD_VERSION]):
+        value, metadata = pyon.decode(bytes(view).decode())
+        return value, metadata, False
+    prefix = worker_ipc.FRAME_PREFIX
+    if bytes(view[1:1+len(prefix)]) != prefix:
+        value, metadata = worker_ipc.decode(bytes(view[1:]))
+        return value, metadata, True
+    # look for the end of the header without copying the arrays
+    size = 64
+    while True:
+        end = bytes(view[:size]).find(b"\n")
+        if end >= 0 or size >= len(view):
+            break
+        size *= 4
+    if end < 0:
+        raise ValueError("truncated dataset record")
+    end += 1
+    lengths = worker_ipc.parse_frame_header(bytes(view[1:end]))
+    parts = []
+    for n in lengths:
+        parts.append(bytearray(view[end:end+n]))
+        end += n
+    value, metadata = worker_ipc.decode(parts[0], parts[1:])
+    return value, metadata, True
+
+
 class DatasetDB(TaskObject):
     def __init__(self, persist_file, autosave_period=30):
         self.persist_file = persist_file
         self.autosave_period = autosave_period
 
         self.lmdb = lmdb.open(persist_file, subdir=False, map_size=2**30)
-        data = dict()
+        # Persistent datasets are decoded when first accessed, by the
+        # background task, or by load_all(). Until then, they are absent from
+        # the notifier, and their addition to it is published to current
+        # subscribers. New subscribers should call load_all() first to
+        # receive all datasets.
         with self.lmdb.begin() as txn:
-            for key, value_and_metadata in txn.cursor():
-                value, metadata = pyon.decode(value_and_metadata.decode())
-                data[key.decode()] = (True, value, metadata)
-        self.data = Notifier(data)
+            self.unloaded_keys = dict.fromkeys(
+                key.decode()
+                for key in txn.cursor().iternext(keys=True, values=False))
+        self.data = Notifier(dict())
         self.pending_keys = set()
+        self.watchers = set()
 
     def close_db(self):
         self.lmdb.close()
 
+    def _load_from(self, txn, key):
+        del self.unloaded_keys[key]
+        # Records are decoded from LMDB's memory, arrays are copied once.
+        value, metadata, current = decode_dataset_record(
+            txn.get(key.encode()))
+        if not current:
+            # rewrite in the current format on the next save
+            self.pending_keys.add(key)
+        self.data[key] = (True, value, metadata)
+
+    def _load(self, key):
+        if key in self.unloaded_keys:
+            with self.lmdb.begin(buffers=True) as txn:
+                self._load_from(txn, key)
+
+    def load_all(self):
+        """Decodes all persistent datasets that have not been accessed
+        yet."""
+        with self.lmdb.begin(buffers=True) as txn:
+            for key in list(self.unloaded_keys):
+                self._load_from(txn, key)
+
+    async def _load_background(self, slice_duration=0.01):
+        while self.unloaded_keys:
+            deadline = time.monotonic() + slice_duration
+            with self.lmdb.begin(buffers=True) as txn:
+                while self.unloaded_keys and time.monotonic() < deadline:
+                    self._load_from(txn, next(iter(self.unloaded_keys)))
+            await asyncio.sleep(0)
+
     def save(self):
         with self.lmdb.begin(write=True) as txn:
             for key in self.pending_keys:
                 if key not in self.data.raw_view or not self.data.raw_view[key][0]:
                     txn.delete(key.encode())
                 else:
-                    value_and_metadata = (self.data.raw_view[key][1],
-                                          self.data.raw_view[key][2])
-                    txn.put(key.encode(), 
-                            pyon.encode(value_and_metadata).encode())
+                    txn.put(key.encode(), encode_dataset_record(
+                        self.data.raw_view[key][1],
+                        self.data.raw_view[key][2]))
         self.pending_keys.clear()
 
     async def _do(self):
         try:
+            await self._load_background()
             while True:
                 await asyncio.sleep(self.autosave_period)
                 self.save()
@@ -78,22 +163,66 @@ class DatasetDB(TaskObject):
             self.save()
 
     def get(self, key):
+        if self.unloaded_keys:
+            self._load(key)
         return self.data.raw_view[key][1]
 
     def get_metadata(self, key):
+        if self.unloaded_keys:
+            self._load(key)
         return self.data.raw_view[key][2]
 
+    def get_many(self, keys=(), prefixes=()):
+        """Returns a dictionary mapping the given keys, and all keys starting
+        with one of the given prefixes, to tuples of value and metadata.
+        Nonexistent keys are omitted."""
+        if self.unloaded_keys:
+            for key in keys:
+                self._load(key)
+            if prefixes:
+                for key in [key for key in self.unloaded_keys
+                            if key.startswith(tuple(prefixes))]:
+                    self._load(key)
+        raw_view = self.data.raw_view
+        r = dict()
+        for key in keys:
+            if key in raw_view:
+                r[key] = raw_view[key][1], raw_view[key][2]
+        if prefixes:
+            prefixes = tuple(prefixes)
+            for key, (_, value, metadata) in raw_view.items():
+                if key.startswith(prefixes):
+                    r[key] = value, metadata
+        return r
+
+    def watch(self, callback):
+        """Registers a function that is called with the key of each
+        dataset that is modified."""
+        self.watchers.add(callback)
+
+    def unwatch(self, callback):
+        self.watchers.discard(callback)
+
+    def _changed(self, key):
+        for callback in list(self.watchers):
+            callback(key)
+
     def update(self, mod):
         if mod["path"]:
             key = mod["path"][0]
         else:
             assert(mod["action"] == ModAction.setitem.value or mod["action"] == ModAction.delitem.value)
             key = mod["key"]
+        if self.unloaded_keys:
+            self._load(key)
         self.pending_keys.add(key)
         process_mod(self.data, mod)
+        self._changed(key)
 
     # convenience functions (update() can be used instead)
     def set(self, key, value, persist=None, metadata=None):
+        if self.unloaded_keys:
+            self._load(key)
         if persist is None:
             if key in self.data.raw_view:
                 persist = self.data.raw_view[key][0]
@@ -106,8 +235,12 @@ class DatasetDB(TaskObject):
                 metadata = {}
         self.data[key] = (persist, value, metadata)
         self.pending_keys.add(key)
+        self._changed(key)
 
     def delete(self, key):
+        if self.unloaded_keys:
+            self._load(key)
         del self.data[key]
         self.pending_keys.add(key)
+        self._changed(key)
     #
@@ -1,11 +1,15 @@
 import asyncio
 import os
+import hashlib
 import tempfile
 import shutil
 import time
 import logging
 
 from sipyco.sync_struct import Notifier, update_from_dict
+from sipyco import pyon
+
+from artiq import __version__ as artiq_version
 
 from artiq.master.worker import (Worker, WorkerInternalException,
                                  log_worker_exception)
@@ -15,19 +19,132 @@ from artiq.tools import get_windows_drives, exc_to_warning
 logger = logging.getLogger(__name__)
 
 
+def _blob_id(path):
+    # Same as the Git blob ID of the file contents, so that entries computed
+    # for a Git checkout match those of other checkouts of the same blob.
+    with open(path, "rb") as f:
+        data = f.read()
+    h = hashlib.sha1()
+    h.update("blob {}\0".format(len(data)).encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+class _ExamineCache:
+    """Persistent cache of experiment file descriptions, indexed by the
+    Git blob ID of the file contents.
+
+    Each entry also records the blob IDs of the modules from the repository
+    that were imported when the file was examined, and is only valid while
+    those are unchanged. Descriptions that depend on other state (datasets,
+    the device database) are not tracked.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = dict()
+        self.used = set()
+        try:
+            data = pyon.load_file(filename)
+        except FileNotFoundError:
+            return
+        except:
+            logger.warning("failed to load examine cache '%s', ignoring",
+                           filename, exc_info=True)
+            return
+        if data.get("artiq_version") == artiq_version:
+            self.entries = data["entries"]
+
+    def get(self, root, blob_id):
+        try:
+            dependencies, description = self.entries[blob_id]
+        except KeyError:
+            return None
+        for dependency, dependency_id in dependencies.items():
+            try:
+                if _blob_id(os.path.join(root, dependency)) != dependency_id:
+                    return None
+            except OSError:
+                return None
+        self.used.add(blob_id)
+        return description
+
+    def set(self, blob_id, dependencies, description):
+        self.entries[blob_id] = dependencies, description
+        self.used.add(blob_id)
+
+    def save(self):
+        # Only keep the entries of the last scan, to bound the cache size.
+        self.entries = {k: v for k, v in self.entries.items() if k in self.used}
+        self.used = set()
+        pyon.store_file(self.filename, {
+            "artiq_version": artiq_version,
+            "entries": self.entries
+        })
+
+
 class _RepoScanner:
-    def __init__(self, worker_handlers):
+    def __init__(self, worker_handlers, max_workers=1, cache=None):
         self.worker_handlers = worker_handlers
-        self.worker = None
-
-    async def process_file(self, entry_dict, root, filename):
-        logger.debug("processing file %s %s", root, filename)
+        self.max_workers = max_workers
+        self.cache = cache
+
+    async def _examine(self, root, filename):
+        # Workers are kept in a queue with max_workers slots; an empty slot
+        # holds None and is filled with a new worker on demand.
+        worker = await self.workers.get()
+        if worker is None:
+            worker = Worker(self.worker_handlers)
         try:
-            description = await self.worker.examine(
+            description = await worker.examine(
                 "scan", os.path.join(root, filename))
+            dependencies = worker.examine_dependencies
         except:
             log_worker_exception()
+            # restart worker
+            await worker.close()
+            worker = None
             raise
+        finally:
+            self.workers.put_nowait(worker)
+        return description, dependencies
+
+    async def process_file(self, root, filename):
+        logger.debug("processing file %s %s", root, filename)
+        if self.cache is None:
+            description, _ = await self._examine(root, filename)
+            return description
+
+        blob_id = _blob_id(os.path.join(root, filename))
+        description = self.cache.get(root, blob_id)
+        if description is not None:
+            return description
+        description, dependencies = await self._examine(root, filename)
+        # record the modules from the repository imported by the file
+        root_prefix = os.path.join(os.path.realpath(root), "")
+        dependency_ids = dict()
+        for dependency in dependencies:
+            dependency = os.path.realpath(dependency)
+            if (dependency.startswith(root_prefix)
+                    and os.path.isfile(dependency)):
+                dependency = os.path.relpath(dependency, root_prefix)
+                dependency_ids[dependency] = _blob_id(
+                    os.path.join(root, dependency))
+        self.cache.set(blob_id, dependency_ids, description)
+        return description
+
+    def _walk(self, root, subdir=""):
+        tree = []
+        for de in os.scandir(os.path.join(root, subdir)):
+            if de.name.startswith("."):
+                continue
+            if de.is_file() and de.name.endswith(".py"):
+                tree.append((de.name, None))
+            if de.is_dir():
+                tree.append((de.name,
+                             self._walk(root, os.path.join(subdir, de.name))))
+        return tree
+
+    def _add_entries(self, entry_dict, filename, description):
         for class_name, class_desc in description.items():
             name = class_desc["name"]
             if "/" in name:
@@ -52,42 +169,81 @@ class _RepoScanner:
             }
             entry_dict[name] = entry
 
-    async def _scan(self, root, subdir=""):
+    def _collect(self, tree, descriptions, subdir=""):
         entry_dict = dict()
-        for de in os.scandir(os.path.join(root, subdir)):
-            if de.name.startswith("."):
-                continue
-            if de.is_file() and de.name.endswith(".py"):
-                filename = os.path.join(subdir, de.name)
-                try:
-                    await self.process_file(entry_dict, root, filename)
-                except Exception as exc:
+        for name, subtree in tree:
+            if subtree is None:
+                filename = os.path.join(subdir, name)
+                exc = descriptions[filename].exception()
+                if exc is not None:
                     logger.warning("Skipping file '%s'", filename,
-                        exc_info=not isinstance(exc, WorkerInternalException))
-                    # restart worker
-                    await self.worker.close()
-                    self.worker = Worker(self.worker_handlers)
-            if de.is_dir():
-                subentries = await self._scan(
-                    root, os.path.join(subdir, de.name))
-                entries = {de.name + "/" + k: v for k, v in subentries.items()}
+                        exc_info=None if isinstance(exc, WorkerInternalException)
+                                 else exc)
+                else:
+                    self._add_entries(entry_dict, filename,
+                                      descriptions[filename].result())
+            else:
+                subentries = self._collect(
+                    subtree, descriptions, os.path.join(subdir, name))
+                entries = {name + "/" + k: v for k, v in subentries.items()}
                 entry_dict.update(entries)
         return entry_dict
 
+    def _process_tree(self, root, tree, descriptions, subdir=""):
+        for name, subtree in tree:
+            filename = os.path.join(subdir, name)
+            if subtree is None:
+                descriptions[filename] = asyncio.ensure_future(
+                    self.process_file(root, filename))
+            else:
+                self._process_tree(root, subtree, descriptions, filename)
+
     async def scan(self, root, subdir=""):
-        self.worker = Worker(self.worker_handlers)
+        """Examines all experiment files below ``subdir`` using up to
+        ``max_workers`` worker processes in parallel.
+
+        The entries are named and de-duplicated in directory order,
+        independently of the order in which the files have been examined."""
+        self.workers = asyncio.Queue()
+        for _ in range(self.max_workers):
+            self.workers.put_nowait(None)
+        tree = self._walk(root, subdir)
+        descriptions = dict()
         try:
-            r = await self._scan(root, subdir)
+            self._process_tree(root, tree, descriptions, subdir)
+            if descriptions:
+                await asyncio.wait(descriptions.values())
         finally:
-            await self.worker.close()
+            for description in descriptions.values():
+                description.cancel()
+            while not self.workers.empty():
+                worker = self.workers.get_nowait()
+                if worker is not None:
+                    await worker.close()
+        r = self._collect(tree, descriptions, subdir)
+        if self.cache is not None:
+            self.cache.save()
         return r
 
 
 class ExperimentDB:
-    def __init__(self, repo_backend, worker_handlers, experiment_subdir=""):
+    """Maintains the list of experiments of the repository.
+
+    Repository scans examine up to ``scan_workers`` files in parallel. If
+    ``examine_cache`` is the name of a file, the descriptions of experiment
+    files are kept there and files are only examined again once they or the
+    repository modules they import have changed.
+    """
+    def __init__(self, repo_backend, worker_handlers, experiment_subdir="",
+                 scan_workers=4, examine_cache=None):
         self.repo_backend = repo_backend
         self.worker_handlers = worker_handlers
         self.experiment_subdir = experiment_subdir
+        self.scan_workers = scan_workers
+        if examine_cache is None:
+            self.examine_cache = None
+        else:
+            self.examine_cache = _ExamineCache(examine_cache)
 
         self.cur_rev = self.repo_backend.get_head_rev()
         self.repo_backend.request_rev(self.cur_rev)
@@ -116,8 +272,9 @@ class ExperimentDB:
             self.cur_rev = new_cur_rev
             self.status["cur_rev"] = new_cur_rev
             t1 = time.monotonic()
-            new_explist = await _RepoScanner(self.worker_handlers).scan(
-                wd, self.experiment_subdir)
+            new_explist = await _RepoScanner(
+                self.worker_handlers, self.scan_workers,
+                self.examine_cache).scan(wd, self.experiment_subdir)
             logger.info("repository scan took %d seconds", time.monotonic()-t1)
             update_from_dict(self.explist, new_explist)
         finally:
@@ -0,0 +1,238 @@
+"""Publication of notifiers to sync_struct subscribers.
+
+:class:`CoalescingPublisher` serves the same protocol as
+:class:`sipyco.sync_struct.Publisher`, with a queue per subscriber that
+does not grow without bound when the subscriber reads slowly. For selected
+notifiers (typically the datasets), modifications are sent after a delay,
+during which those to the same top-level key are merged, and a key that
+accumulates too many modifications is sent again as a whole instead. For
+the other notifiers, a subscriber that falls too far behind is
+disconnected, and receives the current contents when it reconnects.
+"""
+
+import asyncio
+import logging
+
+from sipyco.sync_struct import ModAction
+from sipyco.asyncio_tools import AsyncioServer
+from sipyco import pyon
+
+
+logger = logging.getLogger(__name__)
+
+
+_protocol_banner = b"ARTIQ sync_struct\n"
+
+
+def _encode(obj):
+    return (pyon.encode(obj) + "\n").encode()
+
+
+class _Subscriber:
+    """Modifications pending for one subscriber of a notifier.
+
+    If ``coalesce`` is false, modifications are kept in order, up to
+    ``max_pending`` of them: beyond that, the queue is dropped and
+    ``overflow`` is set. Otherwise, they are kept in order for each
+    top-level key of the notifier, and the keys may be sent in any order."""
+    def __init__(self, notifier, coalesce, max_backlog, peer=None,
+                 max_pending=None):
+        self.notifier = notifier
+        self.coalesce = coalesce
+        self.max_backlog = max_backlog
+        self.max_pending = max_pending
+        self.peer = peer
+        self.event = asyncio.Event()
+        self.overflow = False
+
+        # coalesce=False: list of encoded lines
+        # coalesce=True: dict of key -> list of [merge_id, line], or None if
+        # the key is to be sent as a whole
+        self.pending = dict() if coalesce else []
+        self.depth = 0
+        self.stats = {
+            "sent": 0,
+            "merged": 0,
+            "collapsed": 0
+        }
+
+    def add(self, mod, line):
+        if not self.coalesce:
+            if self.overflow:
+                return
+            if self.max_pending is not None and self.depth >= self.max_pending:
+                self.overflow = True
+                self.pending = []
+                self.depth = 0
+                self.event.set()
+                return
+            self.pending.append(line)
+            self.depth += 1
+            self.event.set()
+            return
+
+        if mod["path"]:
+            key = mod["path"][0]
+        else:
+            key = mod["key"]
+        if key in self.pending:
+            entries = self.pending[key]
+            if entries is None:
+                # the current contents will be sent
+                self.stats["merged"] += 1
+                return
+        else:
+            entries = self.pending[key] = []
+
+        merge_id = None
+        if mod["action"] == ModAction.setitem.value:
+            merge_id = (tuple(mod["path"]), mod["key"])
+        if not mod["path"]:
+            # replaces the whole dataset
+            self.stats["merged"] += len(entries)
+            self.depth -= len(entries)
+            entries.clear()
+        elif (merge_id is not None and entries
+                and entries[-1][0] == merge_id):
+            self.stats["merged"] += 1
+            entries[-1][1] = line
+            return
+
+        if len(entries) >= self.max_backlog:
+            self.stats["merged"] += len(entries)
+            self.stats["collapsed"] += 1
+            self.depth -= len(entries) - 1
+            self.pending[key] = None
+        else:
+            entries.append([merge_id, line])
+            self.depth += 1
+        self.event.set()
+
+    def _current(self, key):
+        raw_view = self.notifier.raw_view
+        if key in raw_view:
+            mod = {"action": ModAction.setitem.value, "path": [],
+                   "key": key, "value": raw_view[key]}
+        else:
+            mod = {"action": ModAction.delitem.value, "path": [], "key": key}
+        return _encode(mod)
+
+    def take(self):
+        """Returns the pending lines, and empties the queue."""
+        if self.coalesce:
+            lines = []
+            for key, entries in self.pending.items():
+                if entries is None:
+                    lines.append(self._current(key))
+                else:
+                    lines += [line for _, line in entries]
+            self.pending = dict()
+        else:
+            lines = self.pending
+            self.pending = []
+        self.depth = 0
+        self.event.clear()
+        self.stats["sent"] += len(lines)
+        return lines
+
+
+class CoalescingPublisher(AsyncioServer):
+    """A replacement for :class:`sipyco.sync_struct.Publisher`.
+
+    :param notifiers: Dictionary of notifiers to publish, by name.
+    :param coalesced: Names of the notifiers whose modifications are
+        coalesced.
+    :param window: Delay in seconds before modifications of coalesced
+        notifiers are sent to each subscriber.
+    :param max_backlog: Maximum number of modifications of a top-level key
+        pending for a subscriber, beyond which the key is sent as a whole.
+    :param max_pending: Maximum number of modifications of a notifier that
+        is not coalesced pending for a subscriber, beyond which the
+        subscriber is disconnected.
+    :param before_init: Functions called, by notifier name, before the
+        contents of the notifier are sent to a new subscriber, e.g. to add
+        contents that are loaded lazily.
+    """
+    def __init__(self, notifiers, coalesced=(), window=0.1, max_backlog=100,
+                 max_pending=10000, before_init={}):
+        AsyncioServer.__init__(self)
+        self.notifiers = notifiers
+        self.coalesced = set(coalesced)
+        self.before_init = before_init
+        self.window = window
+        self.max_backlog = max_backlog
+        self.max_pending = max_pending
+
+        self._subscribers = {k: set() for k in notifiers.keys()}
+        for name, notifier in notifiers.items():
+            notifier.publish = self._make_publish(name)
+
+    def _make_publish(self, name):
+        subscribers = self._subscribers[name]
+        def publish(mod):
+            if not subscribers:
+                return
+            line = _encode(mod)
+            for subscriber in subscribers:
+                subscriber.add(mod, line)
+        return publish
+
+    async def _handle_connection_cr(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if line != _protocol_banner:
+                return
+            line = await reader.readline()
+            if not line:
+                return
+            name = line.decode()[:-1]
+            try:
+                notifier = self.notifiers[name]
+            except KeyError:
+                return
+
+            if name in self.before_init:
+                self.before_init[name]()
+            writer.write(_encode({"action": ModAction.init.value,
+                                  "struct": notifier.raw_view}))
+            coalesce = name in self.coalesced
+            subscriber = _Subscriber(notifier, coalesce, self.max_backlog,
+                                     writer.get_extra_info("peername"),
+                                     self.max_pending)
+            self._subscribers[name].add(subscriber)
+            try:
+                while True:
+                    await subscriber.event.wait()
+                    if subscriber.overflow:
+                        logger.warning("disconnecting subscriber %s of %s, "
+                                       "which is too slow to read "
+                                       "modifications", subscriber.peer, name)
+                        return
+                    if coalesce and self.window:
+                        await asyncio.sleep(self.window)
+                    writer.writelines(subscriber.take())
+                    # Modifications published while the subscriber is
+                    # slow to read accumulate in its queue, where they are
+                    # coalesced or, past max_pending, cause a disconnection.
+                    await writer.drain()
+            finally:
+                self._subscribers[name].remove(subscriber)
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            # subscribers disconnecting are a normal occurrence
+            pass
+        finally:
+            writer.close()
+
+    def get_subscriber_stats(self):
+        """Returns a list with, for each subscriber, the name of the notifier,
+        the address of the subscriber, the number of modifications waiting
+        to be sent, and counters of modifications sent, merged, and keys
+        sent as a whole."""
+        r = []
+        for name, subscribers in self._subscribers.items():
+            for subscriber in subscribers:
+                stats = {"notifier": name, "peer": subscriber.peer,
+                         "depth": subscriber.depth}
+                stats.update(subscriber.stats)
+                r.append(stats)
+        return r
@@ -0,0 +1,216 @@
+"""Index of the runs stored in a results directory.
+
+The index is a SQLite database at the root of the results directory. The
+worker adds each run when it writes its results file; existing results
+directories can be indexed with :meth:`ResultsIndex.scan`.
+"""
+
+import os
+import re
+import sqlite3
+import logging
+
+import h5py
+
+from sipyco import pyon
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_FILENAME = "index.db"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    rid INTEGER PRIMARY KEY,
+    class_name TEXT,
+    file TEXT,
+    results_file TEXT NOT NULL,
+    repo_rev TEXT,
+    start_time REAL,
+    run_time REAL,
+    artiq_version TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_class_name ON runs (class_name);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+CREATE TABLE IF NOT EXISTS datasets (
+    rid INTEGER NOT NULL REFERENCES runs (rid) ON DELETE CASCADE,
+    archive INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    shape TEXT,
+    dtype TEXT,
+    PRIMARY KEY (rid, archive, name)
+);
+CREATE INDEX IF NOT EXISTS datasets_name ON datasets (name);
+"""
+
+_run_columns = ("rid", "class_name", "file", "results_file", "repo_rev",
+                "start_time", "run_time", "artiq_version")
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def describe_results(f):
+    """Returns the entry of the index for an open results file, without
+    the ``results_file`` item, as expected by :meth:`ResultsIndex.add`."""
+    expid = pyon.decode(_decode(f["expid"][()]))
+    datasets = []
+    for archive, group_name in enumerate(("datasets", "archive")):
+        if group_name not in f:
+            continue
+        for name, dataset in f[group_name].items():
+            if not isinstance(dataset, h5py.Dataset):
+                continue
+            datasets.append((bool(archive), name, dataset.shape,
+                             dataset.dtype.str))
+    run_time = f["run_time"][()] if "run_time" in f else None
+    return {
+        "rid": int(f["rid"][()]),
+        "class_name": expid.get("class_name"),
+        "file": expid.get("file"),
+        "repo_rev": expid.get("repo_rev"),
+        "start_time": float(f["start_time"][()]),
+        "run_time": None if run_time is None else float(run_time),
+        "artiq_version": _decode(f["artiq_version"][()]),
+        "datasets": datasets
+    }
+
+
+class ResultsIndex:
+    """Index of the runs in the results directory ``root``.
+
+    Several processes may update and query the index concurrently.
+    """
+    def __init__(self, root="results", filename=INDEX_FILENAME, timeout=10.0):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, filename),
+                                  timeout=timeout)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA foreign_keys=ON")
+            self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add(self, results_file, entry):
+        """Adds or replaces a run.
+
+        :param results_file: path of the results file, relative to the root
+            of the results directory.
+        :param entry: description of the run, as returned by
+            :func:`describe_results`.
+        """
+        run = [entry.get(column) for column in _run_columns]
+        run[_run_columns.index("results_file")] = results_file
+        with self.db:
+            self.db.execute("DELETE FROM runs WHERE rid = ?", (entry["rid"],))
+            self.db.execute(
+                "INSERT INTO runs ({}) VALUES ({})".format(
+                    ", ".join(_run_columns), ", ".join("?"*len(_run_columns))),
+                run)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?)",
+                [(entry["rid"], archive, name, pyon.encode(tuple(shape)),
+                  dtype)
+                 for archive, name, shape, dtype in entry["datasets"]])
+
+    def add_file(self, path):
+        """Indexes the results file at ``path``, relative to the root of the
+        results directory."""
+        with h5py.File(os.path.join(self.root, path), "r") as f:
+            self.add(path, describe_results(f))
+
+    def scan(self):
+        """Adds the results files of the results directory that are not
+        indexed yet. Returns the number of files added."""
+        indexed = {row[0] for row in
+                   self.db.execute("SELECT results_file FROM runs")}
+        n = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not re.fullmatch("\\d{9}-.*\\.h5", filename):
+                    continue
+                path = os.path.relpath(os.path.join(dirpath, filename),
+                                       self.root)
+                if path in indexed:
+                    continue
+                try:
+                    self.add_file(path)
+                except Exception:
+                    logger.warning("unable to index %s", path, exc_info=True)
+                else:
+                    n += 1
+        return n
+
+    def query(self, rid=None, class_name=None, file=None, repo_rev=None,
+              dataset=None, since=None, until=None, limit=None):
+        """Returns the runs that match all the given criteria, latest first,
+        as a list of dictionaries.
+
+        :param class_name: name of the experiment class.
+        :param file: experiment file, relative to the repository if the run
+            used one.
+        :param dataset: name of a dataset that the results contain (either
+            set by the experiment or read from the master and archived).
+        :param since: minimum start time, as a UNIX timestamp.
+        :param until: maximum start time, as a UNIX timestamp.
+        """
+        conditions = []
+        parameters = []
+        for column, value in (("rid", rid), ("class_name", class_name),
+                              ("file", file), ("repo_rev", repo_rev)):
+            if value is not None:
+                conditions.append("{} = ?".format(column))
+                parameters.append(value)
+        if dataset is not None:
+            conditions.append(
+                "rid IN (SELECT rid FROM datasets WHERE name = ?)")
+            parameters.append(dataset)
+        if since is not None:
+            conditions.append("start_time >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("start_time <= ?")
+            parameters.append(until)
+        sql = "SELECT * FROM runs"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY rid DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return [dict(row) for row in self.db.execute(sql, parameters)]
+
+    def get_datasets(self, rid):
+        """Returns the datasets of a run, as a list of dictionaries."""
+        r = []
+        for row in self.db.execute(
+                "SELECT archive, name, shape, dtype FROM datasets "
+                "WHERE rid = ? ORDER BY archive, name", (rid,)):
+            row = dict(row)
+            row["archive"] = bool(row["archive"])
+            row["shape"] = pyon.decode(row["shape"])
+            r.append(row)
+        return r
+
+    def get_path(self, rid):
+        """Returns the path of the results file of a run."""
+        row = self.db.execute("SELECT results_file FROM runs WHERE rid = ?",
+                              (rid,)).fetchone()
+        if row is None:
+            raise KeyError(rid)
+        return os.path.join(self.root, row[0])
@@ -2,13 +2,14 @@ import asyncio
 import logging
 import csv
 import os.path
+import heapq
 from enum import Enum
 from time import time
 
 from sipyco.sync_struct import Notifier
 from sipyco.asyncio_tools import TaskObject, Condition
 
-from artiq.master.worker import Worker, log_worker_exception
+from artiq.master.worker import Worker, WorkerPool, log_worker_exception
 from artiq.tools import asyncio_wait_or_cancel
 
 
@@ -29,7 +30,7 @@ class RunStatus(Enum):
 
 def _mk_worker_method(name):
     async def worker_method(self, *args, **kwargs):
-        if self.worker.closed.is_set():
+        if self.closed.is_set():
             return True
         m = getattr(self.worker, name)
         try:
@@ -37,7 +38,7 @@ def _mk_worker_method(name):
         except Exception as e:
             if isinstance(e, asyncio.CancelledError):
                 raise
-            if self.worker.closed.is_set():
+            if self.closed.is_set():
                 logger.debug("suppressing worker exception of terminated run",
                              exc_info=True)
                 # Return completion on termination
@@ -60,10 +61,17 @@ class Run:
         self.due_date = due_date
         self.flush = flush
 
-        self.worker = Worker(pool.worker_handlers)
+        # created, or taken from the worker pool, when the run is built, so
+        # that queued runs do not hold idle processes
+        self.worker = None
+        self._worker_handlers = pool.worker_handlers
+        self._worker_pool = pool.worker_pool
+        self.closed = asyncio.Event()
         self.termination_requested = False
 
         self._status = RunStatus.pending
+        self._pool = pool
+        self._index_entry = None
 
         notification = {
             "pipeline": self.pipeline_name,
@@ -85,7 +93,8 @@ class Run:
     @status.setter
     def status(self, value):
         self._status = value
-        if not self.worker.closed.is_set():
+        self._pool.update_index(self)
+        if not self.closed.is_set():
             self._notifier[self.rid]["status"] = self._status.name
         self._state_changed.notify()
 
@@ -98,15 +107,29 @@ class Run:
 
     async def close(self):
         # called through pool
-        await self.worker.close()
+        self.closed.set()
+        if self.worker is not None and (
+                self._worker_pool is None
+                or not self._worker_pool.put(self.worker)):
+            await self.worker.close()
         del self._notifier[self.rid]
 
     _build = _mk_worker_method("build")
 
     async def build(self):
+        if self.closed.is_set():
+            return
+        warm = False
+        if self._worker_pool is not None:
+            self.worker = self._worker_pool.get()
+            warm = self.worker.ipc is not None
+        else:
+            self.worker = Worker(self._worker_handlers)
         await self._build(self.rid, self.pipeline_name,
                           self.wd, self.expid,
                           self.priority)
+        if self._worker_pool is not None:
+            self._worker_pool.record_build(self.worker, warm)
 
     prepare = _mk_worker_method("prepare")
     run = _mk_worker_method("run")
@@ -115,12 +138,23 @@ class Run:
 
 
 class RunPool:
-    def __init__(self, ridc, worker_handlers, notifier, experiment_db, log_submissions):
+    def __init__(self, ridc, worker_handlers, notifier, experiment_db, log_submissions,
+                 worker_pool=None):
         self.runs = dict()
         self.state_changed = Condition()
 
+        # Runs are indexed by status, in heaps of [negated priority key, run]
+        # entries. Pending runs whose due date has not elapsed yet are kept
+        # in a separate heap of [due date, negated priority key, run] entries.
+        # Entries are invalidated by setting their run to None, and
+        # discarded when they reach the top of their heap.
+        self._heaps = {status: [] for status in RunStatus}
+        self._waiting = []
+        self._entry_count = 0
+
         self.ridc = ridc
         self.worker_handlers = worker_handlers
+        self.worker_pool = worker_pool
         self.notifier = notifier
         self.experiment_db = experiment_db
         self.log_submissions = log_submissions
@@ -151,6 +185,7 @@ class RunPool:
         if self.log_submissions is not None:          
             self.log_submission(rid, expid)
         self.runs[rid] = run
+        self.update_index(run)
         self.state_changed.notify()
         return rid
 
@@ -163,6 +198,77 @@ class RunPool:
         if "repo_rev" in run.expid:
             self.experiment_db.repo_backend.release_rev(run.expid["repo_rev"])
         del self.runs[rid]
+        self._invalidate_index_entry(run)
+
+    def _invalidate_index_entry(self, run):
+        if run._index_entry is not None:
+            run._index_entry[-1] = None
+            run._index_entry = None
+
+    def update_index(self, run):
+        """Moves a run to the index of its current status. Called when the
+        status of the run changes."""
+        self._invalidate_index_entry(run)
+        if run.rid not in self.runs:
+            return
+        neg_key = tuple(-k for k in run.priority_key())
+        if (run.status == RunStatus.pending
+                and run.due_date is not None and run.due_date >= time()):
+            entry = [run.due_date, neg_key, run]
+            heapq.heappush(self._waiting, entry)
+        else:
+            entry = [neg_key, run]
+            heapq.heappush(self._heaps[run.status], entry)
+        run._index_entry = entry
+        self._entry_count += 1
+        # Rebuild the heaps when they are mostly made of invalid entries.
+        if self._entry_count > 2*len(self.runs) + 64:
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._heaps = {status: [] for status in RunStatus}
+        self._waiting = []
+        self._entry_count = 0
+        for run in self.runs.values():
+            run._index_entry = None
+        for run in list(self.runs.values()):
+            self.update_index(run)
+
+    @staticmethod
+    def _clean_top(heap):
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+
+    def _promote_due_runs(self, now):
+        while True:
+            self._clean_top(self._waiting)
+            if not self._waiting or self._waiting[0][0] >= now:
+                break
+            self.update_index(self._waiting[0][-1])
+
+    def get_max_run(self, status):
+        """Returns the run with the given status that has the highest
+        priority key, or None.
+
+        For pending runs, only those the due date of which has elapsed are
+        considered."""
+        if status == RunStatus.pending:
+            self._promote_due_runs(time())
+        heap = self._heaps[status]
+        self._clean_top(heap)
+        if heap:
+            return heap[0][-1]
+        else:
+            return None
+
+    def get_next_due_date(self):
+        """Returns the earliest due date of the pending runs that are not
+        runnable yet, or None."""
+        self._clean_top(self._waiting)
+        if self._waiting:
+            return self._waiting[0][0]
+        else:
+            return None
 
 
 class PrepareStage(TaskObject):
@@ -175,33 +281,21 @@ class PrepareStage(TaskObject):
         float giving the time until the next check, or None if no time-based
         check is required.
 
-        The latter can be the case if there are no due-date runs, or none
-        of them are going to become next-in-line before further pool state
-        changes (which will also cause a re-evaluation).
+        The latter can be the case if there are no due-date runs.
         """
-        pending_runs = list(
-            filter(lambda r: r.status == RunStatus.pending,
-                   self.pool.runs.values()))
-
-        now = time()
-        def is_runnable(r):
-            return (r.due_date or 0) < now
-
-        prepared_max = max((r.priority_key() for r in self.pool.runs.values()
-                            if r.status == RunStatus.prepare_done),
-                           default=None)
-        def takes_precedence(r):
-            return prepared_max is None or r.priority_key() > prepared_max
-
-        candidate = max(filter(is_runnable, pending_runs),
-                        key=lambda r: r.priority_key(),
-                        default=None)
-        if candidate is not None and takes_precedence(candidate):
+        prepared = self.pool.get_max_run(RunStatus.prepare_done)
+        candidate = self.pool.get_max_run(RunStatus.pending)
+        if candidate is not None and (
+                prepared is None
+                or candidate.priority_key() > prepared.priority_key()):
             return candidate
 
-        return min((r.due_date - now for r in pending_runs
-                    if (not is_runnable(r) and takes_precedence(r))),
-                   default=None)
+        # This may wake up the stage for a run that does not take precedence
+        # over the prepared ones; it is then simply re-evaluated.
+        due_date = self.pool.get_next_due_date()
+        if due_date is None:
+            return None
+        return max(due_date - time(), 0.0)
 
     async def _do(self):
         while True:
@@ -220,12 +314,12 @@ class PrepareStage(TaskObject):
                                   or r is run
                                   for r in self.pool.runs.values()):
                         ev = [self.pool.state_changed.wait(),
-                              run.worker.closed.wait()]
+                              run.closed.wait()]
                         await asyncio_wait_or_cancel(
                             ev, return_when=asyncio.FIRST_COMPLETED)
-                        if run.worker.closed.is_set():
+                        if run.closed.is_set():
                             break
-                    if run.worker.closed.is_set():
+                    if run.closed.is_set():
                         continue
                 run.status = RunStatus.preparing
                 try:
@@ -246,14 +340,7 @@ class RunStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                               self.pool.runs.values())
-        try:
-            r = max(prepared_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # prepared_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.get_max_run(RunStatus.prepare_done)
 
     async def _do(self):
         stack = []
@@ -300,14 +387,7 @@ class AnalyzeStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        run_runs = filter(lambda r: r.status == RunStatus.run_done,
-                          self.pool.runs.values())
-        try:
-            r = max(run_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # run_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.get_max_run(RunStatus.run_done)
 
     async def _do(self):
         while True:
@@ -326,8 +406,10 @@ class AnalyzeStage(TaskObject):
 
 
 class Pipeline:
-    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db, log_submissions):
-        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db, log_submissions)
+    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db, log_submissions,
+                 worker_pool=None):
+        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db, log_submissions,
+                            worker_pool)
         self._prepare = PrepareStage(self.pool, deleter.delete)
         self._run = RunStage(self.pool, deleter.delete)
         self._analyze = AnalyzeStage(self.pool, deleter.delete)
@@ -398,7 +480,19 @@ class Deleter(TaskObject):
 
 
 class Scheduler:
-    def __init__(self, ridc, worker_handlers, experiment_db, log_submissions):
+    """Manages the pipelines of the master.
+
+    ``worker_pool_size`` pre-started worker processes are kept idle for each
+    pipeline, to avoid the start-up time of the worker in the prepare stage;
+    ``worker_pool_sizes`` maps pipeline names to sizes that override this
+    default. The pools of pipelines listed there are started together with
+    the scheduler, the others when a pipeline is first used. Pools survive
+    the garbage collection of their pipeline. Each worker process is used
+    for at most ``worker_pool_max_runs`` runs before being replaced.
+    """
+    def __init__(self, ridc, worker_handlers, experiment_db, log_submissions,
+                 worker_pool_size=0, worker_pool_sizes=None,
+                 worker_pool_max_runs=1):
         self.notifier = Notifier(dict())
 
         self._pipelines = dict()
@@ -410,9 +504,35 @@ class Scheduler:
         self._deleter = Deleter(self._pipelines)
         self._log_submissions = log_submissions
 
+        self._worker_pool_size = worker_pool_size
+        if worker_pool_sizes is None:
+            worker_pool_sizes = dict()
+        self._worker_pool_sizes = worker_pool_sizes
+        self._worker_pool_max_runs = worker_pool_max_runs
+        self._worker_pools = dict()
+
     def start(self, *, loop=None):
         self._loop = loop
         self._deleter.start(loop=self._loop)
+        for pipeline_name in self._worker_pool_sizes.keys():
+            self._get_worker_pool(pipeline_name)
+
+    def _get_worker_pool(self, pipeline_name):
+        try:
+            return self._worker_pools[pipeline_name]
+        except KeyError:
+            pass
+        size = self._worker_pool_sizes.get(pipeline_name,
+                                           self._worker_pool_size)
+        if size <= 0:
+            return None
+        logger.debug("creating worker pool of size %d for pipeline '%s'",
+                     size, pipeline_name)
+        worker_pool = WorkerPool(self._worker_handlers, size,
+                                 self._worker_pool_max_runs)
+        worker_pool.start(loop=self._loop)
+        self._worker_pools[pipeline_name] = worker_pool
+        return worker_pool
 
     async def stop(self):
         # NB: restart of a stopped scheduler is not supported
@@ -424,6 +544,8 @@ class Scheduler:
         await self._deleter.stop()
         if self._pipelines:
             logger.warning("some pipelines were not garbage-collected")
+        for worker_pool in self._worker_pools.values():
+            await worker_pool.stop()
 
     def submit(self, pipeline_name, expid, priority=0, due_date=None, flush=False):
         """Submits a new run.
@@ -441,7 +563,8 @@ class Scheduler:
             logger.debug("creating pipeline '%s'", pipeline_name)
             pipeline = Pipeline(self._ridc, self._deleter,
                                 self._worker_handlers, self.notifier,
-                                self._experiment_db, self._log_submissions)
+                                self._experiment_db, self._log_submissions,
+                                self._get_worker_pool(pipeline_name))
             self._pipelines[pipeline_name] = pipeline
             pipeline.start(loop=self._loop)
         return pipeline.pool.submit(expid, priority, due_date, flush, pipeline_name)
@@ -468,6 +591,14 @@ class Scheduler:
         Must not be modified."""
         return self.notifier.raw_view
 
+    def get_worker_pool_stats(self):
+        """Returns, for each pipeline with a worker pool, the number of
+        idle, spawned, reused and retired workers, and the number and mean
+        build latency (from the request to build the run to the end of the
+        build stage, in seconds) of runs on warm and cold workers."""
+        return {name: worker_pool.get_stats()
+                for name, worker_pool in self._worker_pools.items()}
+
     def check_pause(self, rid):
         """Returns ``True`` if there is a condition that could make ``pause``
         not return immediately (termination requested or higher priority run).
@@ -488,12 +619,8 @@ class Scheduler:
                 if run.termination_requested:
                     return True
 
-                prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                                       pipeline.pool.runs.values())
-                try:
-                    r = max(prepared_runs, key=lambda r: r.priority_key())
-                except ValueError:
-                    # prepared_runs is an empty sequence
+                r = pipeline.pool.get_max_run(RunStatus.prepare_done)
+                if r is None:
                     return False
                 return r.priority_key() > run.priority_key()
         raise KeyError("RID not found")
@@ -4,12 +4,15 @@ import asyncio
 import logging
 import subprocess
 import time
+from collections import deque
 
-from sipyco import pipe_ipc, pyon
+from sipyco import pipe_ipc
 from sipyco.logging_tools import LogParser
 from sipyco.packed_exceptions import current_exc_packed
+from sipyco.asyncio_tools import TaskObject
 
 from artiq.tools import asyncio_wait_or_cancel
+from artiq.master import worker_ipc
 
 
 logger = logging.getLogger(__name__)
@@ -42,15 +45,30 @@ def log_worker_exception():
 
 
 class Worker:
-    def __init__(self, handlers=dict(), send_timeout=10.0):
+    def __init__(self, handlers=dict(), send_timeout=10.0, binary_ipc=True):
         self.handlers = handlers
         self.send_timeout = send_timeout
+        # send large arrays out of band (see artiq.master.worker_ipc)
+        self.binary_ipc = binary_ipc
 
         self.rid = None
         self.filename = None
         self.ipc = None
         self.watchdogs = dict()  # wid -> expiration (using time.monotonic)
 
+        self.spawn_time = None  # time.monotonic() at process creation
+        self.build_latency = None  # seconds between build request and end
+        self.completed_runs = 0
+        self.run_finished = False
+        # cleared when the process reports that it may hold state of a
+        # previous run that it cannot reset
+        self.reusable = True
+
+        # datasets of which the worker may hold a copy
+        self._cached_datasets = set()
+        self._cached_dataset_prefixes = set()
+        self._watching_datasets = False
+
         self.io_lock = asyncio.Lock()
         self.closed = asyncio.Event()
 
@@ -86,11 +104,17 @@ class Worker:
             self.ipc = pipe_ipc.AsyncioParentComm()
             env = os.environ.copy()
             env["PYTHONUNBUFFERED"] = "1"
+            args = [self.ipc.get_address(), str(log_level)]
+            if self.binary_ipc:
+                args.append("binary_ipc")
+            if all(handler in self.handlers for handler in
+                   ("get_datasets", "watch_datasets", "unwatch_datasets")):
+                args.append("dataset_cache")
             await self.ipc.create_subprocess(
-                sys.executable, "-m", "artiq.master.worker_impl",
-                self.ipc.get_address(), str(log_level),
+                sys.executable, "-m", "artiq.master.worker_impl", *args,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                 env=env, start_new_session=True)
+            self.spawn_time = time.monotonic()
             asyncio.ensure_future(
                 LogParser(self._get_log_source).stream_task(
                     self.ipc.process.stdout))
@@ -107,6 +131,9 @@ class Worker:
         This method should always be called by the user to clean up, even if
         build() or examine() raises an exception."""
         self.closed.set()
+        if self._watching_datasets:
+            self.handlers["unwatch_datasets"](self._dataset_changed)
+            self._watching_datasets = False
         await self.io_lock.acquire()
         try:
             if self.ipc is None:
@@ -157,8 +184,8 @@ class Worker:
 
     async def _send(self, obj, cancellable=True):
         assert self.io_lock.locked()
-        line = pyon.encode(obj)
-        self.ipc.write((line + "\n").encode())
+        for data in worker_ipc.encode(obj, self.binary_ipc):
+            self.ipc.write(data)
         ifs = [self.ipc.drain()]
         if cancellable:
             ifs.append(self.closed.wait())
@@ -176,10 +203,42 @@ class Worker:
                 "Data transmission to worker cancelled (RID {})".format(
                     self.rid))
 
+    async def _read_exactly(self, n):
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        pos = 0
+        while pos < n:
+            data = await self.ipc.read(n - pos)
+            if not data:
+                return None
+            view[pos:pos+len(data)] = data
+            pos += len(data)
+        return buffer
+
+    async def _read_message(self):
+        # Returns the PYON payload and out-of-band buffers of the next
+        # message, or None if the worker has ended.
+        line = await self.ipc.readline()
+        if not line:
+            return None
+        try:
+            lengths = worker_ipc.parse_frame_header(line)
+        except ValueError:
+            return line, []
+        if lengths is None:
+            return line, []
+        parts = []
+        for n in lengths:
+            part = await self._read_exactly(n)
+            if part is None:
+                return None
+            parts.append(part)
+        return parts[0], parts[1:]
+
     async def _recv(self, timeout):
         assert self.io_lock.locked()
         fs = await asyncio_wait_or_cancel(
-            [self.ipc.readline(), self.closed.wait()],
+            [self._read_message(), self.closed.wait()],
             timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
         if all(f.cancelled() for f in fs):
             raise WorkerTimeout(
@@ -188,13 +247,13 @@ class Worker:
             raise WorkerError(
                 "Receiving data from worker cancelled (RID {})".format(
                     self.rid))
-        line = fs[0].result()
-        if not line:
+        message = fs[0].result()
+        if message is None:
             raise WorkerError(
                 "Worker ended while attempting to receive data (RID {})".
                 format(self.rid))
         try:
-            obj = pyon.decode(line.decode())
+            obj = worker_ipc.decode(*message)
         except:
             raise WorkerError("Worker sent invalid PYON data (RID {})".format(
                 self.rid))
@@ -212,6 +271,8 @@ class Worker:
                 raise WorkerWatchdogTimeout
             action = obj["action"]
             if action == "completed":
+                if not obj.get("reusable", True):
+                    self.reusable = False
                 return True
             elif action == "pause":
                 return False
@@ -223,22 +284,71 @@ class Worker:
                 func = self.delete_watchdog
             elif action == "register_experiment":
                 func = self.register_experiment
+            elif action == "register_dependencies":
+                func = self.register_dependencies
+            elif action == "update_dataset_batch":
+                func = self._update_dataset_batch
+            elif action == "get_datasets":
+                func = self._get_datasets
             else:
                 func = self.handlers[action]
             try:
                 data = func(*obj["args"], **obj["kwargs"])
                 reply = {"status": "ok", "data": data}
+                if action == "get_datasets":
+                    # the worker may keep the datasets until invalidated
+                    reply["cache"] = True
             except:
+                if not obj.get("reply", True):
+                    logger.warning("failed to process '%s' request from "
+                                   "worker (RID %s)", action, self.rid,
+                                   exc_info=True)
                 reply = {
                     "status": "failed",
                     "exception": current_exc_packed()
                 }
+            if not obj.get("reply", True):
+                continue
             await self.io_lock.acquire()
             try:
                 await self._send(reply)
             finally:
                 self.io_lock.release()
 
+    def _update_dataset_batch(self, mods):
+        # See artiq.master.worker_db.BatchPublisher for the merged mods.
+        update = self.handlers["update_dataset"]
+        for mod in mods:
+            if mod["action"] == "extend":
+                for x in mod["xs"]:
+                    update({"action": "append", "path": mod["path"], "x": x})
+            else:
+                update(mod)
+
+    def _get_datasets(self, keys, prefixes):
+        if not self._watching_datasets:
+            self.handlers["watch_datasets"](self._dataset_changed)
+            self._watching_datasets = True
+        datasets = self.handlers["get_datasets"](keys, prefixes)
+        self._cached_datasets.update(datasets.keys())
+        self._cached_dataset_prefixes.update(prefixes)
+        return datasets
+
+    def _dataset_changed(self, key):
+        if not (key in self._cached_datasets
+                or key.startswith(tuple(self._cached_dataset_prefixes))):
+            return
+        self._cached_datasets.discard(key)
+        if not self.is_alive():
+            return
+        # The message is written without waiting for io_lock, which is held
+        # while waiting for the worker. This is safe as messages are written
+        # without yielding to the event loop.
+        for data in worker_ipc.encode(
+                {"action": "invalidate_datasets", "keys": [key]},
+                self.binary_ipc):
+            self.ipc.write(data)
+
     async def _worker_action(self, obj, timeout=None):
         if timeout is not None:
             self.watchdogs[-1] = time.monotonic() + timeout
@@ -257,11 +367,21 @@ class Worker:
                 del self.watchdogs[-1]
         return completed
 
+    def is_alive(self):
+        """Returns ``True`` if the worker process has been created, is still
+        running, and the worker has not been closed."""
+        return (self.ipc is not None
+                and self.ipc.process.returncode is None
+                and not self.closed.is_set())
+
     async def build(self, rid, pipeline_name, wd, expid, priority,
                     timeout=15.0):
         self.rid = rid
         if "file" in expid:
             self.filename = os.path.basename(expid["file"])
+        self.run_finished = False
+        self.build_latency = None
+        t0 = time.monotonic()
         await self._create_process(expid["log_level"])
         await self._worker_action(
             {"action": "build",
@@ -271,6 +391,7 @@ class Worker:
              "expid": expid,
              "priority": priority},
             timeout)
+        self.build_latency = time.monotonic() - t0
 
     async def prepare(self):
         await self._worker_action({"action": "prepare"})
@@ -293,13 +414,20 @@ class Worker:
 
     async def analyze(self):
         await self._worker_action({"action": "analyze"})
+        self.completed_runs += 1
+        self.run_finished = True
 
     async def examine(self, rid, file, timeout=20.0):
+        """Returns the descriptions of the experiments in ``file``.
+
+        After completion, the ``examine_dependencies`` attribute contains the
+        list of the files of the modules imported by the experiment file."""
         self.rid = rid
         self.filename = os.path.basename(file)
 
         await self._create_process(logging.WARNING)
         r = dict()
+        self.examine_dependencies = []
 
         def register(class_name, name, arginfo, argument_ui,
                      scheduler_defaults):
@@ -309,8 +437,143 @@ class Worker:
                 "argument_ui": argument_ui,
                 "scheduler_defaults": scheduler_defaults
             }
+        def register_dependencies(files):
+            self.examine_dependencies = files
         self.register_experiment = register
+        self.register_dependencies = register_dependencies
         await self._worker_action({"action": "examine", "file": file},
                                   timeout)
         del self.register_experiment
+        del self.register_dependencies
         return r
+
+
+class WorkerPool(TaskObject):
+    """Maintains a set of pre-started idle worker processes.
+
+    Starting a worker process involves importing the worker implementation
+    and its dependencies (NumPy, h5py, the compiler, etc.), which takes a
+    significant amount of time. The pool keeps ``size`` such processes
+    ready in the background so that :meth:`get` can hand one out
+    immediately.
+
+    A worker that has completed the analyze stage of a run without error
+    may be returned to the pool with :meth:`put` and is then reused, until
+    it has served ``max_runs`` runs; after that, it is terminated and
+    replaced with a fresh process. Between runs, the process closes the
+    devices, recreates its device and dataset managers, removes the modules
+    of the repository and of the experiment directory and the log handlers
+    added by the run, and returns to its initial working directory. Modules
+    of ARTIQ and of the standard library imported by the run stay loaded.
+    A worker that failed, or whose run imported other modules (whose state
+    would be kept), is not reused. With the default of ``max_runs=1``, each
+    worker process is used for a single run only.
+
+    The log level of the pre-started processes is ``log_level``; it is
+    changed to that of the experiment when a run is built.
+    """
+    def __init__(self, handlers, size, max_runs=1, log_level=logging.WARNING):
+        self.handlers = handlers
+        self.size = size
+        self.max_runs = max_runs
+        self.log_level = log_level
+
+        self._idle = deque()
+        # workers handed out by get() that may be returned with put()
+        self._lent = set()
+        self._refill = asyncio.Event()
+        self._refill.set()
+        self.stats = {
+            "spawned": 0,
+            "warm": 0,
+            "cold": 0,
+            "reused": 0,
+            "retired": 0,
+            "warm_build_time": 0.0,
+            "cold_build_time": 0.0
+        }
+
+    def get(self):
+        """Returns an idle worker if one is available, or a new worker that
+        will start its process when the run is built otherwise."""
+        self._refill.set()
+        worker = None
+        while self._idle:
+            worker = self._idle.popleft()
+            if worker.is_alive():
+                break
+            logger.debug("discarding dead idle worker")
+            asyncio.ensure_future(worker.close())
+            worker = None
+        if worker is None:
+            worker = Worker(self.handlers)
+        if worker.completed_runs + 1 < self.max_runs:
+            self._lent.add(worker)
+        return worker
+
+    def put(self, worker):
+        """Attempts to return a worker to the pool after its run has
+        completed.
+
+        Returns ``True`` if the pool took ownership of the worker. Otherwise,
+        the caller remains responsible for closing it.
+        """
+        self._lent.discard(worker)
+        if (worker.run_finished and worker.is_alive() and worker.reusable
+                and worker.completed_runs < self.max_runs
+                and len(self._idle) < self.size):
+            worker.rid = None
+            worker.filename = None
+            worker.watchdogs.clear()
+            worker.run_finished = False
+            self._idle.append(worker)
+            self.stats["reused"] += 1
+            return True
+        if worker.completed_runs >= self.max_runs or not worker.reusable:
+            self.stats["retired"] += 1
+        self._refill.set()
+        return False
+
+    def record_build(self, worker, warm):
+        """Accounts the build latency of a worker obtained with
+        :meth:`get`."""
+        if worker.build_latency is None:
+            return
+        kind = "warm" if warm else "cold"
+        self.stats[kind] += 1
+        self.stats[kind + "_build_time"] += worker.build_latency
+        logger.debug("%s worker (started %.3fs earlier) built RID %s in %.3fs",
+                     kind, time.monotonic() - worker.spawn_time, worker.rid,
+                     worker.build_latency)
+
+    def get_stats(self):
+        """Returns the pool counters, with the mean build latencies of runs
+        on warm and cold workers."""
+        r = dict(self.stats)
+        r["idle"] = len(self._idle)
+        for kind in "warm", "cold":
+            n = self.stats[kind]
+            r["mean_" + kind + "_build_time"] = (
+                self.stats[kind + "_build_time"]/n if n else None)
+        return r
+
+    async def _do(self):
+        while True:
+            await self._refill.wait()
+            self._refill.clear()
+            while len(self._idle) + len(self._lent) < self.size:
+                worker = Worker(self.handlers)
+                try:
+                    await worker._create_process(self.log_level)
+                except:
+                    logger.warning("failed to start idle worker",
+                                   exc_info=True)
+                    await worker.close()
+                    break
+                self.stats["spawned"] += 1
+                self._idle.append(worker)
+
+    async def stop(self):
+        await TaskObject.stop(self)
+        while self._idle:
+            await self._idle.popleft().close()
@@ -7,8 +7,13 @@ standalone command line tools).
 from operator import setitem
 import importlib
 import logging
+import threading
+import time
+import copy
+import numbers
 
-from sipyco.sync_struct import Notifier
+import numpy as np
+from sipyco.sync_struct import Notifier, process_mod
 from sipyco.pc_rpc import AutoTarget, Client, BestEffortClient
 
 
@@ -106,15 +111,232 @@ class DeviceManager:
         self.active_devices.clear()
 
 
+def _mod_key(mod):
+    if mod["path"]:
+        return mod["path"][0]
+    else:
+        return mod["key"]
+
+
+def _is_index(key):
+    # Only integer indices are compared: arrays and slices either do not
+    # compare to a boolean or may select overlapping elements.
+    if isinstance(key, tuple):
+        return all(isinstance(k, numbers.Integral) for k in key)
+    return isinstance(key, numbers.Integral)
+
+
+class BatchPublisher:
+    """Collects the modifications of broadcast datasets and publishes them
+    in batches through ``publish_batch``, which takes a list of mods.
+
+    Mods are buffered per dataset and merged when possible:
+
+    * a new value or the deletion of a dataset supersedes all its buffered
+      mods, which are dropped;
+    * mods to a dataset that has been assigned a new value since the last
+      batch are applied to that value;
+    * consecutive appends to the same list are merged into a single
+      ``extend`` mod, and consecutive assignments of the same element into
+      the last one.
+
+    Mods, including new values, are copied when they are buffered, so that
+    the caller may keep modifying its objects in place.
+
+    A batch is published when ``max_mods`` mods are buffered, ``max_delay``
+    seconds after the first buffered mod (from a background thread), or when
+    :meth:`flush` is called. Errors that occur in the background are raised
+    by the next call to :meth:`flush`.
+    """
+    def __init__(self, publish_batch, max_delay=0.1, max_mods=1000):
+        self.publish_batch = publish_batch
+        self.max_delay = max_delay
+        self.max_mods = max_mods
+
+        self.lock = threading.RLock()
+        self._cond = threading.Condition(self.lock)
+        self._pending = dict()
+        self._pending_count = 0
+        self._deadline = None
+        self._error = None
+        self._thread = None
+        self._closed = False
+        self.stats = {
+            "mods": 0,
+            "batches": 0,
+            "merged": 0,
+            "dropped": 0
+        }
+
+    def _add(self, mod):
+        key = _mod_key(mod)
+        pending = self._pending.setdefault(key, [])
+        mod = copy.deepcopy(mod)
+        if not mod["path"]:
+            self.stats["dropped"] += len(pending)
+            self._pending_count -= len(pending)
+            pending.clear()
+        elif (pending and not pending[0]["path"]
+                and pending[0]["action"] == "setitem"):
+            process_mod({key: pending[0]["value"]}, mod)
+            self.stats["merged"] += 1
+            return
+        else:
+            last = pending[-1] if pending else None
+            if (last is not None and mod["action"] == "append"
+                    and last["action"] in ("append", "extend")
+                    and last["path"] == mod["path"]):
+                if last["action"] == "append":
+                    pending[-1] = {"action": "extend", "path": last["path"],
+                                   "xs": [last["x"], mod["x"]]}
+                else:
+                    last["xs"].append(mod["x"])
+                self.stats["merged"] += 1
+                return
+            if (last is not None and mod["action"] == "setitem"
+                    and last["action"] == "setitem"
+                    and last["path"] == mod["path"]
+                    and _is_index(last["key"]) and _is_index(mod["key"])
+                    and last["key"] == mod["key"]):
+                pending[-1] = mod
+                self.stats["merged"] += 1
+                return
+        pending.append(mod)
+        self._pending_count += 1
+
+    def __call__(self, mod):
+        with self.lock:
+            self.stats["mods"] += 1
+            self._add(mod)
+            if self._pending_count >= self.max_mods:
+                self.flush()
+            elif self._deadline is None:
+                self._deadline = time.monotonic() + self.max_delay
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._flush_loop,
+                                                    daemon=True)
+                    self._thread.start()
+                else:
+                    self._cond.notify()
+
+    def _flush(self):
+        mods = [mod for pending in self._pending.values() for mod in pending]
+        self._pending.clear()
+        self._pending_count = 0
+        self._deadline = None
+        if mods:
+            self.stats["batches"] += 1
+            self.publish_batch(mods)
+
+    def flush(self):
+        """Publishes all buffered mods."""
+        with self.lock:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            self._flush()
+
+    def _flush_loop(self):
+        with self.lock:
+            while not self._closed:
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                timeout = self._deadline - time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                try:
+                    self._flush()
+                except Exception as e:
+                    logger.error("failed to publish datasets", exc_info=True)
+                    self._error = e
+
+    def close(self):
+        """Publishes all buffered mods and stops the background thread."""
+        with self.lock:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._closed = False
+
+
+class DatasetCache:
+    """Local copy of broadcast datasets of the master.
+
+    ``get_datasets`` is called with lists of keys and of key prefixes, and
+    returns a dictionary mapping the existing matching keys to tuples of value
+    and metadata. The caller must pass the returned datasets to
+    :meth:`update`, and the keys of datasets modified in the master to
+    :meth:`invalidate`, in the same order as the master sent them (in the
+    worker, both are done by the thread that receives messages from the
+    master).
+    """
+    def __init__(self, get_datasets):
+        self.get_datasets = get_datasets
+        self.data = dict()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0
+        }
+
+    def update(self, datasets):
+        self.data.update(datasets)
+
+    def invalidate(self, keys):
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def prefetch(self, keys=(), prefixes=()):
+        """Obtains the given datasets, and all datasets the keys of which
+        start with one of the given prefixes, with a single request."""
+        self.get_datasets(list(keys), list(prefixes))
+
+    def _get(self, key):
+        try:
+            r = self.data[key]
+        except KeyError:
+            self.stats["misses"] += 1
+            r = self.get_datasets([key], [])[key]
+        else:
+            self.stats["hits"] += 1
+        # Values are shared with the cache, return copies that the caller
+        # can modify.
+        return copy.deepcopy(r)
+
+    def get(self, key):
+        return self._get(key)[0]
+
+    def get_metadata(self, key):
+        return self._get(key)[1]
+
+
 class DatasetManager:
-    def __init__(self, ddb):
+    def __init__(self, ddb, publisher=None, cache=None):
         self._broadcaster = Notifier(dict())
         self.local = dict()
         self.archive = dict()
         self.metadata = dict()
 
         self.ddb = ddb
-        self._broadcaster.publish = ddb.update
+        self.cache = cache
+        # (flush period, compression) when the experiment requests archived
+        # datasets to be written while it runs
+        self.results_streaming = None
+        self.results_writer = None
+        # Held while datasets are modified, so that other threads (the
+        # dataset publisher and the results writer) see consistent values.
+        if publisher is None:
+            self._broadcaster.publish = ddb.update
+            self.lock = threading.RLock()
+        else:
+            self._broadcaster.publish = publisher
+            self.lock = publisher.lock
 
     def set(self, key, value, metadata, broadcast, persist, archive):
         if persist:
@@ -123,17 +345,20 @@ class DatasetManager:
         if not (broadcast or archive):
             logger.warning(f"Dataset '{key}' will not be stored. Both 'broadcast' and 'archive' are set to False.")
 
-        if broadcast:
-            self._broadcaster[key] = persist, value, metadata
-        elif key in self._broadcaster.raw_view:
-            del self._broadcaster[key]
+        self._invalidate(key)
+        with self.lock:
+            if broadcast:
+                self._broadcaster[key] = persist, value, metadata
+            elif key in self._broadcaster.raw_view:
+                del self._broadcaster[key]
 
-        if archive:
-            self.local[key] = value
-        elif key in self.local:
-            del self.local[key]
-        
-        self.metadata[key] = metadata
+            if archive:
+                self.local[key] = value
+            elif key in self.local:
+                del self.local[key]
+
+            self.metadata[key] = metadata
+            self._results_modified(key)
 
     def _get_mutation_target(self, key):
         target = self.local.get(key, None)
@@ -145,23 +370,42 @@ class DatasetManager:
             raise KeyError("Cannot mutate nonexistent dataset '{}'".format(key))
         return target
 
+    def _invalidate(self, key):
+        # The master notifies changes only once they have been published.
+        if self.cache is not None:
+            self.cache.invalidate([key])
+
+    def _results_modified(self, key, appended=False):
+        if self.results_writer is not None:
+            self.results_writer.modified(key, appended)
+
     def mutate(self, key, index, value):
+        self._invalidate(key)
         target = self._get_mutation_target(key)
         if isinstance(index, tuple):
             if isinstance(index[0], tuple):
                 index = tuple(slice(*e) for e in index)
             else:
                 index = slice(*index)
-        setitem(target, index, value)
+        with self.lock:
+            setitem(target, index, value)
+            self._results_modified(key)
 
     def append_to(self, key, value):
-        self._get_mutation_target(key).append(value)
+        self._invalidate(key)
+        target = self._get_mutation_target(key)
+        with self.lock:
+            target.append(value)
+            self._results_modified(key, appended=True)
 
     def get(self, key, archive=False):
         if key in self.local:
             return self.local[key]
         
-        data = self.ddb.get(key)
+        if self.cache is not None:
+            data = self.cache.get(key)
+        else:
+            data = self.ddb.get(key)
         if archive:
             if key in self.archive:
                 logger.warning("Dataset '%s' is already in archive, "
@@ -172,13 +416,26 @@ class DatasetManager:
     def get_metadata(self, key):
         if key in self.metadata:
             return self.metadata[key]
+        if self.cache is not None:
+            return self.cache.get_metadata(key)
         return self.ddb.get_metadata(key)
 
-    def write_hdf5(self, f):
-        datasets_group = f.create_group("datasets")
-        for k, v in self.local.items():
-            m = self.metadata.get(k, {})
-            _write(datasets_group, k, v, m)
+    def prefetch(self, keys=(), prefixes=()):
+        if self.cache is not None:
+            self.cache.prefetch(keys, prefixes)
+
+    def stream_results(self, flush_period=10.0, compression="gzip"):
+        self.results_streaming = flush_period, compression
+
+    def write_hdf5(self, f, local=True):
+        """Writes the archived datasets to ``f``. If ``local`` is false,
+        only the datasets read from the master are written, and the local
+        datasets are left to a :class:`ResultsWriter`."""
+        if local:
+            datasets_group = f.create_group("datasets")
+            for k, v in self.local.items():
+                m = self.metadata.get(k, {})
+                _write(datasets_group, k, v, m)
 
         archive_group = f.create_group("archive")
         for k, v in self.archive.items():
@@ -196,3 +453,145 @@ def _write(group, k, v, m):
     except TypeError as e:
         raise TypeError("Error writing dataset '{}' of type '{}': {}".format(
             k, type(v), e))
+
+
+_missing = object()
+
+
+class ResultsWriter:
+    """Writes the local archived datasets of a :class:`DatasetManager` to the
+    ``datasets`` group of an HDF5 file while the experiment runs.
+
+    Numeric lists and arrays are stored in chunked, compressed datasets, and
+    values appended to lists are added to the end of the HDF5 datasets.
+    Other modifications rewrite the whole dataset. The file is updated every
+    ``flush_period`` seconds by a background thread, and a last time by
+    :meth:`close`. The modified values are copied with the lock of the
+    :class:`DatasetManager` held, and written from the copies.
+    """
+    def __init__(self, f, dataset_mgr, flush_period=10.0, compression="gzip"):
+        self.f = f
+        self.group = f.create_group("datasets")
+        self.dataset_mgr = dataset_mgr
+        self.flush_period = flush_period
+        self.compression = compression
+
+        self.lock = threading.Lock()
+        # key -> True to rewrite the dataset, False to append new rows
+        self._modified = dict.fromkeys(dataset_mgr.local.keys(), True)
+        # key -> number of rows written, for extensible datasets
+        self._rows = dict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def modified(self, key, appended=False):
+        with self.lock:
+            self._modified[key] = self._modified.get(key, False) or not appended
+
+    def start(self):
+        self._thread = threading.Thread(target=self._flush_periodically,
+                                        daemon=True)
+        self._thread.start()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_period):
+            try:
+                self.flush()
+            except:
+                logger.warning("failed to write results, postponing until "
+                               "the end of the experiment", exc_info=True)
+                return
+
+    def _rewrite(self, key, value, metadata):
+        if key in self.group:
+            del self.group[key]
+        self._rows.pop(key, None)
+        data = None
+        if isinstance(value, (list, np.ndarray)):
+            try:
+                data = np.asarray(value)
+            except ValueError:
+                pass
+        if (data is not None and data.ndim >= 1 and len(data)
+                and data.dtype.kind in "biufc"):
+            dataset = self.group.create_dataset(
+                key, data=data, maxshape=(None,) + data.shape[1:],
+                chunks=True, compression=self.compression)
+            for k, v in metadata.items():
+                dataset.attrs[k] = v
+            if isinstance(value, list):
+                self._rows[key] = len(data)
+        else:
+            _write(self.group, key, value, metadata)
+
+    def _append(self, key, rows):
+        if not rows:
+            return True
+        dataset = self.group[key]
+        n = self._rows[key]
+        data = np.asarray(rows)
+        if (data.shape[1:] != dataset.shape[1:]
+                or np.result_type(dataset.dtype, data.dtype) != dataset.dtype):
+            return False
+        dataset.resize(n + len(data), axis=0)
+        dataset[n:] = data
+        self._rows[key] = n + len(data)
+        return True
+
+    def _snapshot(self):
+        # key -> (value, metadata, rows appended since the last flush or
+        # None to rewrite the dataset)
+        snapshot = dict()
+        with self.dataset_mgr.lock:
+            with self.lock:
+                modified, self._modified = self._modified, dict()
+            for key, rewrite in modified.items():
+                value = self.dataset_mgr.local.get(key, _missing)
+                if value is _missing:
+                    snapshot[key] = _missing
+                elif (not rewrite and key in self._rows
+                        and isinstance(value, list)):
+                    snapshot[key] = (None, None,
+                                     copy.deepcopy(value[self._rows[key]:]))
+                else:
+                    snapshot[key] = (copy.deepcopy(value),
+                                     dict(self.dataset_mgr.metadata.get(key, {})),
+                                     None)
+        return snapshot
+
+    def flush(self):
+        for key, entry in self._snapshot().items():
+            if entry is _missing:
+                if key in self.group:
+                    del self.group[key]
+                self._rows.pop(key, None)
+                continue
+            value, metadata, rows = entry
+            try:
+                if rows is not None and self._append(key, rows):
+                    continue
+                if rows is not None:
+                    # The appended rows do not fit in the HDF5 dataset. If
+                    # the dataset has been deleted since the snapshot, the
+                    # next flush deletes it.
+                    with self.dataset_mgr.lock:
+                        value = self.dataset_mgr.local.get(key, _missing)
+                        if value is _missing:
+                            continue
+                        value = copy.deepcopy(value)
+                        metadata = dict(self.dataset_mgr.metadata.get(key, {}))
+                self._rewrite(key, value, metadata)
+            except:
+                # write the dataset again at the next attempt
+                self.modified(key)
+                raise
+        self.f.flush()
+
+    def close(self):
+        """Stops the background thread and writes the latest values."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
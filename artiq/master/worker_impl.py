@@ -8,13 +8,17 @@ process via IPC.
 
 import sys
 import time
+import json
 import os
+import threading
+import queue
 import inspect
 import logging
 import traceback
 from collections import OrderedDict
 import importlib.util
 import linecache
+import sysconfig
 
 import h5py
 
@@ -24,7 +28,11 @@ from sipyco.logging_tools import multiline_log_config
 
 import artiq
 from artiq import tools
-from artiq.master.worker_db import DeviceManager, DatasetManager, DummyDevice
+from artiq.master.worker_db import (DeviceManager, DatasetManager,
+                                    DummyDevice, BatchPublisher, DatasetCache,
+                                    ResultsWriter)
+from artiq.master import worker_ipc
+from artiq.master.results_index import ResultsIndex, describe_results
 from artiq.language.environment import (
     is_public_experiment, TraceArgumentManager, ProcessArgumentManager
 )
@@ -36,23 +44,103 @@ from artiq import __version__ as artiq_version
 
 
 ipc = None
+# set when the master accepts large arrays out of band
+binary_ipc = False
+# held while sending a message and, for requests, receiving the reply;
+# dataset batches are sent from a background thread
+ipc_lock = threading.RLock()
+dataset_publisher = None
+# set when the master keeps the worker's copies of datasets up to date;
+# messages are then received by a background thread into ipc_queue
+dataset_cache = None
+ipc_queue = None
+
+
+def _read_exactly(n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < n:
+        data = ipc.read(n - pos)
+        if not data:
+            raise EOFError("master closed the connection")
+        view[pos:pos+len(data)] = data
+        pos += len(data)
+    return buffer
+
+
+def _read_object():
+    line = ipc.readline()
+    if not line:
+        raise EOFError("master closed the connection")
+    lengths = worker_ipc.parse_frame_header(line)
+    if lengths is None:
+        return worker_ipc.decode(line)
+    parts = [_read_exactly(n) for n in lengths]
+    return worker_ipc.decode(parts[0], parts[1:])
+
+
+def _receive_objects():
+    # Invalidations are applied as soon as they arrive, even while the
+    # experiment does not communicate with the master.
+    while True:
+        try:
+            obj = _read_object()
+        except Exception as e:
+            ipc_queue.put(e)
+            return
+        if obj.get("action") == "invalidate_datasets":
+            dataset_cache.invalidate(obj["keys"])
+            continue
+        if obj.get("cache") and obj["status"] == "ok":
+            dataset_cache.update(obj["data"])
+        ipc_queue.put(obj)
 
 
 def get_object():
-    line = ipc.readline().decode()
-    return pyon.decode(line)
+    if ipc_queue is None:
+        return _read_object()
+    obj = ipc_queue.get()
+    if isinstance(obj, Exception):
+        raise obj
+    return obj
 
 
 def put_object(obj):
-    ds = pyon.encode(obj)
-    ipc.write((ds + "\n").encode())
+    with ipc_lock:
+        for data in worker_ipc.encode(obj, binary_ipc):
+            data = memoryview(data).cast("B")
+            while data:
+                n = ipc.write(data)
+                if n is None:
+                    break
+                data = data[n:]
+
+
+def flush_datasets():
+    if dataset_publisher is not None:
+        dataset_publisher.flush()
+
+
+def make_parent_action(action, reply=True):
+    """Returns a function that performs ``action`` in the master.
+
+    If ``reply`` is false, the request is sent without waiting for the
+    master to process it, and errors are only logged by the master.
+    Otherwise, buffered dataset modifications are published first so that
+    the master observes them before the request."""
+    if not reply:
+        def notify_parent(*args, **kwargs):
+            put_object({"action": action, "args": args, "kwargs": kwargs,
+                        "reply": False})
+        return notify_parent
 
-
-def make_parent_action(action):
     def parent_action(*args, **kwargs):
         request = {"action": action, "args": args, "kwargs": kwargs}
-        put_object(request)
-        reply = get_object()
+        flush_datasets()
+        with ipc_lock:
+            put_object(request)
+            reply = get_object()
         if "action" in reply:
             if reply["action"] == "terminate":
                 sys.exit()
@@ -73,6 +161,8 @@ class ParentDeviceDB:
 class ParentDatasetDB:
     get = make_parent_action("get_dataset")
     update = make_parent_action("update_dataset")
+    update_batch = make_parent_action("update_dataset_batch", reply=False)
+    get_many = make_parent_action("get_datasets")
 
 
 class Watchdog:
@@ -171,6 +261,7 @@ def get_experiment_from_content(content, class_name):
 
 
 register_experiment = make_parent_action("register_experiment")
+register_dependencies = make_parent_action("register_dependencies")
 
 
 class ExamineDeviceMgr:
@@ -186,6 +277,14 @@ class ExamineDatasetMgr:
     def get(key, archive=False):
         return ParentDatasetDB.get(key)
 
+    @staticmethod
+    def prefetch(keys=(), prefixes=()):
+        pass
+
+    @staticmethod
+    def stream_results(flush_period=10.0, compression="gzip"):
+        pass
+
 
 def examine(device_mgr, dataset_mgr, file):
     previous_keys = set(sys.modules.keys())
@@ -211,6 +310,11 @@ def examine(device_mgr, dataset_mgr, file):
             if hasattr(exp_class, "argument_ui"):
                 argument_ui = exp_class.argument_ui
             register_experiment(class_name, name, arginfo, argument_ui, scheduler_defaults)
+        new_modules = (sys.modules[key]
+                       for key in set(sys.modules.keys()) - previous_keys)
+        register_dependencies(sorted(
+            {m.__file__ for m in new_modules
+             if getattr(m, "__file__", None) is not None}))
     finally:
         new_keys = set(sys.modules.keys())
         for key in new_keys - previous_keys:
@@ -243,8 +347,51 @@ def setup_diagnostics(experiment_file, repository_path):
         render_diagnostic
 
 
-def put_completed():
-    put_object({"action": "completed"})
+def precompile_kernels(exp_inst):
+    """Compiles the kernels listed in the ``precompiled_kernels`` attribute
+    of the experiment and replaces them, on the instance, by the callables
+    returned by :meth:`~artiq.coredevice.core.Core.precompile`.
+
+    Returns the number of kernels compiled and the time spent compiling."""
+    n = 0
+    t0 = time.monotonic()
+    for name in getattr(exp_inst, "precompiled_kernels", ()):
+        function = getattr(exp_inst, name)
+        embedded = getattr(function, "artiq_embedded", None)
+        if embedded is None or embedded.core_name is None:
+            raise ValueError("{} is not a kernel and cannot be precompiled"
+                             .format(name))
+        core = getattr(exp_inst, embedded.core_name)
+        try:
+            # Subkernels are uploaded at the first call, as another
+            # experiment may be running on the core device.
+            precompiled = core._precompile(function, (), {},
+                                           defer_upload=True)
+        except Exception as e:
+            # The diagnostics of compilation errors have already been
+            # printed.
+            logging.warning("failed to precompile %s, it will be compiled "
+                            "when called", name,
+                            exc_info=not isinstance(e, CompileError))
+            continue
+        setattr(exp_inst, name, precompiled)
+        n += 1
+    return n, time.monotonic() - t0
+
+
+def archive_compiler_profiles(device_mgr, dataset_mgr):
+    """Archives the compilation reports of the core devices created with a
+    dataset name as ``profile_compiler`` argument."""
+    for _, device in device_mgr.active_devices:
+        key = getattr(device, "compiler_profile_dataset", None)
+        if key is not None and device.compiler_profiles:
+            dataset_mgr.set(key, json.dumps(device.compiler_profiles), {},
+                            broadcast=False, persist=False, archive=True)
+
+
+def put_completed(**info):
+    flush_datasets()
+    put_object({"action": "completed", **info})
 
 
 def put_exception_report():
@@ -264,14 +411,23 @@ def put_exception_report():
             lines += traceback.format_exception_only(type(exc), exc)
         logging.error("".join(lines).rstrip(),
                       exc_info=not hasattr(exc, "parent_traceback"))
+    try:
+        flush_datasets()
+    except:
+        logging.error("failed to publish datasets", exc_info=True)
     put_object({"action": "exception"})
 
 
 def main():
-    global ipc
+    global ipc, binary_ipc, dataset_publisher, dataset_cache, ipc_queue
 
     multiline_log_config(level=int(sys.argv[2]))
     ipc = pipe_ipc.ChildComm(sys.argv[1])
+    binary_ipc = "binary_ipc" in sys.argv[3:]
+    if "dataset_cache" in sys.argv[3:]:
+        dataset_cache = DatasetCache(ParentDatasetDB.get_many)
+        ipc_queue = queue.Queue()
+        threading.Thread(target=_receive_objects, daemon=True).start()
 
     start_time = None
     run_time = None
@@ -280,32 +436,169 @@ def main():
     exp = None
     exp_inst = None
     repository_path = None
+    experiment_dir = None
+    results_writer = None
+
+    def results_filename():
+        return "{:09}-{}.h5".format(rid, exp.__name__)
+
+    def start_results_writer():
+        nonlocal results_writer
+        flush_period, compression = dataset_mgr.results_streaming
+        f = h5py.File(results_filename(), "w")
+        results_writer = ResultsWriter(f, dataset_mgr, flush_period,
+                                       compression)
+        dataset_mgr.results_writer = results_writer
+        results_writer.start()
 
     def write_results():
-        filename = "{:09}-{}.h5".format(rid, exp.__name__)
-        with h5py.File(filename, "w") as f:
-            dataset_mgr.write_hdf5(f)
+        nonlocal results_writer
+        archive_compiler_profiles(device_mgr, dataset_mgr)
+        if results_writer is None:
+            f = h5py.File(results_filename(), "w")
+        else:
+            f = results_writer.f
+        with f:
+            if results_writer is None:
+                dataset_mgr.write_hdf5(f)
+            else:
+                writer, results_writer = results_writer, None
+                writer.close()
+                dataset_mgr.results_writer = None
+                dataset_mgr.write_hdf5(f, local=False)
             f["artiq_version"] = artiq_version
             f["rid"] = rid
             f["start_time"] = start_time
             f["run_time"] = run_time
             f["expid"] = pyon.encode(expid)
-
-    device_mgr = DeviceManager(ParentDeviceDB,
-                               virtual_devices={"scheduler": Scheduler(),
-                                                "ccb": CCB()})
-    dataset_mgr = DatasetManager(ParentDatasetDB)
+            index_results(f)
+
+    def index_results(f):
+        results_root = os.path.join(initial_cwd, "results")
+        try:
+            with ResultsIndex(results_root) as index:
+                index.add(os.path.relpath(os.path.abspath(f.filename),
+                                          results_root),
+                          describe_results(f))
+        except Exception:
+            logging.warning("failed to add RID %d to the results index", rid,
+                            exc_info=True)
+
+    def make_device_mgr():
+        return DeviceManager(ParentDeviceDB,
+                             virtual_devices={"scheduler": Scheduler(),
+                                              "ccb": CCB()})
+
+    device_mgr = make_device_mgr()
+    dataset_publisher = BatchPublisher(ParentDatasetDB.update_batch)
+    dataset_mgr = DatasetManager(ParentDatasetDB, dataset_publisher,
+                                 dataset_cache)
 
     import_cache.install_hook()
 
+    # The master may keep this process idle in its worker pool and reuse it
+    # for several runs; record the pristine state to restore between them.
+    initial_cwd = os.getcwd()
+    initial_modules = set(sys.modules.keys())
+    initial_log_handlers = {
+        name: list(logger.handlers)
+        for name, logger in logging.root.manager.loggerDict.items()
+        if isinstance(logger, logging.Logger)}
+    initial_log_handlers[None] = list(logging.root.handlers)
+    # Modules of ARTIQ and of the standard library imported by a run are
+    # kept for the following runs, like those imported at startup. Modules
+    # of the repository and of the directory of the experiment are removed
+    # after each run, so that they are imported again in their current
+    # version; nothing else refers to them. Other modules (e.g. third-party
+    # drivers, extensions) may leave state behind, so the process is not
+    # reused after importing them.
+    shared_paths = [os.path.dirname(os.path.abspath(artiq.__file__)),
+                    sysconfig.get_paths()["stdlib"],
+                    sysconfig.get_paths()["platstdlib"]]
+
+    def experiment_paths():
+        paths = []
+        if repository_path is not None:
+            paths.append(os.path.join(initial_cwd, repository_path))
+        if experiment_dir is not None:
+            paths.append(experiment_dir)
+        return paths
+
+    def new_modules(paths):
+        """Returns the names of the modules imported since the start of the
+        worker that are located in one of ``paths``, and of those located
+        elsewhere. Built-in modules are in neither list."""
+        paths = tuple(os.path.join(path, "") for path in paths)
+        inside, outside = [], []
+        for key in set(sys.modules.keys()) - initial_modules:
+            module = sys.modules[key]
+            filename = getattr(module, "__file__", None)
+            if filename is None:
+                # namespace packages
+                filename = next(iter(getattr(module, "__path__", [])), None)
+            if filename is None:
+                continue
+            if os.path.abspath(filename).startswith(paths):
+                inside.append(key)
+            else:
+                outside.append(key)
+        return inside, outside
+
+    def is_reusable():
+        _, others = new_modules(shared_paths + experiment_paths())
+        if others:
+            logging.debug("worker not reusable after importing %s",
+                          ", ".join(sorted(others)))
+            return False
+        return True
+
+    def reset_logging():
+        loggers = [(name, logger)
+                   for name, logger in logging.root.manager.loggerDict.items()
+                   if isinstance(logger, logging.Logger)]
+        loggers.append((None, logging.root))
+        for name, logger in loggers:
+            initial = initial_log_handlers.get(name, [])
+            for handler in list(logger.handlers):
+                if handler not in initial:
+                    logger.removeHandler(handler)
+                    handler.close()
+            for handler in initial:
+                if handler not in logger.handlers:
+                    logger.addHandler(handler)
+
+    def reset():
+        nonlocal device_mgr, dataset_mgr, exp, exp_inst, run_time, \
+            results_writer
+        device_mgr.close_devices()
+        device_mgr = make_device_mgr()
+        if results_writer is not None:
+            # the run was not analyzed, keep the datasets written so far
+            with results_writer.f:
+                results_writer.close()
+        dataset_mgr = DatasetManager(ParentDatasetDB, dataset_publisher,
+                                     dataset_cache)
+        reset_logging()
+        exp = None
+        exp_inst = None
+        run_time = None
+        results_writer = None
+        os.chdir(initial_cwd)
+        modules, _ = new_modules(experiment_paths())
+        for key in modules:
+            del sys.modules[key]
+
     try:
         while True:
             obj = get_object()
             action = obj["action"]
             if action == "build":
+                if rid is not None:
+                    reset()
                 start_time = time.time()
                 rid = obj["rid"]
                 expid = obj["expid"]
+                logging.getLogger().setLevel(expid["log_level"])
                 if "file" in expid:
                     if obj["wd"] is not None:
                         # Using repository
@@ -314,9 +607,12 @@ def main():
                     else:
                         experiment_file = expid["file"]
                         repository_path = None
+                    experiment_dir = os.path.dirname(
+                        os.path.abspath(experiment_file))
                     setup_diagnostics(experiment_file, repository_path)
                     exp = get_experiment_from_file(experiment_file, expid["class_name"])
                 else:
+                    experiment_dir = None
                     setup_diagnostics("<none>", None)
                     exp = get_experiment_from_content(expid["content"], expid["class_name"])
                 device_mgr.virtual_devices["scheduler"].set_run_info(
@@ -333,9 +629,16 @@ def main():
                 put_completed()
             elif action == "prepare":
                 exp_inst.prepare()
+                n, compile_time = precompile_kernels(exp_inst)
+                if n:
+                    logging.info("RID %d: %d kernel(s) compiled in the "
+                                 "prepare stage (%.2f s)",
+                                 rid, n, compile_time)
                 put_completed()
             elif action == "run":
                 run_time = time.time()
+                if dataset_mgr.results_streaming is not None:
+                    start_results_writer()
                 try:
                     exp_inst.run()
                 except:
@@ -353,7 +656,16 @@ def main():
                     if rid is not None:
                         write_results()
 
-                put_completed()
+                logging.debug("dataset publishing: %d mods in %d batches, "
+                              "%d merged, %d dropped",
+                              *(dataset_publisher.stats[k] for k in
+                                ("mods", "batches", "merged", "dropped")))
+                if dataset_cache is not None:
+                    logging.debug("dataset cache: %d hits, %d misses, "
+                                  "%d invalidations",
+                                  *(dataset_cache.stats[k] for k in
+                                    ("hits", "misses", "invalidations")))
+                put_completed(reusable=is_reusable())
             elif action == "examine":
                 examine(ExamineDeviceMgr, ExamineDatasetMgr, obj["file"])
                 put_completed()
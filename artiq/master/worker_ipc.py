@@ -0,0 +1,100 @@
+"""Encoding of the messages exchanged between the master and its workers.
+
+Messages are normally PYON-encoded objects, one per line. Large NumPy arrays
+of numeric types are expensive to represent as PYON text; when both sides
+support it, they are instead sent out of band, after the PYON-encoded
+remainder of the message, as raw memory. Such messages take the form::
+
+    #frame <payload length> <buffer 0 length> <buffer 1 length> ...\\n
+    <payload><buffer 0><buffer 1>...
+
+where the payload is the PYON-encoded message in which each out-of-band
+array has been replaced by a placeholder referencing its buffer.
+"""
+
+import numpy
+
+from sipyco import pyon
+
+
+FRAME_PREFIX = b"#frame"
+# Minimum size in bytes for an array to be sent out of band.
+DEFAULT_THRESHOLD = 64*1024
+
+_BUFFER_KEY = "__artiq_ipc_buffer__"
+
+
+def _extract(obj, buffers, threshold):
+    t = type(obj)
+    if t is numpy.ndarray:
+        if (obj.dtype.kind in "biufc" and not obj.dtype.hasobject
+                and obj.nbytes >= threshold):
+            obj = numpy.ascontiguousarray(obj)
+            buffers.append(obj.reshape(-1).view(numpy.uint8))
+            return {_BUFFER_KEY: len(buffers) - 1,
+                    "dtype": obj.dtype.str,
+                    "shape": obj.shape}
+        return obj
+    elif t is dict:
+        return {k: _extract(v, buffers, threshold) for k, v in obj.items()}
+    elif t is list:
+        return [_extract(v, buffers, threshold) for v in obj]
+    elif t is tuple:
+        return tuple(_extract(v, buffers, threshold) for v in obj)
+    else:
+        return obj
+
+
+def _restore(obj, buffers):
+    t = type(obj)
+    if t is dict:
+        if _BUFFER_KEY in obj:
+            buffer = buffers[obj[_BUFFER_KEY]]
+            return numpy.frombuffer(buffer, dtype=obj["dtype"]).reshape(
+                obj["shape"])
+        return {k: _restore(v, buffers) for k, v in obj.items()}
+    elif t is list:
+        return [_restore(v, buffers) for v in obj]
+    elif t is tuple:
+        return tuple(_restore(v, buffers) for v in obj)
+    else:
+        return obj
+
+
+def encode(obj, binary=False, threshold=DEFAULT_THRESHOLD):
+    """Encodes a message into a list of bytes-like objects, to be written
+    in order.
+
+    If ``binary`` is true, arrays of at least ``threshold`` bytes are sent
+    out of band, without copying them. Otherwise, or if the message contains
+    no such array, the message is a single PYON line."""
+    if binary:
+        buffers = []
+        stripped = _extract(obj, buffers, threshold)
+        if buffers:
+            payload = pyon.encode(stripped).encode()
+            lengths = [len(payload)] + [buffer.nbytes for buffer in buffers]
+            header = b" ".join([FRAME_PREFIX] +
+                               [str(n).encode() for n in lengths]) + b"\n"
+            return [header, payload] + [memoryview(b) for b in buffers]
+    return [(pyon.encode(obj) + "\n").encode()]
+
+
+def parse_frame_header(line):
+    """Returns the lengths of the payload and of the out-of-band buffers of
+    a message, given its first line, or None if the message is a plain PYON
+    line."""
+    if not line.startswith(FRAME_PREFIX):
+        return None
+    return [int(n) for n in line[len(FRAME_PREFIX):].split()]
+
+
+def decode(payload, buffers=()):
+    """Decodes a message from its PYON payload and out-of-band buffers.
+
+    The arrays of the message share memory with the buffers, which should
+    therefore be writable (e.g. :class:`bytearray`)."""
+    obj = pyon.decode(payload.decode())
+    if buffers:
+        obj = _restore(obj, buffers)
+    return obj
@@ -0,0 +1,125 @@
+import shutil
+import struct
+import subprocess
+import tempfile
+import os
+import unittest
+
+from artiq.compiler import elf
+from artiq.compiler.module import Module, Source
+from artiq.compiler.targets import RV32GTarget, CortexA9Target
+
+
+_source = """
+def square(x):
+    return x * x
+
+def entrypoint():
+    return square(3)
+"""
+
+
+def _llvm_strip(library):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "library.elf")
+        with open(filename, "wb") as f:
+            f.write(library)
+        subprocess.check_call(["llvm-strip", "--strip-debug", filename])
+        with open(filename, "rb") as f:
+            return f.read()
+
+
+@unittest.skipIf(shutil.which("ld.lld") is None or shutil.which("llvm-strip") is None,
+                 "linker not available")
+class StripTest(unittest.TestCase):
+    def check(self, target):
+        module = Module(Source.from_string(_source, "<test_elf>"))
+        library = target.compile_and_link([module])
+        stripped = elf.strip_debug(library)
+        expected = _llvm_strip(library)
+
+        self.assertTrue(any(name.startswith(".debug")
+                            for name, *_ in elf.sections(library)))
+        sections = elf.sections(stripped)
+        self.assertEqual([name for name, *_ in sections],
+                         [name for name, *_ in elf.sections(expected)])
+        for name, sh_type, flags, offset, size in sections:
+            if flags & elf.SHF_ALLOC and sh_type != elf.SHT_NOBITS:
+                self.assertEqual(stripped[offset:offset + size],
+                                 library[offset:offset + size], name)
+        self.assertLess(len(stripped), len(library))
+        self.assertEqual(elf.strip_debug(stripped), stripped)
+
+    def test_rv32g(self):
+        self.check(RV32GTarget())
+
+    def test_cortexa9(self):
+        self.check(CortexA9Target())
+
+
+def _make_library():
+    # ELF32 shared library with the sections null, .debug_info, .text,
+    # .symtab, .strtab and .shstrtab, in this order. The symbol table has
+    # the section symbols of .debug_info and .text, and the global f.
+    shstrtab = b"\0.debug_info\0.text\0.symtab\0.strtab\0.shstrtab\0"
+    strtab = b"\0f\0"
+    symbol = struct.Struct("<IIIBBH")
+    symtab = (symbol.pack(0, 0, 0, 0, 0, 0) +
+              symbol.pack(0, 0, 0, 3, 0, 1) +  # STT_SECTION, STB_LOCAL
+              symbol.pack(0, 0, 0, 3, 0, 2) +
+              symbol.pack(1, 0x80, 4, 0x12, 0, 2))  # STT_FUNC, STB_GLOBAL
+    text = b"\x13\x00\x00\x00"  # nop
+    debug_info = b"\xaa" * 16
+
+    header_size, phdr_size, shdr_size = 52, 32, 40
+    contents = [(text, 0x80), (debug_info, 0x84), (symtab, 0x94),
+                (strtab, 0x94 + len(symtab)),
+                (shstrtab, 0x97 + len(symtab))]
+    data = bytearray(contents[-1][1] + len(shstrtab))
+    for content, offset in contents:
+        data[offset:offset + len(content)] = content
+    e_shoff = len(data) + (-len(data)) % 4
+    data += bytes(e_shoff - len(data))
+    data[0:header_size] = struct.pack(
+        "<16sHHIIIIIHHHHHH", b"\x7fELF\x01\x01\x01" + bytes(9), elf.ET_DYN,
+        243, 1, 0, header_size, e_shoff, 0, header_size, phdr_size, 1,
+        shdr_size, 6, 5)
+    data[header_size:header_size + phdr_size] = struct.pack(
+        "<IIIIIIII", 1, 0, 0, 0, 0x84, 0x84, 5, 0x1000)  # PT_LOAD
+    section = struct.Struct("<IIIIIIIIII")
+    data += section.pack(*[0]*10)
+    data += section.pack(1, 1, 0, 0, 0x84, len(debug_info), 0, 0, 1, 0)
+    data += section.pack(13, 1, elf.SHF_ALLOC | 4, 0x80, 0x80, len(text),
+                         0, 0, 4, 0)
+    data += section.pack(19, elf.SHT_SYMTAB, 0, 0, 0x94, len(symtab),
+                         4, 3, 4, symbol.size)
+    data += section.pack(27, 3, 0, 0, 0x94 + len(symtab), len(strtab),
+                         0, 0, 1, 0)
+    data += section.pack(35, 3, 0, 0, 0x97 + len(symtab), len(shstrtab),
+                         0, 0, 1, 0)
+    return bytes(data)
+
+
+class ELFTest(unittest.TestCase):
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            elf.strip_debug(b"\0" * 64)
+
+    def test_section_symbol(self):
+        library = _make_library()
+        stripped = elf.strip_debug(library)
+        sections = elf.sections(stripped)
+        self.assertEqual([name for name, *_ in sections],
+                         ["", ".text", ".symtab", ".strtab", ".shstrtab"])
+        self.assertEqual(stripped[0x80:0x84], library[0x80:0x84])
+        _, _, _, offset, size = sections[2]
+        symbols = [struct.unpack_from("<IIIBBH", stripped, offset + i)
+                   for i in range(0, size, 16)]
+        # the section symbol of .debug_info is removed
+        self.assertEqual(symbols, [(0, 0, 0, 0, 0, 0), (0, 0, 0, 3, 0, 1),
+                                   (1, 0x80, 4, 0x12, 0, 1)])
+        e_shoff, = struct.unpack_from("<I", stripped, 32)
+        sh_link, sh_info = struct.unpack_from("<II", stripped,
+                                              e_shoff + 2*40 + 24)
+        self.assertEqual((sh_link, sh_info), (3, 2))
+        self.assertEqual(elf.strip_debug(stripped), stripped)
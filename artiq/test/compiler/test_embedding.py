@@ -0,0 +1,115 @@
+import os
+import re
+import glob
+import tokenize
+import unittest
+
+import numpy
+
+from artiq import __artiq_dir__ as artiq_dir
+from artiq.language.core import kernel
+from artiq.master.databases import DeviceDB
+from artiq.master.worker_db import DeviceManager
+from artiq.coredevice.core import Core
+from artiq.compiler import asttyped, builtins, embedding, ir
+from artiq.compiler.module import Module
+
+
+table = [0.5 * i for i in range(embedding.BLOB_MIN_ELEMENTS)]
+wide_table = [2**40] * (embedding.BLOB_MIN_ELEMENTS + 2)
+narrow_table = list(range(embedding.BLOB_MIN_ELEMENTS + 1, 0, -1))
+waveform = numpy.zeros((2, embedding.BLOB_MIN_ELEMENTS), dtype=numpy.int32)
+
+
+class _Tables:
+    def __init__(self, core):
+        self.core = core
+
+    @kernel
+    def run(self):
+        x = table[1] + waveform[1][0]
+        y = wide_table[1]
+        z = narrow_table[1]
+
+
+class EmbeddingTest(unittest.TestCase):
+    def setUp(self):
+        self.synthesizer = embedding.ASTSynthesizer(embedding.EmbeddingMap(), {})
+
+    def test_blob(self):
+        node = self.synthesizer.quote(list(table))
+        self.assertIsInstance(node, asttyped.QuoteT)
+        self.assertEqual(node.type.find(), builtins.TList(builtins.TFloat()))
+
+        node = self.synthesizer.quote(waveform)
+        self.assertIsInstance(node, asttyped.QuoteT)
+        self.assertEqual(node.type.find(), builtins.TArray(builtins.TInt32(), 2))
+
+    def test_no_blob(self):
+        short = table[:embedding.BLOB_MIN_ELEMENTS - 1]
+        for value in (short, table[:-1] + [1], numpy.array(short)):
+            self.assertNotIsInstance(self.synthesizer.quote(value), asttyped.QuoteT)
+
+    def test_stitch(self):
+        dmgr = dict()
+        dmgr["core"] = core = Core(dmgr, None, 1e-9)
+        stitcher = embedding.Stitcher(core=core, dmgr=dmgr)
+        experiment = _Tables(core)
+        stitcher.stitch_call(_Tables.run, (experiment,), {})
+        stitcher.finalize()
+        module = Module(stitcher, ref_period=core.ref_period)
+
+        quoted = {}
+        for function in module.artiq_ir:
+            for block in function.basic_blocks:
+                for insn in block.instructions:
+                    if isinstance(insn, ir.Quote) and isinstance(insn.value, numpy.ndarray):
+                        quoted[len(insn.value)] = insn.type.find(), insn.value
+        self.assertEqual(len(quoted), 4)
+        for value, typ in [
+                (table, builtins.TList(builtins.TFloat())),
+                (waveform, builtins.TArray(builtins.TInt32(), 2)),
+                (wide_table, builtins.TList(builtins.TInt64())),
+                (narrow_table, builtins.TList(builtins.TInt32()))]:
+            quoted_type, quoted_value = quoted[len(value)]
+            self.assertEqual(quoted_type, typ)
+            self.assertTrue(numpy.array_equal(quoted_value, value))
+
+
+def _lit_embedding_cases():
+    lit_dir = os.path.join(artiq_dir, "test", "lit", "embedding")
+    for filename in sorted(glob.glob(os.path.join(lit_dir, "*.py"))):
+        with open(filename) as f:
+            run_lines = [line for line in f if line.startswith("# RUN:")]
+        if any("testbench.embedding" in line and "+diag" not in line
+               for line in run_lines):
+            yield filename
+
+
+class IncrementalInferenceTest(unittest.TestCase):
+    def compile(self, filename, incremental):
+        dmgr = DeviceManager(DeviceDB(
+            os.path.join(os.path.dirname(filename), "device_db.py")))
+        try:
+            with tokenize.open(filename) as f:
+                namespace = {"__name__": "testbench", "dmgr": dmgr}
+                exec(compile(f.read(), f.name, "exec"), namespace)
+            core = dmgr.get("core")
+            stitcher = embedding.Stitcher(core=core, dmgr=dmgr)
+            stitcher.stitch_call(namespace["entrypoint"], (), {})
+            stitcher.finalize(incremental=incremental)
+            module = Module(stitcher, ref_period=core.ref_period)
+            # host objects are different in each compilation
+            text = "\n".join(str(function) for function in module.artiq_ir)
+            text = re.sub(r"0x[0-9a-f]+", "0x...", text)
+            return re.sub(r"__eval_[0-9]+", "__eval_...", text)
+        finally:
+            dmgr.close_devices()
+
+    def test_lit_embedding(self):
+        filenames = list(_lit_embedding_cases())
+        self.assertTrue(filenames)
+        for filename in filenames:
+            with self.subTest(filename=os.path.basename(filename)):
+                self.assertEqual(self.compile(filename, incremental=True),
+                                 self.compile(filename, incremental=False))
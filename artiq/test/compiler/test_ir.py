@@ -0,0 +1,29 @@
+import unittest
+
+from artiq.compiler import ir, builtins, types
+
+
+class IRTest(unittest.TestCase):
+    def test_slots(self):
+        block = ir.BasicBlock([])
+        insn = block.append(ir.Unreachable())
+        for value in (block, insn, ir.Constant(1, builtins.TInt32())):
+            self.assertFalse(hasattr(value, "__dict__"))
+        with self.assertRaises(AttributeError):
+            insn.misspelled = True
+
+    def test_intern_type(self):
+        self.assertIs(ir.Constant(1, builtins.TInt32()).type,
+                      ir.Constant(2, builtins.TInt32()).type)
+        self.assertIsNot(ir.Constant(1, builtins.TInt32()).type,
+                         ir.Constant(1, builtins.TInt64()).type)
+        self.assertIs(ir.BasicBlock([]).type, ir.BasicBlock([]).type)
+
+        # types that may still change are never shared
+        free_int = builtins.TInt()
+        self.assertIs(ir.intern_type(free_int), free_int)
+        lst = builtins.TList(builtins.TInt32())
+        self.assertIs(ir.intern_type(lst), lst)
+        var = types.TVar()
+        var.unify(builtins.TFloat())
+        self.assertIs(ir.intern_type(var), ir.intern_type(builtins.TFloat()))
@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from artiq.compiler.kernel_cache import KernelCache
+
+
+class _Target:
+    triple = "test"
+    data_layout = ""
+    features = []
+    additional_linker_options = []
+    tool_ld = "ld.lld"
+
+    def __init__(self, subkernel_id=None, opt_level=2):
+        self.subkernel_id = subkernel_id
+        self.opt_level = opt_level
+        self.linked = 0
+
+    def link(self, llvm_ir):
+        self.linked += 1
+        return b"library:" + llvm_ir.encode()
+
+    def strip(self, library):
+        return library[len(b"library:"):]
+
+
+def _compile(cache, target, llvm_ir):
+    # as in Core._submit
+    key, entry = cache.lookup(target, llvm_ir)
+    if entry is not None:
+        return entry
+    library = target.link(llvm_ir)
+    stripped_library = target.strip(library)
+    cache.store(key, library, stripped_library)
+    return library, stripped_library
+
+
+class KernelCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = KernelCache(self.tmpdir.name, max_size=1000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hit(self):
+        target = _Target()
+        self.assertEqual(_compile(self.cache, target, "a"),
+                         (b"library:a", b"a"))
+        self.assertEqual(_compile(self.cache, target, "a"),
+                         (b"library:a", b"a"))
+        self.assertEqual(_compile(self.cache, target, "b"),
+                         (b"library:b", b"b"))
+        self.assertEqual(target.linked, 2)
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(self.cache.stats["misses"], 2)
+
+        # shared between instances
+        cache = KernelCache(self.tmpdir.name)
+        _compile(cache, _Target(), "a")
+        self.assertEqual(cache.stats["hits"], 1)
+
+    def test_key(self):
+        self.assertNotEqual(self.cache.key(_Target(), "a"),
+                            self.cache.key(_Target(subkernel_id=1), "a"))
+        self.assertNotEqual(self.cache.key(_Target(), "a"),
+                            self.cache.key(_Target(opt_level=0), "a"))
+        self.assertNotEqual(self.cache.key(_Target(), "a"),
+                            self.cache.key(_Target(), "b"))
+        target = _Target()
+        target.tool_ld = sys.executable  # prints another version
+        self.assertNotEqual(self.cache.key(_Target(), "a"),
+                            self.cache.key(target, "a"))
+        self.assertEqual(self.cache.key(_Target(), "a"),
+                         self.cache.key(_Target(), "a"))
+
+    def _set_mtime(self, target, module, t):
+        path = os.path.join(self.tmpdir.name,
+                            self.cache.key(target, module) + KernelCache.suffix)
+        os.utime(path, (t, t))
+
+    def test_evict(self):
+        # each entry takes 412 bytes, two of them fit in the cache
+        target = _Target()
+        for t, m in enumerate("abc"):
+            _compile(self.cache, target, m*200)
+            self._set_mtime(target, m*200, t)
+        self.assertEqual(self.cache.stats["evictions"], 1)
+        self.assertIsNone(self.cache.get(self.cache.key(target, "a"*200)))
+
+        _compile(self.cache, target, "b"*200)
+        _compile(self.cache, target, "d"*200)
+        self.assertEqual(self.cache.stats["evictions"], 2)
+        self.assertEqual(
+            [self.cache.get(self.cache.key(target, m*200)) is not None
+             for m in "abcd"],
+            [False, True, False, True])
+
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
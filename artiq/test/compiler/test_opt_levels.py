@@ -0,0 +1,81 @@
+import unittest
+
+import llvmlite.binding as llvm
+
+from artiq.language.core import kernel
+from artiq.coredevice.core import Core
+from artiq.compiler.targets import OPT_LEVELS, RV32GTarget
+
+
+_llvm_ir = """
+define internal i32 @square(i32 %x) {
+  %y = mul i32 %x, %x
+  ret i32 %y
+}
+
+define internal i32 @unused() {
+  ret i32 0
+}
+
+define i32 @f(i32 %x) {
+  %p = alloca i32
+  store i32 %x, i32* %p
+  %v = load i32, i32* %p
+  %y = call i32 @square(i32 %v)
+  %z = add i32 %y, 0
+  ret i32 %z
+}
+"""
+
+
+class _Experiment:
+    @kernel
+    def default(self):
+        pass
+
+    @kernel(flags={"opt0"})
+    def fast(self):
+        pass
+
+    @kernel(flags={"opt0", "opt2"})
+    def conflicting(self):
+        pass
+
+
+class OptLevelTest(unittest.TestCase):
+    def make_core(self, **kwargs):
+        dmgr = dict()
+        dmgr["core"] = Core(dmgr, None, 1e-9, **kwargs)
+        return dmgr["core"]
+
+    def test_core(self):
+        with self.assertRaises(ValueError):
+            self.make_core(opt_level=3)
+        core = self.make_core(opt_level=1)
+        self.assertEqual(core._opt_level(_Experiment.default), 1)
+        self.assertEqual(core._opt_level(_Experiment.fast), 0)
+        with self.assertRaises(ValueError):
+            core._opt_level(_Experiment.conflicting)
+
+    def test_optimize(self):
+        results = []
+        for opt_level in OPT_LEVELS:
+            llmodule = llvm.parse_assembly(_llvm_ir)
+            RV32GTarget(opt_level=opt_level).optimize(llmodule)
+            llmodule.verify()
+            f = str(llmodule.get_function("f"))
+            functions = {function.name for function in llmodule.functions}
+            results.append({
+                "alloca": "alloca" in f,
+                "combined": "add" not in f,
+                "inlined": "call" not in f,
+                "global_dce": "unused" not in functions
+            })
+        # every level promotes local variables to registers
+        self.assertEqual([r["alloca"] for r in results], [False]*3)
+        # level 1 adds the cleanup passes
+        self.assertEqual([r["combined"] for r in results], [False, True, True])
+        # only level 2 inlines functions and performs global optimizations
+        self.assertEqual([r["inlined"] for r in results], [False, False, True])
+        self.assertEqual([r["global_dce"] for r in results],
+                         [False, False, True])
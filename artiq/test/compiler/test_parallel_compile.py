@@ -0,0 +1,31 @@
+import shutil
+import unittest
+
+from artiq.coredevice.core import Core
+from artiq.compiler.testbench.perf_subkernels import make_benchmark
+
+
+@unittest.skipIf(shutil.which("ld.lld") is None, "linker not available")
+class ParallelCompileTest(unittest.TestCase):
+    def compile(self, compile_workers):
+        dmgr = dict()
+        core = dmgr["core"] = Core(
+            dmgr, None, 1e-9,
+            satellite_cpu_targets={i + 1: "rv32g" for i in range(4)},
+            compile_workers=compile_workers)
+        try:
+            experiment = make_benchmark(core, 4)
+            (_, kernel_library, _, _, _), subkernels = \
+                core._compile_with_subkernels(
+                    type(experiment).run, (experiment,), {}, None)
+            return kernel_library, subkernels
+        finally:
+            core.close()
+
+    def test_parallel(self):
+        kernel_library, subkernels = self.compile(2)
+        self.assertEqual([(sid, destination)
+                          for _, sid, destination in subkernels],
+                         sorted((sid, destination)
+                                for _, sid, destination in subkernels))
+        self.assertEqual((kernel_library, subkernels), self.compile(0))
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from artiq.compiler import profiler
+from artiq.compiler.testbench import perf_suite
+
+
+def _run(total, phases, host="host"):
+    return {"host": host, "backend": True,
+            "results": {"case": {"total": total, "phases": phases}}}
+
+
+class PerfSuiteTest(unittest.TestCase):
+    def test_measure(self):
+        def compile_case(backend):
+            with profiler.stage("kernel"):
+                with profiler.stage("inference", iteration=0):
+                    pass
+                with profiler.stage("inference", iteration=1):
+                    pass
+            if backend:
+                with profiler.stage("kernel/backend"):
+                    pass
+        result = perf_suite.measure(compile_case, 2, True)
+        self.assertEqual(sorted(result["phases"]),
+                         ["backend", "frontend", "inference"])
+        self.assertGreaterEqual(result["total"],
+                                result["phases"]["frontend"])
+
+    def test_regressions(self):
+        history = {"version": perf_suite.HISTORY_VERSION, "runs": [
+            _run(1.0, {"frontend": 0.5}),
+            _run(1.1, {"frontend": 0.5}),
+            _run(0.1, {"frontend": 0.05}, host="other"),
+        ]}
+        self.assertEqual(
+            perf_suite.find_regressions(history, _run(1.1, {"frontend": 0.5})),
+            [])
+        self.assertEqual(
+            perf_suite.find_regressions(history, _run(1.5, {"frontend": 0.5})),
+            [("case", "total", 1.05, 1.5)])
+        # below the minimum slowdown
+        self.assertEqual(
+            perf_suite.find_regressions(history, _run(1.1, {"frontend": 0.5}),
+                                        threshold=0.01, min_delta=0.1),
+            [])
+        # no history on this host
+        self.assertEqual(
+            perf_suite.find_regressions(history,
+                                        _run(5.0, {}, host="new")),
+            [])
+
+    def test_history(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "history.json")
+            history = perf_suite.load_history(filename)
+            self.assertEqual(history["runs"], [])
+            history["runs"].append(_run(1.0, {}))
+            perf_suite.save_history(filename, history)
+            self.assertEqual(perf_suite.load_history(filename), history)
@@ -0,0 +1,47 @@
+import json
+import unittest
+
+from artiq.compiler import profiler
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_inactive(self):
+        self.assertIsNone(profiler.active())
+        with profiler.stage("a") as record:
+            self.assertIsNone(record)
+
+    def test_stages(self):
+        p = profiler.Profiler()
+        with profiler.activate(p):
+            self.assertIs(profiler.active(), p)
+            with profiler.stage("kernel"):
+                with profiler.stage("inference", iteration=0):
+                    data = bytearray(1 << 20)
+                    del data
+                with profiler.stage("module"):
+                    pass
+        self.assertIsNone(profiler.active())
+        p.merge([{"name": "kernel/backend", "start": p.start + 100,
+                  "time": 0.0}])
+
+        report = json.loads(json.dumps(p.report(function="run")))
+        self.assertEqual(report["version"], profiler.REPORT_VERSION)
+        self.assertEqual(report["function"], "run")
+        self.assertEqual([stage["name"] for stage in report["stages"]],
+                         ["kernel", "kernel/inference", "kernel/module",
+                          "kernel/backend"])
+        kernel, inference, module, _ = report["stages"]
+        self.assertEqual(inference["iteration"], 0)
+        self.assertGreaterEqual(inference["peak_memory"], 1 << 20)
+        self.assertGreaterEqual(kernel["peak_memory"],
+                                inference["peak_memory"])
+        self.assertLess(module["peak_memory"], 1 << 20)
+        self.assertGreaterEqual(kernel["time"],
+                                inference["time"] + module["time"])
+
+    def test_no_memory(self):
+        p = profiler.Profiler(trace_memory=False)
+        with profiler.activate(p), profiler.stage("a"):
+            pass
+        stage, = p.report()["stages"]
+        self.assertNotIn("peak_memory", stage)
@@ -0,0 +1,417 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import numpy
+
+from artiq.coredevice.comm_kernel import (CommKernel, RPCReturnValueError,
+                                          _receive_list, _receive_array)
+
+
+class _StandInDevice:
+    """Accepts a connection of :class:`CommKernel` on the loopback
+    interface, and sends it ``payload`` as a little-endian core device."""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        connection, _ = self.server.accept()
+        with connection:
+            hello = b""
+            while not hello.endswith(b"\n"):
+                hello += connection.recv(1)
+            connection.sendall(b"e")
+            connection.sendall(self.payload)
+            # wait for the client to close the connection
+            connection.recv(1)
+
+    def close(self):
+        self.thread.join()
+        self.server.close()
+
+
+def _pack_int32_list(values):
+    return b"l" + struct.pack("<lc", len(values), b"i") + \
+        numpy.array(values, "<i4").tobytes()
+
+
+def _pack_float_list(values):
+    return b"l" + struct.pack("<lc", len(values), b"f") + \
+        numpy.array(values, "<f8").tobytes()
+
+
+def _pack_int32_array(array):
+    return b"a" + bytes([array.ndim]) + \
+        struct.pack("<{}l".format(array.ndim), *array.shape) + b"i" + \
+        array.astype("<i4").tobytes()
+
+
+def _pack_bytes(value):
+    return b"B" + struct.pack("<l", len(value)) + value
+
+
+def _pack_string(value):
+    return b"s" + _pack_bytes(value.encode())[1:]
+
+
+def _pack_int32(value):
+    return b"i" + struct.pack("<l", value)
+
+
+def _receive(payload, count):
+    device = _StandInDevice(payload)
+    comm = CommKernel("127.0.0.1", device.port)
+    try:
+        comm.open()
+        return [comm._receive_rpc_value(None) for _ in range(count)]
+    finally:
+        comm.close()
+        device.close()
+
+
+class ReceiveTest(unittest.TestCase):
+    def test_values(self):
+        window = CommKernel.read_buffer_size
+        array = numpy.arange(3*window, dtype=numpy.int32).reshape(3, window)
+        values = [
+            12,
+            "kernel",
+            list(range(window // 4 - 3)),
+            b"\xff" * (window // 2 + 1),
+            -1,
+            [0.5*i for i in range(window)],
+            array,
+            b"",
+            list(range(5)),
+            "µs" * window,
+        ]
+        payload = b"".join([
+            _pack_int32(values[0]), _pack_string(values[1]),
+            _pack_int32_list(values[2]), _pack_bytes(values[3]),
+            _pack_int32(values[4]), _pack_float_list(values[5]),
+            _pack_int32_array(values[6]), _pack_bytes(values[7]),
+            _pack_int32_list(values[8]), _pack_string(values[9])])
+
+        received = _receive(payload, len(values))
+        for value, expected in zip(received, values):
+            if isinstance(expected, numpy.ndarray):
+                numpy.testing.assert_array_equal(value, expected)
+            else:
+                self.assertEqual(value, expected)
+        # received arrays are not overwritten by later reads
+        numpy.testing.assert_array_equal(received[6], array)
+
+
+class _Loopback:
+    """Stands in for the socket of a :class:`CommKernel`; the data sent to
+    it can be received back."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.position = 0
+
+    def sendall(self, data):
+        self.data += data
+
+    def recv_into(self, view, nbytes, flags=0):
+        chunk = self.data[self.position:self.position + nbytes]
+        view[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+class SendTest(unittest.TestCase):
+    def setUp(self):
+        self.loopback = _Loopback()
+        self.comm = CommKernel("127.0.0.1")
+        self.comm.socket = self.loopback
+        self.comm._set_endian("<")
+
+    def tearDown(self):
+        self.comm.close()
+
+    def send(self, tags, value):
+        del self.loopback.data[:]
+        self.comm._send_rpc_value(bytearray(tags), value, None, None)
+        self.comm._flush()
+        return bytes(self.loopback.data)
+
+    def receive(self, receiver, data):
+        self.loopback.data[:] = data
+        self.loopback.position = 0
+        return receiver(self.comm, None)
+
+    def round_trip_list(self, tag, value):
+        data = self.send(b"l" + tag, value)
+        # the device sends the element tag after the length
+        return self.receive(_receive_list, data[:4] + tag + data[4:])
+
+    def round_trip_array(self, tag, value):
+        data = self.send(b"a" + bytes([value.ndim]) + tag, value)
+        header = 4*value.ndim
+        return self.receive(_receive_array, bytes([value.ndim]) +
+                            data[:header] + tag + data[header:])
+
+    def test_lists(self):
+        for tag, value in [
+                (b"b", [True, False, True]),
+                (b"i", [0, -2**31, 2**31 - 1, numpy.int32(7), True]),
+                (b"I", [0, -2**63, 2**63 - 1, numpy.int64(7)]),
+                (b"f", [0.5, -1.25, 3, float("inf")]),
+                (b"i", list(range(100000))),
+                (b"f", [])]:
+            self.assertEqual(self.round_trip_list(tag, value), value)
+
+    def test_arrays(self):
+        for tag, value in [
+                (b"b", numpy.array([[True, False], [False, True]])),
+                (b"i", numpy.arange(24, dtype=numpy.int64).reshape(2, 3, 4)),
+                (b"I", numpy.array([-2**63, 2**63 - 1])),
+                (b"f", numpy.linspace(0, 1, 100).reshape(10, 10)),
+                (b"f", numpy.arange(10, dtype=numpy.int32)),
+                (b"i", numpy.arange(12, dtype=numpy.int32).reshape(3, 4).T),
+                (b"i", numpy.zeros((0, 3), dtype=numpy.int32))]:
+            received = self.round_trip_array(tag, value)
+            self.assertEqual(received.shape, value.shape)
+            numpy.testing.assert_array_equal(received, value)
+
+    def test_tuple_lists(self):
+        tags = b"t\x04bIif"
+        value = [(i % 2 == 0, -i << 40, i, i / 4) for i in range(1000)]
+        per_element = b"".join(self.send(tags, elt) for elt in value)
+        data = self.send(b"l" + tags, value)
+        self.assertEqual(data, struct.pack("<l", len(value)) + per_element)
+        self.assertEqual(self.send(b"l" + tags, []), struct.pack("<l", 0))
+
+    def test_nested_lists(self):
+        value = [[1, 2], [], [3]]
+        self.assertEqual(self.send(b"lli", value),
+                         struct.pack("<7l", 3, 2, 1, 2, 0, 1, 3))
+
+    def test_mismatches(self):
+        for tags, value in [
+                (b"lb", [True, 1]),
+                (b"li", [1, 2**31]),
+                (b"li", [1, 2.0]),
+                (b"li", [[1], [2]]),
+                (b"lI", [2**63]),
+                (b"lf", [1.0, "2"]),
+                (b"lt\x02if", [(1, 2.0), (1,)]),
+                (b"lt\x02if", [(1, 2.0), (2**31, 2.0)]),
+                (b"lt\x02if", [([1, 2], 1.0)]),
+                (b"lt\x02if", [(1, numpy.zeros(2))]),
+                (b"a\x01i", numpy.array([0.5])),
+                (b"a\x01i", numpy.array([2**31])),
+                (b"a\x01I", numpy.array([2**63], dtype=numpy.uint64)),
+                (b"a\x01b", numpy.array([0, 1]))]:
+            with self.assertRaises(RPCReturnValueError):
+                self.send(tags, value)
+
+
+def _pack_rpc_request(service_id, args, is_async):
+    return b"\x5a\x5a\x5a\x5a\x0a" + bytes([is_async]) + \
+        struct.pack("<l", service_id) + b"".join(map(_pack_int32, args)) + \
+        b"\x00" + _pack_bytes(b"n")[1:]
+
+
+_kernel_finished = b"\x5a\x5a\x5a\x5a\x07\x00"
+
+
+class _EmbeddingMap:
+    def __init__(self, services):
+        self.services = services
+
+    def retrieve_object(self, service_id):
+        return self.services[service_id]
+
+
+def _serve(loopback, services, requests, **kwargs):
+    loopback.data += b"".join(
+        _pack_rpc_request(service_id, args, is_async)
+        for service_id, args, is_async in requests) + _kernel_finished
+    comm = CommKernel("127.0.0.1", **kwargs)
+    comm.socket = loopback
+    comm._set_endian("<")
+    try:
+        comm.serve(_EmbeddingMap(services), None, None)
+        return comm
+    finally:
+        comm.close()
+
+
+class AsyncRPCTest(unittest.TestCase):
+    def serve(self, services, requests, async_rpc_queue):
+        self.loopback = _Loopback()
+        self.end = len(b"".join(_pack_rpc_request(*request)
+                                for request in requests) + _kernel_finished)
+        comm = _serve(self.loopback, services, requests,
+                      async_rpc_queue=async_rpc_queue)
+        return comm.async_rpc_stats()
+
+    def test_order(self):
+        calls = []
+        def record(value):
+            time.sleep(0.01)
+            calls.append((value, threading.current_thread()))
+        def observe():
+            calls.append(("sync", list(calls)))
+        stats = self.serve({1: record, 2: observe},
+                           [(1, [0], True), (1, [1], True), (2, [], False),
+                            (1, [2], True)], 2)
+        self.assertEqual([value for value, _ in calls],
+                         [0, 1, "sync", 2])
+        # the synchronous RPC observes the completed async RPCs
+        self.assertEqual(len(calls[2][1]), 2)
+        self.assertIsNot(calls[0][1], threading.current_thread())
+        self.assertEqual(stats["calls"], 3)
+        self.assertGreaterEqual(stats["max_latency"], 0.01)
+
+    def test_inline(self):
+        threads = []
+        stats = self.serve({1: lambda: threads.append(threading.current_thread())},
+                           [(1, [], True)], 0)
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertIsNone(stats)
+
+    def test_concurrency(self):
+        positions = []
+        def slow():
+            time.sleep(0.1)
+            positions.append(self.loopback.position)
+        stats = self.serve({1: slow, 2: lambda: None},
+                           [(1, [], True)] + [(2, [], True)]*2, 4)
+        # the host has read the end of the kernel while the RPC was running
+        self.assertEqual(positions, [self.end])
+        self.assertEqual(stats["max_depth"], 3)
+
+    def test_exception(self):
+        calls = []
+        def fail():
+            raise ZeroDivisionError
+        with self.assertRaises(ZeroDivisionError):
+            self.serve({1: fail, 2: lambda: calls.append(2)},
+                       [(1, [], True), (2, [], True)], 1)
+        self.assertEqual(calls, [])
+
+    def test_abandoned(self):
+        calls = []
+        def fail():
+            time.sleep(0.05)
+            raise ZeroDivisionError
+        services = {1: fail, 2: lambda: calls.append(2),
+                    3: lambda: calls.append(3)}
+        comm = CommKernel("127.0.0.1", async_rpc_queue=4)
+        comm.socket = _Loopback()
+        comm._set_endian("<")
+        try:
+            # the connection is lost while async RPCs are still queued
+            comm.socket.data += b"".join(
+                _pack_rpc_request(service_id, [], True)
+                for service_id in (1, 2, 2))
+            with self.assertRaises(OSError):
+                comm.serve(_EmbeddingMap(services), None, None)
+            time.sleep(0.1)
+            self.assertEqual(calls, [])
+
+            # the error of the abandoned kernel is not raised by the next one
+            comm.socket = _Loopback()
+            comm.socket.data += _pack_rpc_request(3, [], False) + _kernel_finished
+            comm.serve(_EmbeddingMap(services), None, None)
+            self.assertEqual(calls, [3])
+        finally:
+            comm.close()
+
+
+class RPCProfileTest(unittest.TestCase):
+    def test_stats(self):
+        def record(*values):
+            time.sleep(0.01)
+        def get():
+            pass
+        requests = [(1, [1, 2], True), (2, [], False), (1, [3], True)]
+        for async_rpc_queue in (0, 2):
+            comm = _serve(_Loopback(), {1: record, 2: get}, requests,
+                          async_rpc_queue=async_rpc_queue, profile_rpc=True)
+            record_stats, get_stats = comm.rpc_stats()
+            self.assertEqual(record_stats["name"], record.__qualname__)
+            self.assertEqual(record_stats["calls"], 2)
+            self.assertEqual(record_stats["async_calls"], 2)
+            self.assertGreaterEqual(record_stats["time"], 0.02)
+            # the requests without the message header
+            self.assertEqual(record_stats["bytes_received"],
+                             len(_pack_rpc_request(*requests[0])) - 5 +
+                             len(_pack_rpc_request(*requests[2])) - 5)
+            self.assertEqual(record_stats["bytes_sent"], 0)
+            self.assertEqual(get_stats["service_id"], 2)
+            self.assertEqual(get_stats["async_calls"], 0)
+            # header, return tags and no value
+            self.assertEqual(get_stats["bytes_sent"], 5 + 4 + 1)
+
+            events = comm.rpc_profiler.chrome_trace()["traceEvents"]
+            self.assertEqual([(event["name"], event["cat"]) for event in events],
+                             [("kernel", "kernel"),
+                              (record.__qualname__, "async_rpc"),
+                              (get.__qualname__, "rpc"),
+                              (record.__qualname__, "async_rpc")])
+            self.assertTrue(all(event["ts"] >= 0 and event["dur"] >= 0
+                                for event in events))
+
+    def test_disabled(self):
+        comm = _serve(_Loopback(), {1: lambda: None}, [(1, [], False)])
+        self.assertEqual(comm.rpc_stats(), [])
+
+
+class ReceiveThroughputTest(unittest.TestCase):
+    """Measures how fast RPC arguments are received from a stand-in
+    device on the loopback interface, for comparison with the figures of
+    :mod:`artiq.test.coredevice.test_performance` on hardware."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        print()
+        print("| {:<30} | MiB/s   |".format("Test"))
+        print("| {} | ------- |".format("-" * 30))
+        for name, throughput in cls.results:
+            print("| {:<30} | {:>7.1f} |".format(name, throughput))
+
+    def measure(self, name, payload, count, check):
+        t0 = time.perf_counter()
+        received = _receive(payload*count, count)
+        duration = time.perf_counter() - t0
+        check(received[-1])
+        self.results.append((name, len(payload)*count/duration/(1 << 20)))
+
+    def test_bytes(self):
+        value = b"\x00" * (16 << 20)
+        self.measure("Bytes (16MB)", _pack_bytes(value), 4,
+                     lambda received: self.assertEqual(len(received), len(value)))
+
+    def test_array(self):
+        value = numpy.arange(4 << 20, dtype=numpy.int32)
+        self.measure("Int32 array (16MB)", _pack_int32_array(value), 4,
+                     lambda received: numpy.testing.assert_array_equal(received, value))
+
+    def test_list(self):
+        value = list(range(1 << 20))
+        self.measure("Int32 list (4MB)", _pack_int32_list(value), 4,
+                     lambda received: self.assertEqual(received, value))
+
+    def test_small_values(self):
+        self.measure("Int32 values", _pack_int32(123), 1 << 18,
+                     lambda received: self.assertEqual(received, 123))
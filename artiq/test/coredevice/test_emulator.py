@@ -0,0 +1,187 @@
+import asyncio
+import time
+import unittest
+
+import numpy
+
+from artiq.coredevice.comm_kernel import CommKernel
+from artiq.coredevice.comm_mgmt import CommMgmt
+from artiq.coredevice.comm_analyzer import (get_analyzer_dump, decode_dump,
+                                            OutputMessage, StoppedMessage)
+from artiq.coredevice.comm_moninj import CommMonInj
+from artiq.coredevice.emulator import (CoreDeviceEmulator, RPCTraffic,
+                                       synthetic_analyzer_dump)
+
+
+class _EmbeddingMap:
+    def __init__(self, services):
+        self.objects = dict(services)
+        self.strings = []
+
+    def store_str(self, value):
+        self.strings.append(value)
+        return len(self.strings) - 1
+
+    def retrieve_str(self, key):
+        return self.strings[key]
+
+    def store_object(self, obj):
+        key = max(self.objects, default=0) + 1
+        self.objects[key] = obj
+        return key
+
+    def retrieve_object(self, key):
+        return self.objects[key]
+
+
+def _run_kernel(emulator, services):
+    comm = CommKernel(emulator.host, emulator.ports["kernel"])
+    try:
+        comm.check_system_info()
+        comm.load(b"\x00" * 100)
+        comm.run()
+        comm.serve(_EmbeddingMap(services), lambda backtrace: [],
+                   lambda names: names)
+    finally:
+        comm.close()
+
+
+class KernelTest(unittest.TestCase):
+    def test_rpcs(self):
+        received, returned = [], []
+        def record(value):
+            received.append(value)
+        def get(value):
+            returned.append(value)
+            return [1, 2, 3]
+        script = [RPCTraffic(1, 10, "list", 400, is_async=True),
+                  RPCTraffic(2, 3, "bytes", 100, return_tags=b"li"),
+                  RPCTraffic(1, 1, "array", 40)]
+        with CoreDeviceEmulator(ports=dict.fromkeys(CoreDeviceEmulator.default_ports, 0),
+                                rpc_script=script) as emulator:
+            _run_kernel(emulator, {1: record, 2: get})
+            # the connection can run another kernel
+            _run_kernel(emulator, {1: record, 2: get})
+        self.assertEqual(len(received), 22)
+        self.assertEqual(received[0], list(range(100)))
+        numpy.testing.assert_array_equal(received[10], numpy.arange(10))
+        self.assertEqual(returned, [b"\x00" * 100] * 6)
+
+    def test_exception(self):
+        def fail(value):
+            raise ValueError("invalid value {}".format(value))
+        script = [RPCTraffic(1, 2, "int32", 42)]
+        with CoreDeviceEmulator(ports=dict.fromkeys(CoreDeviceEmulator.default_ports, 0),
+                                rpc_script=script) as emulator:
+            with self.assertRaisesRegex(ValueError, "invalid value 42"):
+                _run_kernel(emulator, {1: fail})
+
+    def test_rate(self):
+        calls = []
+        script = [RPCTraffic(1, 6, rate=50, is_async=True)]
+        with CoreDeviceEmulator(ports=dict.fromkeys(CoreDeviceEmulator.default_ports, 0),
+                                rpc_script=script) as emulator:
+            t0 = time.monotonic()
+            _run_kernel(emulator, {1: calls.append})
+            duration = time.monotonic() - t0
+        self.assertEqual(len(calls), 6)
+        self.assertGreaterEqual(duration, 0.1)
+
+
+class MgmtTest(unittest.TestCase):
+    def test_mgmt(self):
+        with CoreDeviceEmulator(ports=dict.fromkeys(CoreDeviceEmulator.default_ports, 0)) as emulator:
+            comm = CommMgmt(emulator.host, emulator.ports["mgmt"])
+            try:
+                self.assertIn("emulator started", comm.get_log())
+                comm.set_log_level("DEBUG")
+                comm.config_write("foo", b"bar")
+                self.assertEqual(comm.config_read("foo"), "bar")
+                comm.config_remove("foo")
+                with self.assertRaises(IOError):
+                    comm.config_read("foo")
+                comm.clear_log()
+                self.assertEqual(comm.get_log(), "")
+                comm.reboot()
+            finally:
+                comm.close()
+
+
+class AnalyzerTest(unittest.TestCase):
+    def test_dump(self):
+        dump = synthetic_analyzer_dump(10, channels=2)
+        with CoreDeviceEmulator(ports=dict.fromkeys(CoreDeviceEmulator.default_ports, 0),
+                                analyzer_dump=dump) as emulator:
+            self.assertEqual(get_analyzer_dump(emulator.host,
+                                               emulator.ports["analyzer"]), dump)
+        messages = decode_dump(dump).messages
+        self.assertEqual(len(messages), 11)
+        self.assertEqual(messages[3], OutputMessage(channel=1, timestamp=24,
+                                                    rtio_counter=24, address=0,
+                                                    data=1))
+        self.assertEqual(messages[-1], StoppedMessage(rtio_counter=80))
+
+
+class MonInjTest(unittest.TestCase):
+    def test_moninj(self):
+        probes, injections = [], []
+        async def run(port):
+            comm = CommMonInj(lambda *args: probes.append(args),
+                              lambda *args: injections.append(args))
+            await comm.connect("127.0.0.1", port)
+            try:
+                comm.monitor_probe(True, 3, 0)
+                comm.monitor_injection(True, 3, 1)
+                comm.inject(3, 1, 1)
+                comm.get_injection_status(3, 2)
+                while len(probes) < 4:
+                    await asyncio.sleep(0.01)
+            finally:
+                await comm.close()
+
+        with CoreDeviceEmulator(ports=dict.fromkeys(CoreDeviceEmulator.default_ports, 0),
+                                moninj_rate=100) as emulator:
+            asyncio.run(asyncio.wait_for(run(emulator.ports["moninj"]), 10))
+        self.assertEqual(probes[:4], [(3, 0, value) for value in range(4)])
+        self.assertEqual(injections, [(3, 1, 0), (3, 1, 1), (3, 2, 0)])
+
+
+class KernelThroughputTest(unittest.TestCase):
+    """Measures how fast the host serves the RPCs of the emulated kernel."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        print()
+        print("| {:<30} | RPCs/s   | MiB/s   |".format("Test"))
+        print("| {} | -------- | ------- |".format("-" * 30))
+        for name, rate, throughput in cls.results:
+            print("| {:<30} | {:>8.0f} | {:>7.1f} |".format(name, rate, throughput))
+
+    def measure(self, name, traffic):
+        with CoreDeviceEmulator(ports=dict.fromkeys(CoreDeviceEmulator.default_ports, 0),
+                                rpc_script=[traffic]) as emulator:
+            calls = []
+            t0 = time.perf_counter()
+            _run_kernel(emulator, {1: lambda value: calls.append(None)})
+            duration = time.perf_counter() - t0
+        self.assertEqual(len(calls), traffic.count)
+        self.results.append((name, traffic.count/duration,
+                             traffic.count*len(traffic.request)/duration/(1 << 20)))
+
+    def test_async(self):
+        self.measure("Async int32 RPCs", RPCTraffic(count=20000, is_async=True))
+
+    def test_sync(self):
+        self.measure("Sync int32 RPCs", RPCTraffic(count=2000))
+
+    def test_bytes(self):
+        self.measure("Async bytes (1MB)",
+                     RPCTraffic(count=64, kind="bytes", size=1 << 20, is_async=True))
+
+    def test_list(self):
+        self.measure("Async int32 lists (64kB)",
+                     RPCTraffic(count=256, kind="list", size=1 << 16, is_async=True))
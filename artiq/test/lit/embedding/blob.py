@@ -0,0 +1,19 @@
+# RUN: env ARTIQ_DUMP_UNOPT_LLVM=%t %python -m artiq.compiler.testbench.embedding +compile %s
+# RUN: OutputCheck %s --file-to-check=%t_unopt.ll
+
+from artiq.language.core import *
+from artiq.language.types import *
+import numpy
+
+# CHECK-L: private global [8192 x i8] c"\00\00\00\00\00\00\00\00\00\00\00\00\00\00\e0?
+float_table = [0.5 * i for i in range(1024)]
+# CHECK-L: private global [4096 x i8] c"\00\00\00\00\01\00\00\00\02\00\00\00
+int_table = list(range(1024))
+# CHECK-L: private global [16384 x i8] c"\00\00\00\00\00\00\00\00\01\00\00\00\00\00\00\00
+int_array = numpy.arange(2048).reshape((2, 1024))
+
+@kernel
+def entrypoint():
+    core_log(float_table[1])
+    core_log(int_table[1])
+    core_log(int_array[1][0])
@@ -0,0 +1,143 @@
+"""Tests for the persistent storage of datasets in the master."""
+
+import asyncio
+import os
+import tempfile
+import unittest
+from time import perf_counter
+
+import lmdb
+import numpy as np
+
+from sipyco import pyon
+
+from artiq.master.databases import (DatasetDB, encode_dataset_record,
+                                    decode_dataset_record)
+
+
+class DatasetDBCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.persist_file = os.path.join(self.tmpdir.name, "dataset_db.mdb")
+
+    def _open(self):
+        ddb = DatasetDB(self.persist_file)
+        self.addCleanup(ddb.close_db)
+        return ddb
+
+    def test_record(self):
+        value = {"array": np.arange(10, dtype=np.int32),
+                 "matrix": np.ones((3, 4)),
+                 "scalar": np.float32(1.5),
+                 "list": [1, "a", None]}
+        decoded, metadata, current = decode_dataset_record(
+            encode_dataset_record(value, {"unit": "s"}))
+        self.assertTrue(current)
+        self.assertEqual(metadata, {"unit": "s"})
+        self.assertEqual(decoded["list"], value["list"])
+        self.assertEqual(decoded["scalar"], value["scalar"])
+        for key in "array", "matrix":
+            self.assertEqual(decoded[key].dtype, value[key].dtype)
+            np.testing.assert_array_equal(decoded[key], value[key])
+        # arrays can be modified in place
+        decoded["array"][0] = 5
+
+        decoded, metadata, current = decode_dataset_record(
+            encode_dataset_record(42, {}))
+        self.assertEqual((decoded, metadata, current), (42, {}, True))
+
+    def test_lazy(self):
+        ddb = self._open()
+        ddb.set("a", np.arange(5), persist=True)
+        ddb.set("b", 1, persist=True, metadata={"unit": "V"})
+        ddb.set("c", 2, persist=False)
+        ddb.save()
+        ddb.close_db()
+
+        ddb = self._open()
+        self.assertEqual(set(ddb.unloaded_keys), {"a", "b"})
+        self.assertEqual(ddb.data.raw_view, dict())
+        self.assertEqual(ddb.get_metadata("b"), {"unit": "V"})
+        self.assertEqual(set(ddb.unloaded_keys), {"a"})
+        self.assertEqual(ddb.data.raw_view["b"], (True, 1, {"unit": "V"}))
+        with self.assertRaises(KeyError):
+            ddb.get("c")
+        ddb.load_all()
+        np.testing.assert_array_equal(ddb.get("a"), np.arange(5))
+        self.assertEqual(ddb.pending_keys, set())
+
+    def test_migration(self):
+        env = lmdb.open(self.persist_file, subdir=False, map_size=2**30)
+        with env.begin(write=True) as txn:
+            txn.put(b"old", pyon.encode((np.arange(3), {"unit": "s"})).encode())
+        env.close()
+
+        ddb = self._open()
+        np.testing.assert_array_equal(ddb.get("old"), np.arange(3))
+        self.assertEqual(ddb.pending_keys, {"old"})
+        ddb.save()
+        with ddb.lmdb.begin() as txn:
+            value, metadata, current = decode_dataset_record(txn.get(b"old"))
+        self.assertTrue(current)
+        np.testing.assert_array_equal(value, np.arange(3))
+
+    def test_background_load(self):
+        ddb = self._open()
+        for i in range(100):
+            ddb.set(str(i), i, persist=True)
+        ddb.save()
+        ddb.close_db()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        ddb = self._open()
+        mods = []
+        ddb.data.publish = mods.append
+        ddb.get("50")
+        loop.run_until_complete(ddb._load_background())
+        self.assertEqual(ddb.unloaded_keys, dict())
+        self.assertEqual(len(ddb.data.raw_view), 100)
+        # subscribers are notified of the datasets as they are loaded
+        self.assertEqual(sorted(mod["key"] for mod in mods),
+                         sorted(str(i) for i in range(100)))
+        self.assertEqual(mods[0]["value"], (True, 50, {}))
+
+    def test_large(self):
+        """Check that opening a large database does not decode it. The
+        bounds on the times to open it and to save one array are well above
+        the measured times, and only catch a return to decoding or encoding
+        the whole database."""
+        n_keys = 5000
+        n_arrays = 4
+        array = np.random.default_rng(0).standard_normal(2**17)  # 1 MiB
+
+        ddb = self._open()
+        for i in range(n_keys):
+            ddb.set("scalar.{}".format(i), float(i), persist=True)
+        for i in range(n_arrays):
+            ddb.set("array.{}".format(i), array.copy(), persist=True)
+        ddb.save()
+        ddb.close_db()
+
+        t0 = perf_counter()
+        ddb = self._open()
+        t_open = perf_counter() - t0
+        self.assertEqual(len(ddb.unloaded_keys), n_keys + n_arrays)
+        self.assertEqual(ddb.data.raw_view, dict())
+        self.assertLess(t_open, 0.5)
+        np.testing.assert_array_equal(ddb.get("array.3"), array)
+        self.assertEqual(len(ddb.data.raw_view), 1)
+        ddb.load_all()
+        self.assertEqual(len(ddb.data.raw_view), n_keys + n_arrays)
+
+        ddb.get("array.0")[0] = 0.0
+        ddb.pending_keys.add("array.0")
+        t0 = perf_counter()
+        ddb.save()
+        self.assertLess(perf_counter() - t0, 0.5)
+        ddb.close_db()
+        ddb = self._open()
+        self.assertEqual(ddb.get("array.0")[0], 0.0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
@@ -1,17 +1,24 @@
 """Tests for the (Env)Experiment-facing dataset interface."""
 
 import copy
+import io
+import time
 import unittest
 
+import h5py
+import numpy as np
+
 from sipyco.sync_struct import process_mod
 
 from artiq.experiment import EnvExperiment
-from artiq.master.worker_db import DatasetManager
+from artiq.master.worker_db import (DatasetManager, BatchPublisher,
+                                    DatasetCache, ResultsWriter)
 
 
 class MockDatasetDB:
     def __init__(self):
         self.data = dict()
+        self.batches = []
 
     def get(self, key):
         return self.data[key][1]
@@ -19,6 +26,11 @@ class MockDatasetDB:
     def get_metadata(self, key):
         return self.data[key][2]
 
+    def get_many(self, keys, prefixes):
+        return {key: (value, metadata)
+                for key, (_, value, metadata) in self.data.items()
+                if key in keys or key.startswith(tuple(prefixes))}
+
     def update(self, mod):
         # Copy mod before applying to avoid sharing references to objects
         # between this and the DatasetManager, which would lead to mods being
@@ -28,6 +40,16 @@ class MockDatasetDB:
     def delete(self, key):
         del self.data[key]
 
+    def update_batch(self, mods):
+        self.batches.append(copy.deepcopy(mods))
+        for mod in mods:
+            if mod["action"] == "extend":
+                for x in mod["xs"]:
+                    self.update({"action": "append", "path": mod["path"],
+                                 "x": x})
+            else:
+                self.update(mod)
+
 
 class TestExperiment(EnvExperiment):
     def get(self, key):
@@ -132,3 +154,223 @@ class ExperimentDatasetCase(unittest.TestCase):
         self.assertEqual(self.dataset_db.get_metadata(KEY), {})
 
 
+class BatchPublisherCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset_db = MockDatasetDB()
+        self.publisher = BatchPublisher(self.dataset_db.update_batch,
+                                        max_delay=1000., max_mods=100)
+        self.dataset_mgr = DatasetManager(self.dataset_db, self.publisher)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def test_set_then_append(self):
+        self.exp.set(KEY, [], broadcast=True)
+        for i in range(10):
+            self.exp.append(KEY, i)
+        self.assertEqual(self.dataset_db.batches, [])
+        self.publisher.flush()
+        self.assertEqual(len(self.dataset_db.batches), 1)
+        self.assertEqual(len(self.dataset_db.batches[0]), 1)
+        self.assertEqual(self.dataset_db.get(KEY), list(range(10)))
+        self.assertEqual(self.publisher.stats["merged"], 10)
+
+    def test_append_extend(self):
+        self.exp.set(KEY, [], broadcast=True)
+        self.publisher.flush()
+        for i in range(10):
+            self.exp.append(KEY, [i])
+        self.exp.append(KEY, [10])
+        self.publisher.flush()
+        batch = self.dataset_db.batches[-1]
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batch[0]["action"], "extend")
+        self.assertEqual(self.dataset_db.get(KEY), [[i] for i in range(11)])
+
+    def test_set_drops(self):
+        self.exp.set(KEY, [], broadcast=True)
+        self.publisher.flush()
+        self.exp.append(KEY, 1)
+        self.exp.set(KEY, 2, broadcast=True)
+        self.exp.set(KEY, 3, broadcast=True)
+        self.exp.set("bar", 4, broadcast=True)
+        self.publisher.flush()
+        self.assertEqual(len(self.dataset_db.batches[-1]), 2)
+        self.assertEqual(self.publisher.stats["dropped"], 2)
+        self.assertEqual(self.dataset_db.get(KEY), 3)
+        self.assertEqual(self.dataset_db.get("bar"), 4)
+
+    def test_mutate(self):
+        self.exp.set(KEY, [0, 0], broadcast=True)
+        self.publisher.flush()
+        for i in range(5):
+            self.exp.mutate_dataset(KEY, 0, i)
+        self.exp.mutate_dataset(KEY, 1, 5)
+        self.publisher.flush()
+        self.assertEqual(len(self.dataset_db.batches[-1]), 2)
+        self.assertEqual(self.dataset_db.get(KEY), [4, 5])
+
+    def test_mutate_array(self):
+        self.exp.set(KEY, np.zeros(4), broadcast=True)
+        self.publisher.flush()
+        index = np.array([1, 2])
+        self.exp.mutate_dataset(KEY, index, 1.)
+        self.exp.mutate_dataset(KEY, index, 2.)
+        self.exp.mutate_dataset(KEY, ((0, 2),), 3.)
+        self.exp.mutate_dataset(KEY, ((0, 2),), 4.)
+        self.publisher.flush()
+        self.assertEqual(len(self.dataset_db.batches[-1]), 4)
+        np.testing.assert_array_equal(self.dataset_db.get(KEY),
+                                      [4., 4., 2., 0.])
+
+    def test_modify_after_set(self):
+        value = [1, 2]
+        self.exp.set(KEY, value, broadcast=True)
+        self.exp.append(KEY, 3)
+        value.append(4)
+        value[:2] = [5, 6]
+        array = np.zeros(2)
+        self.exp.set("bar", array, broadcast=True)
+        array[:] = 1.
+        self.publisher.flush()
+        self.assertEqual(self.dataset_db.get(KEY), [1, 2, 3])
+        np.testing.assert_array_equal(self.dataset_db.get("bar"), [0., 0.])
+
+    def test_max_mods(self):
+        for i in range(100):
+            self.exp.set(str(i), i, broadcast=True)
+        self.assertEqual(len(self.dataset_db.batches), 1)
+        self.assertEqual(self.dataset_db.get("99"), 99)
+
+    def test_max_delay(self):
+        self.publisher.max_delay = 0.01
+        self.exp.set(KEY, 0, broadcast=True)
+        t0 = time.monotonic()
+        while not self.dataset_db.batches and time.monotonic() - t0 < 5:
+            time.sleep(0.01)
+        with self.publisher.lock:
+            self.assertEqual(self.dataset_db.get(KEY), 0)
+        self.publisher.close()
+
+
+class DatasetCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset_db = MockDatasetDB()
+        self.requests = []
+        self.cache = DatasetCache(self.get_datasets)
+        self.dataset_mgr = DatasetManager(self.dataset_db, cache=self.cache)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+        for i in range(3):
+            self.dataset_db.data["a." + str(i)] = (True, [i], {"unit": "s"})
+        self.dataset_db.data["b"] = (True, 42, {})
+
+    def get_datasets(self, keys, prefixes):
+        # In the worker, replies are added to the cache upon reception.
+        self.requests.append((keys, prefixes))
+        datasets = self.dataset_db.get_many(keys, prefixes)
+        self.cache.update(copy.deepcopy(datasets))
+        return datasets
+
+    def test_prefetch(self):
+        self.exp.prefetch_datasets(["b"], ["a."])
+        self.assertEqual(self.requests, [(["b"], ["a."])])
+        self.assertEqual(self.exp.get("a.1"), [1])
+        self.assertEqual(self.exp.get_metadata("a.2"), {"unit": "s"})
+        self.assertEqual(self.exp.get("b"), 42)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.cache.stats["hits"], 3)
+
+    def test_miss(self):
+        self.assertEqual(self.exp.get("b"), 42)
+        self.assertEqual(self.exp.get("b"), 42)
+        self.assertEqual(self.requests, [(["b"], [])])
+        with self.assertRaises(KeyError):
+            self.exp.get("c")
+
+    def test_invalidate(self):
+        self.exp.prefetch_datasets(prefixes=["a."])
+        self.dataset_db.data["a.0"] = (True, [5], {})
+        self.assertEqual(self.exp.get("a.0"), [0])
+        self.cache.invalidate(["a.0"])
+        self.assertEqual(self.exp.get("a.0"), [5])
+        self.assertEqual(self.cache.stats["invalidations"], 1)
+
+    def test_modify(self):
+        self.exp.prefetch_datasets(["b"], ["a."])
+        value = self.exp.get("a.0")
+        value.append(1)
+        self.assertEqual(self.exp.get("a.0"), [0])
+        self.exp.set("b", 43, broadcast=True)
+        self.assertEqual(self.exp.get("b"), 43)
+
+
+class ResultsWriterCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset_db = MockDatasetDB()
+        self.dataset_mgr = DatasetManager(self.dataset_db)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+        self.f = h5py.File(io.BytesIO(), "w")
+        self.exp.set("before", [1, 2], unit="s")
+        self.writer = ResultsWriter(self.f, self.dataset_mgr, compression=None)
+        self.dataset_mgr.results_writer = self.writer
+
+    def tearDown(self):
+        self.f.close()
+
+    def _compare(self):
+        reference = h5py.File(io.BytesIO(), "w")
+        self.dataset_mgr.write_hdf5(reference)
+        self.assertEqual(set(self.f["datasets"].keys()),
+                         set(reference["datasets"].keys()))
+        for key, dataset in reference["datasets"].items():
+            written = self.f["datasets"][key]
+            np.testing.assert_array_equal(written[()], dataset[()])
+            self.assertEqual(dict(written.attrs), dict(dataset.attrs))
+        reference.close()
+
+    def test_append(self):
+        self.writer.flush()
+        self.assertIsNotNone(self.f["datasets"]["before"].chunks)
+        for i in range(10):
+            self.exp.append("before", i)
+            if i % 3 == 0:
+                self.writer.flush()
+        self.writer.close()
+        self._compare()
+
+    def test_modify(self):
+        self.exp.set("x", [1, 2, 3])
+        self.exp.set("y", 1.5)
+        self.exp.set("z", np.zeros((4, 3)))
+        self.exp.set("empty", [])
+        self.writer.flush()
+        self.exp.append("x", 1.5)
+        self.exp.append("empty", 1)
+        self.exp.set("y", "text")
+        self.exp.mutate_dataset("z", (1, 3), 5)
+        self.exp.set("before", 0, archive=False, broadcast=True)
+        self.writer.flush()
+        self.assertEqual(self.f["datasets"]["x"].dtype, np.float64)
+        self._compare()
+
+    def test_snapshot(self):
+        self.exp.set("x", [[0, 0]])
+        self.exp.set("y", np.zeros(3))
+        self.writer.flush()
+        self.exp.append("x", [1, 1])
+        self.exp.mutate_dataset("y", (0, 2), 1.)
+        snapshot = self.writer._snapshot()
+        # modifications made while the snapshot is written are not included
+        self.exp.mutate_dataset("x", 1, [2, 2])
+        self.exp.mutate_dataset("y", 2, 2.)
+        self.assertEqual(snapshot["x"], (None, None, [[1, 1]]))
+        np.testing.assert_array_equal(snapshot["y"][0], [1., 1., 0.])
+
+    def test_background(self):
+        self.writer.flush_period = 0.01
+        self.writer.start()
+        self.exp.set("x", [])
+        for i in range(100):
+            self.exp.append("x", i)
+            time.sleep(0.0005)
+        self.writer.close()
+        self._compare()
+
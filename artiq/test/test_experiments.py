@@ -0,0 +1,90 @@
+import unittest
+import asyncio
+import os
+import tempfile
+
+from artiq.master.experiments import _RepoScanner, _ExamineCache, _blob_id
+
+
+_experiment = """
+from artiq.experiment import *
+{imports}
+
+class {name}(EnvExperiment):
+    \"\"\"{title}\"\"\"
+    def build(self):
+        self.setattr_argument("x", NumberValue({default}))
+
+    def run(self):
+        pass
+"""
+
+
+class ScanCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+
+    def _write(self, filename, content):
+        path = os.path.join(self.root, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def _scan(self, cache=None, max_workers=2, subdir=""):
+        scanner = _RepoScanner(dict(), max_workers, cache)
+        return self.loop.run_until_complete(scanner.scan(self.root, subdir))
+
+    def _populate(self):
+        self._write("helper.py", "DEFAULT = 1\n")
+        self._write("a.py", _experiment.format(
+            imports="", name="A", title="Same", default=1))
+        self._write("b.py", _experiment.format(
+            imports="from helper import DEFAULT", name="B", title="Same",
+            default="DEFAULT"))
+        self._write("sub/c.py", _experiment.format(
+            imports="", name="C", title="C", default=1))
+        self._write("broken.py", "raise ValueError\n")
+
+    def test_scan(self):
+        self._populate()
+        explist = self._scan()
+        self.assertEqual(set(explist.keys()), {"Same", "Same1", "sub/C"})
+        self.assertEqual(explist["sub/C"]["file"], os.path.join("sub", "c.py"))
+        self.assertEqual({explist["Same"]["file"], explist["Same1"]["file"]},
+                         {"a.py", "b.py"})
+
+    def test_subdir(self):
+        self._populate()
+        self._write("sub/deeper/d.py", _experiment.format(
+            imports="", name="D", title="D", default=1))
+        explist = self._scan(subdir="sub")
+        self.assertEqual(set(explist.keys()), {"C", "deeper/D"})
+        self.assertEqual(explist["C"]["file"], os.path.join("sub", "c.py"))
+        self.assertEqual(explist["deeper/D"]["file"],
+                         os.path.join("sub", "deeper", "d.py"))
+
+    def test_cache(self):
+        self._populate()
+        cache_file = os.path.join(self.root, "cache.pyon")
+        explist = self._scan(_ExamineCache(cache_file))
+
+        cache = _ExamineCache(cache_file)
+        self.assertEqual(len(cache.entries), 4)
+        b_id = _blob_id(os.path.join(self.root, "b.py"))
+        dependencies, _ = cache.entries[b_id]
+        self.assertEqual(list(dependencies.keys()), ["helper.py"])
+        self.assertEqual(self._scan(cache), explist)
+
+        # entries depending on a modified module are invalidated
+        self._write("helper.py", "DEFAULT = 2\n")
+        self.assertIsNone(cache.get(self.root, b_id))
+        explist = self._scan(cache)
+        entry, = [e for e in explist.values() if e["file"] == "b.py"]
+        self.assertEqual(entry["arginfo"]["x"][0]["default"], 2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
@@ -12,9 +12,9 @@ class TestFrontends(unittest.TestCase):
                 "corelog", "moninj_proxy"
             ],
             "artiq": [
-                "client", "compile", "coreanalyzer", "coremgmt",
-                "flash", "master", "mkfs", "route", "rtiomap",
-                "rtiomon", "run", "session", "browser", "dashboard"
+                "client", "compile", "coreanalyzer", "coreemu", "coremgmt",
+                "flash", "master", "mkfs", "results", "route",
+                "rtiomap", "rtiomon", "run", "session", "browser", "dashboard"
             ]
         }
 
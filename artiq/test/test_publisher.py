@@ -0,0 +1,170 @@
+import unittest
+import asyncio
+
+from sipyco.sync_struct import Notifier, process_mod
+from sipyco import pyon
+
+from artiq.master.publisher import CoalescingPublisher, _Subscriber
+
+
+def _decode(lines):
+    return [pyon.decode(line.decode()) for line in lines]
+
+
+class SubscriberCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.notifier = Notifier(dict())
+        self.subscriber = _Subscriber(self.notifier, True, 10)
+        self.notifier.publish = lambda mod: self.subscriber.add(
+            mod, (pyon.encode(mod) + "\n").encode())
+        self.mirror = dict()
+
+    def _sync(self):
+        for mod in _decode(self.subscriber.take()):
+            process_mod(self.mirror, mod)
+        self.assertEqual(self.mirror, self.notifier.raw_view)
+
+    def test_merge(self):
+        self.notifier["a"] = (False, [], {})
+        self.notifier["a"][1].append(1)
+        self.notifier["b"] = (False, 0, {})
+        self.notifier["b"] = (False, 1, {})
+        self.assertEqual(self.subscriber.depth, 3)
+        self._sync()
+        self.assertEqual(self.subscriber.depth, 0)
+
+        self.notifier["a"][1].append(2)
+        del self.notifier["a"]
+        self.notifier["a"] = (False, [3], {})
+        self.assertEqual(self.subscriber.depth, 1)
+        self._sync()
+
+    def test_collapse(self):
+        self.notifier["a"] = (False, [], {})
+        self._sync()
+        for i in range(100):
+            self.notifier["a"][1].append(i)
+        self.notifier["b"] = (False, 0, {})
+        self.assertEqual(self.subscriber.depth, 2)
+        self.assertEqual(self.subscriber.stats["collapsed"], 1)
+        lines = self.subscriber.take()
+        self.assertEqual(len(lines), 2)
+        self.subscriber.take = lambda: lines
+        self._sync()
+
+    def test_order(self):
+        subscriber = _Subscriber(self.notifier, False, 10)
+        self.notifier.publish = lambda mod: subscriber.add(
+            mod, (pyon.encode(mod) + "\n").encode())
+        self.notifier["a"] = 1
+        self.notifier["b"] = 2
+        self.notifier["a"] = 3
+        self.assertEqual([mod["value"] for mod in _decode(subscriber.take())],
+                         [1, 2, 3])
+
+    def test_overflow(self):
+        subscriber = _Subscriber(self.notifier, False, 10, max_pending=2)
+        self.notifier.publish = lambda mod: subscriber.add(
+            mod, (pyon.encode(mod) + "\n").encode())
+        self.notifier["a"] = 1
+        self.notifier["b"] = 2
+        self.assertFalse(subscriber.overflow)
+        self.notifier["c"] = 3
+        self.assertTrue(subscriber.overflow)
+        self.assertEqual(subscriber.depth, 0)
+        self.assertEqual(subscriber.pending, [])
+
+    def tearDown(self):
+        self.loop.close()
+
+
+class PublisherCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    async def _subscribe(self, port, name):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"ARTIQ sync_struct\n" + name.encode() + b"\n")
+        return reader, writer
+
+    async def _test_publisher(self):
+        datasets = Notifier({"a": (False, [], {})})
+        schedule = Notifier(dict())
+        publisher = CoalescingPublisher(
+            {"datasets": datasets, "schedule": schedule},
+            coalesced={"datasets"}, window=0.01, max_backlog=10)
+        await publisher.start("127.0.0.1", 0)
+        try:
+            port = publisher.server.sockets[0].getsockname()[1]
+            reader, writer = await self._subscribe(port, "datasets")
+            mirror = dict()
+            mod = pyon.decode((await reader.readline()).decode())
+            self.assertEqual(mod["action"], "init")
+            mirror.update(mod["struct"])
+            while not publisher.get_subscriber_stats():
+                await asyncio.sleep(0.01)
+
+            for i in range(100):
+                datasets["a"][1].append(i)
+            stats, = publisher.get_subscriber_stats()
+            self.assertEqual(stats["notifier"], "datasets")
+            self.assertEqual(stats["depth"], 1)
+
+            mod = pyon.decode((await reader.readline()).decode())
+            process_mod(mirror, mod)
+            self.assertEqual(mirror, datasets.raw_view)
+            writer.close()
+        finally:
+            await publisher.stop()
+
+    def test_publisher(self):
+        self.loop.run_until_complete(self._test_publisher())
+
+    async def _test_before_init(self):
+        datasets = Notifier(dict())
+        def load():
+            if "a" not in datasets.raw_view:
+                datasets["a"] = (True, 1, {})
+        publisher = CoalescingPublisher({"datasets": datasets},
+                                        before_init={"datasets": load})
+        await publisher.start("127.0.0.1", 0)
+        try:
+            port = publisher.server.sockets[0].getsockname()[1]
+            reader, writer = await self._subscribe(port, "datasets")
+            mod = pyon.decode((await reader.readline()).decode())
+            self.assertEqual(mod["struct"], {"a": (True, 1, {})})
+            writer.close()
+        finally:
+            await publisher.stop()
+
+    def test_before_init(self):
+        self.loop.run_until_complete(self._test_before_init())
+
+    async def _test_slow_subscriber(self):
+        schedule = Notifier(dict())
+        publisher = CoalescingPublisher({"schedule": schedule}, max_pending=2)
+        await publisher.start("127.0.0.1", 0)
+        try:
+            port = publisher.server.sockets[0].getsockname()[1]
+            reader, writer = await self._subscribe(port, "schedule")
+            mod = pyon.decode((await reader.readline()).decode())
+            self.assertEqual(mod["action"], "init")
+            while not publisher.get_subscriber_stats():
+                await asyncio.sleep(0.01)
+
+            for i in range(10):
+                schedule[i] = i
+            self.assertEqual(await reader.read(), b"")
+            self.assertEqual(publisher.get_subscriber_stats(), [])
+            writer.close()
+        finally:
+            await publisher.stop()
+
+    def test_slow_subscriber(self):
+        self.loop.run_until_complete(self._test_slow_subscriber())
+
+    def tearDown(self):
+        self.loop.close()
@@ -0,0 +1,88 @@
+import unittest
+import os
+import tempfile
+
+import h5py
+
+from sipyco import pyon
+
+from artiq.master.results_index import ResultsIndex
+
+
+class ResultsIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+
+    def _write(self, rid, class_name, start_time, datasets):
+        dirname = os.path.join(self.root, "2024-01-01", "00")
+        os.makedirs(dirname, exist_ok=True)
+        path = os.path.join(dirname, "{:09}-{}.h5".format(rid, class_name))
+        with h5py.File(path, "w") as f:
+            group = f.create_group("datasets")
+            for name, value in datasets.items():
+                group[name] = value
+            f.create_group("archive")["archived"] = 1.0
+            f["artiq_version"] = "8.0"
+            f["rid"] = rid
+            f["start_time"] = start_time
+            f["run_time"] = start_time + 1
+            f["expid"] = pyon.encode({"class_name": class_name,
+                                      "file": "exp.py", "repo_rev": "abc",
+                                      "arguments": {}, "log_level": 30})
+        return path
+
+    def test_scan_query(self):
+        self._write(1, "A", 100.0, {"x": [1, 2, 3]})
+        self._write(2, "B", 200.0, {"y": [[1.0, 2.0]]})
+        self._write(3, "A", 300.0, {"x": [4], "z": 1})
+        with open(os.path.join(self.root, "not_results.h5"), "w"):
+            pass
+
+        with ResultsIndex(self.root) as index:
+            self.assertEqual(index.scan(), 3)
+            self.assertEqual(index.scan(), 0)
+            self.assertEqual([r["rid"] for r in index.query()], [3, 2, 1])
+            self.assertEqual([r["rid"] for r in index.query(class_name="A")],
+                             [3, 1])
+            self.assertEqual([r["rid"] for r in index.query(dataset="x")],
+                             [3, 1])
+            self.assertEqual([r["rid"] for r in index.query(since=150.0,
+                                                              until=250.0)],
+                             [2])
+            self.assertEqual([r["rid"] for r in index.query(limit=1)], [3])
+            run, = index.query(rid=2)
+            self.assertEqual(run["repo_rev"], "abc")
+            self.assertEqual(run["run_time"], 201.0)
+            self.assertEqual(
+                [(d["archive"], d["name"], d["shape"])
+                 for d in index.get_datasets(2)],
+                [(False, "y", (1, 2)), (True, "archived", ())])
+
+        with ResultsIndex(self.root) as index:
+            self.assertEqual(
+                index.get_path(1),
+                os.path.join(self.root, "2024-01-01", "00", "000000001-A.h5"))
+            with self.assertRaises(KeyError):
+                index.get_path(4)
+
+    def test_replace(self):
+        with ResultsIndex(self.root) as index:
+            path = self._write(1, "A", 100.0, {"x": 1})
+            index.add_file(os.path.relpath(path, self.root))
+            path = self._write(1, "A", 100.0, {"y": 1})
+            index.add_file(os.path.relpath(path, self.root))
+            self.assertEqual([d["name"] for d in index.get_datasets(1)],
+                             ["y", "archived"])
+
+    def test_subgroup(self):
+        path = self._write(1, "A", 100.0, {"x": 1})
+        with h5py.File(path, "a") as f:
+            f["datasets"].create_group("group")["y"] = 2
+        with ResultsIndex(self.root) as index:
+            self.assertEqual(index.scan(), 1)
+            self.assertEqual([d["name"] for d in index.get_datasets(1)],
+                             ["x", "archived"])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
@@ -2,10 +2,14 @@ import unittest
 import logging
 import asyncio
 import sys
-from time import time, sleep
+import random
+from time import time, sleep, perf_counter
+
+from sipyco.sync_struct import Notifier
 
 from artiq.experiment import *
-from artiq.master.scheduler import Scheduler
+from artiq.master.scheduler import (Scheduler, RunPool, RunStatus,
+                                    PrepareStage, RunStage, AnalyzeStage)
 
 
 class EmptyExperiment(EnvExperiment):
@@ -424,5 +428,85 @@ class SchedulerCase(unittest.TestCase):
         loop.run_until_complete(done.wait())
         loop.run_until_complete(scheduler.stop())
 
+    def test_worker_pool(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None, None,
+                              worker_pool_sizes={"main": 1},
+                              worker_pool_max_runs=2)
+        expid = _get_expid("EmptyExperiment")
+
+        deleted = {0: asyncio.Event(), 1: asyncio.Event()}
+        def notify(mod):
+            if mod["path"] == [] and mod["action"] == "delitem":
+                deleted[mod["key"]].set()
+        scheduler.notifier.publish = notify
+
+        async def wait_idle():
+            while scheduler.get_worker_pool_stats()["main"]["idle"] < 1:
+                await asyncio.sleep(0.01)
+
+        scheduler.start(loop=loop)
+        for rid in range(2):
+            loop.run_until_complete(wait_idle())
+            scheduler.submit("main", expid, 0, None, False)
+            loop.run_until_complete(deleted[rid].wait())
+
+        stats = scheduler.get_worker_pool_stats()["main"]
+        self.assertEqual(stats["warm"], 2)
+        self.assertEqual(stats["cold"], 0)
+        self.assertEqual(stats["reused"], 1)
+        self.assertEqual(stats["retired"], 1)
+        self.assertIsNotNone(stats["mean_warm_build_time"])
+        loop.run_until_complete(scheduler.stop())
+
+    def test_dispatch_benchmark(self):
+        """Submit many runs and dispatch them through the stages without
+        workers, checking the order and bounding the latencies.
+
+        The bounds are two orders of magnitude above the measured
+        latencies and only catch a return to dispatch costs that grow
+        with the number of pending runs."""
+        n = 10000
+        rng = random.Random(0)
+        pool = RunPool(_RIDCounter(0), dict(), Notifier(dict()), None, None)
+        expid = _get_expid("EmptyExperiment")
+
+        t0 = perf_counter()
+        late = time() + 100000
+        n_late = 0
+        for i in range(n):
+            due_date = None
+            if rng.random() < 0.1:
+                due_date = late
+                n_late += 1
+            pool.submit(expid, rng.randrange(10), due_date, False, "main")
+        t1 = perf_counter()
+
+        prepare = PrepareStage(pool, None)
+        run = RunStage(pool, None)
+        analyze = AnalyzeStage(pool, None)
+        keys = []
+        while True:
+            r = prepare._get_run()
+            if r is None or isinstance(r, float):
+                break
+            r.status = RunStatus.preparing
+            r.status = RunStatus.prepare_done
+            r = run._get_run()
+            r.status = RunStatus.running
+            r.status = RunStatus.run_done
+            r = analyze._get_run()
+            r.status = RunStatus.analyzing
+            r.status = RunStatus.deleting
+            keys.append(r.priority_key())
+            self.loop.run_until_complete(pool.delete(r.rid))
+        t2 = perf_counter()
+
+        self.assertEqual(len(keys), n - n_late)
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertGreater(prepare._get_run(), 0.0)
+        self.assertLess((t1 - t0)/n, 5e-3)
+        self.assertLess((t2 - t1)/len(keys), 20e-3)
+
     def tearDown(self):
         self.loop.close()
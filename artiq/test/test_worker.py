@@ -1,11 +1,16 @@
 import unittest
 import logging
 import asyncio
+import os
 import sys
+import tempfile
 from time import sleep
 
+import numpy as np
+
 from artiq.experiment import *
 from artiq.master.worker import *
+from artiq.master import worker_ipc
 
 
 class SimpleExperiment(EnvExperiment):
@@ -52,6 +57,32 @@ class WatchdogTimeoutInBuild(EnvExperiment):
         pass
 
 
+class LargeDataset(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        data = self.get_dataset("input")
+        self.set_dataset("output", 2*data[::-1],
+                         broadcast=True, archive=False)
+
+
+_examined_file = """
+from artiq.experiment import *
+
+
+class StreamingExperiment(EnvExperiment):
+    \"\"\"Streaming experiment\"\"\"
+    def build(self):
+        self.setattr_argument("n", NumberValue(1, precision=0, step=1))
+        self.prefetch_datasets(["foo"], ["bar."])
+        self.stream_results()
+
+    def run(self):
+        pass
+"""
+
+
 async def _call_worker(worker, expid):
     try:
         await worker.build(0, "main", None, expid, 0)
@@ -67,14 +98,14 @@ class WorkerCase(unittest.TestCase):
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
-    def _run_experiment(self, class_name):
+    def _run_experiment(self, class_name, handlers={}, **kwargs):
         expid = {
             "log_level": logging.WARNING,
             "file": sys.modules[__name__].__file__,
             "class_name": class_name,
             "arguments": dict()
         }
-        worker = Worker({})
+        worker = Worker(handlers, **kwargs)
         self.loop.run_until_complete(_call_worker(worker, expid))
 
     def test_simple_run(self):
@@ -99,5 +130,126 @@ class WorkerCase(unittest.TestCase):
         with self.assertRaises(WorkerWatchdogTimeout):
             self._run_experiment("WatchdogTimeoutInBuild")
 
+    def test_large_dataset(self):
+        data = np.arange(1000000, dtype=np.int32).reshape(1000, 1000)
+        for binary_ipc in True, False:
+            mods = []
+            handlers = {
+                "get_dataset": lambda key: data,
+                "update_dataset": mods.append
+            }
+            self._run_experiment("LargeDataset", handlers,
+                                 binary_ipc=binary_ipc)
+            mod, = mods
+            self.assertEqual(mod["key"], "output")
+            np.testing.assert_array_equal(mod["value"][1], 2*data[::-1])
+            self.assertEqual(mod["value"][1].dtype, np.int32)
+
+    def test_examine(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, "streaming.py")
+            with open(file, "w") as f:
+                f.write(_examined_file)
+            worker = Worker({})
+            try:
+                r = self.loop.run_until_complete(worker.examine(0, file))
+            finally:
+                self.loop.run_until_complete(worker.close())
+        self.assertEqual(list(r.keys()), ["StreamingExperiment"])
+        self.assertEqual(r["StreamingExperiment"]["name"],
+                         "Streaming experiment")
+        self.assertEqual(list(r["StreamingExperiment"]["arginfo"].keys()),
+                         ["n"])
+
     def tearDown(self):
         self.loop.close()
+
+
+class IPCEncodingCase(unittest.TestCase):
+    def _roundtrip(self, obj, binary):
+        chunks = [bytes(c) for c in worker_ipc.encode(obj, binary)]
+        lengths = worker_ipc.parse_frame_header(chunks[0])
+        if lengths is None:
+            self.assertEqual(len(chunks), 1)
+            return worker_ipc.decode(chunks[0]), 0
+        self.assertEqual([len(c) for c in chunks[1:]], lengths)
+        return (worker_ipc.decode(chunks[1], [bytearray(c) for c in chunks[2:]]),
+                len(chunks) - 2)
+
+    def test_roundtrip(self):
+        big = np.linspace(0, 1, 100000).reshape(2, -1)
+        obj = {
+            "action": "setitem",
+            "value": (True, [big, np.arange(3)], {"unit": "V"}),
+            "other": [np.ones(50000, dtype=np.complex128),
+                      np.zeros(100000, dtype=bool)]
+        }
+        for binary in True, False:
+            decoded, n_buffers = self._roundtrip(obj, binary)
+            self.assertEqual(n_buffers, 3 if binary else 0)
+            self.assertEqual(decoded["value"][0], True)
+            self.assertEqual(decoded["value"][2], {"unit": "V"})
+            np.testing.assert_array_equal(decoded["value"][1][0], big)
+            np.testing.assert_array_equal(decoded["value"][1][1], np.arange(3))
+            for a, b in zip(decoded["other"], obj["other"]):
+                self.assertEqual(a.dtype, b.dtype)
+                np.testing.assert_array_equal(a, b)
+
+    def test_small_message(self):
+        chunks = worker_ipc.encode({"action": "completed"}, True)
+        self.assertEqual(len(chunks), 1)
+        self.assertIsNone(worker_ipc.parse_frame_header(chunks[0]))
+
+
+class _PrecompilingCore:
+    def __init__(self):
+        self.compiled = []
+
+    def _precompile(self, function, args, kwargs, defer_upload=False):
+        self.compiled.append((function.__name__, defer_upload))
+        if function.__name__ == "fail":
+            raise RuntimeError("cannot embed value")
+        return lambda: "precompiled"
+
+
+class _PrecompiledExperiment:
+    precompiled_kernels = ("run",)
+
+    def __init__(self):
+        self.core = _PrecompilingCore()
+
+    @kernel
+    def run(self):
+        pass
+
+    @kernel
+    def fail(self):
+        pass
+
+    def analyze(self):
+        pass
+
+
+class PrecompileCase(unittest.TestCase):
+    def test_precompile(self):
+        from artiq.master.worker_impl import precompile_kernels
+
+        exp_inst = _PrecompiledExperiment()
+        n, _ = precompile_kernels(exp_inst)
+        self.assertEqual(n, 1)
+        self.assertEqual(exp_inst.core.compiled, [("run", True)])
+        self.assertEqual(exp_inst.run(), "precompiled")
+
+        exp_inst = _PrecompiledExperiment()
+        exp_inst.precompiled_kernels = ("analyze",)
+        with self.assertRaises(ValueError):
+            precompile_kernels(exp_inst)
+
+        exp_inst = _PrecompiledExperiment()
+        exp_inst.precompiled_kernels = ("fail", "run")
+        with self.assertLogs(level=logging.WARNING) as logs:
+            n, _ = precompile_kernels(exp_inst)
+        self.assertEqual(n, 1)
+        self.assertIn("failed to precompile fail", logs.output[0])
+        self.assertEqual(exp_inst.fail.__name__, "fail")
+        self.assertEqual(exp_inst.run(), "precompiled")
@@ -23,6 +23,7 @@ console_scripts = [
     "artiq_compile = artiq.frontend.artiq_compile:main",
     "artiq_coreanalyzer = artiq.frontend.artiq_coreanalyzer:main",
     "artiq_coremgmt = artiq.frontend.artiq_coremgmt:main",
+    "artiq_coreemu = artiq.frontend.artiq_coreemu:main",
     "artiq_rtiomap = artiq.frontend.artiq_rtiomap:main",
     "artiq_ddb_template = artiq.frontend.artiq_ddb_template:main",
     "artiq_master = artiq.frontend.artiq_master:main",
@@ -31,6 +32,7 @@ console_scripts = [
     "artiq_sinara_tester = artiq.frontend.artiq_sinara_tester:main",
     "artiq_session = artiq.frontend.artiq_session:main",
     "artiq_route = artiq.frontend.artiq_route:main",
+    "artiq_results = artiq.frontend.artiq_results:main",
     "artiq_run = artiq.frontend.artiq_run:main",
     "artiq_flash = artiq.frontend.artiq_flash:main",
     "aqctl_corelog = artiq.frontend.aqctl_corelog:main",